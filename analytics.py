@@ -0,0 +1,67 @@
+# analytics.py
+"""
+Групповые сводки по столбцам NumPy (для /statistic): число строк, сумма флага,
+минимум, среднее, максимум и процентили по каждой группе — без циклов по строкам.
+
+    keys   — int64, код группы; MISSING — строка ни в какую группу не входит
+    values — float64, NaN — значения нет (строка считается, но в ценах не участвует)
+    flags  — 0/1, например «в наличии»
+"""
+from typing import Dict, Iterable, Optional, Sequence
+
+import numpy as np
+
+MISSING = -1
+
+
+def column(values: Iterable, dtype=float, missing=np.nan) -> np.ndarray:
+    """Столбец из значений строк БД: None -> missing (Decimal и bool приводятся к dtype)."""
+    return np.array([missing if v is None else v for v in values], dtype=dtype)
+
+
+def group_stats(keys: np.ndarray, values: np.ndarray, flags: Optional[np.ndarray] = None,
+                percentiles: Sequence[float] = ()) -> Dict[str, np.ndarray]:
+    """
+    Сводка по группам. Возвращает массивы одинаковой длины (по группе на элемент):
+    keys, count, flagged, min, mean, max (NaN — у группы нет значений) и
+    percentiles {q: массив} — с линейной интерполяцией, как np.percentile.
+    """
+    keep = keys != MISSING
+    keys, values = keys[keep], values[keep]
+    groups, inv = np.unique(keys, return_inverse=True)
+    size = len(groups)
+    result: Dict[str, np.ndarray] = {
+        'keys': groups,
+        'count': np.bincount(inv, minlength=size),
+        'flagged': (np.bincount(inv, weights=flags[keep], minlength=size).astype(np.int64)
+                    if flags is not None else np.zeros(size, dtype=np.int64)),
+    }
+
+    # значения группы подряд и по возрастанию: минимум — первое, максимум — последнее
+    known = ~np.isnan(values)
+    vg, vv = inv[known], values[known]
+    order = np.lexsort((vv, vg))
+    vg, vv = vg[order], vv[order]
+    n = np.bincount(vg, minlength=size)
+    start = np.cumsum(n) - n
+    has = n > 0
+    last = start + np.maximum(n, 1) - 1
+
+    def pick(pos: np.ndarray) -> np.ndarray:
+        out = np.full(size, np.nan)
+        out[has] = vv[pos[has]]
+        return out
+
+    result['min'] = pick(start)
+    result['max'] = pick(last)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result['mean'] = np.where(has, np.bincount(vg, weights=vv, minlength=size) / n, np.nan)
+
+    result['percentiles'] = {}
+    for q in percentiles:
+        pos = start + (n - 1).clip(min=0) * min(max(q, 0.0), 1.0)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, last)
+        low, high = pick(lo), pick(hi)
+        result['percentiles'][q] = low + (high - low) * (pos - lo)
+    return result
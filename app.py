@@ -1,18 +1,32 @@
 import os
 import re
-from datetime import date as _Date, datetime as _DT
-from functools import wraps
+from datetime import date as _Date, datetime as _DT, timedelta, timezone
+from functools import lru_cache, wraps
 from typing import Optional, List, Tuple, Dict, Any
 
 import sys, json
-from contextlib import closing
+import tempfile
+import csv
+import base64
+import bisect
+import hashlib
+import hmac
+import io
+import itertools
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from decimal import Decimal
+from contextlib import closing, contextmanager, nullcontext
 
 import psycopg2
 import psycopg2.extras
 import sqlite3
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    jsonify, flash, session, abort
+    jsonify, flash, session, abort, stream_template, get_flashed_messages,
+    Response, stream_with_context, make_response, g, has_request_context
 )
 from flask_login import (
     LoginManager, UserMixin, login_user, logout_user,
@@ -20,6 +34,14 @@ from flask_login import (
 )
 from werkzeug.security import generate_password_hash, check_password_hash
 
+try:
+    import numpy as np
+    import analytics
+except ImportError:      # нужен только для «похожих устройств» и сводок /statistic
+    np = analytics = None
+
+from db_pool import ConnectionPool, env_int, env_float
+
 # -------------------------------------------------
 # Конфиг
 # -------------------------------------------------
@@ -40,33 +62,326 @@ def current_backend() -> str:
 def backend_name() -> str:
     return "PostgreSQL" if current_backend() == "pg" else "SQLite"
 
-def get_conn():
-    if current_backend() == "pg":
-        return psycopg2.connect(PG_DSN)
-    else:
-        conn = sqlite3.connect(SQLITE_PATH)
-        conn.execute("PRAGMA foreign_keys = ON")
-        return conn
+def _connect_pg():
+    return psycopg2.connect(PG_DSN)
+
+def _connect_sqlite():
+    # соединение переходит между потоками через пул, но одновременно им владеет один поток
+    conn = sqlite3.connect(SQLITE_PATH, check_same_thread=False)
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+# Настройки пулов: PG_POOL_SIZE / PG_POOL_MAX_OVERFLOW / PG_POOL_TIMEOUT /
+# PG_POOL_RECYCLE / PG_POOL_PING_INTERVAL и такие же SQLITE_POOL_*.
+_POOL_DEFAULTS = {
+    'pg':     {'connect': _connect_pg,     'size': 5, 'max_overflow': 10},
+    'sqlite': {'connect': _connect_sqlite, 'size': 5, 'max_overflow': 5},
+}
+_POOLS: Dict[str, ConnectionPool] = {}
+_POOLS_LOCK = threading.Lock()
+
+def get_pool(backend: Optional[str] = None) -> ConnectionPool:
+    backend = backend or current_backend()
+    pool = _POOLS.get(backend)
+    if pool is None:
+        with _POOLS_LOCK:
+            pool = _POOLS.get(backend)
+            if pool is None:
+                cfg = _POOL_DEFAULTS[backend]
+                prefix = "PG_POOL_" if backend == "pg" else "SQLITE_POOL_"
+                pool = ConnectionPool(
+                    backend, cfg['connect'],
+                    size=env_int(prefix + "SIZE", cfg['size']),
+                    max_overflow=env_int(prefix + "MAX_OVERFLOW", cfg['max_overflow']),
+                    timeout=env_float(prefix + "TIMEOUT", 30.0),
+                    recycle=env_float(prefix + "RECYCLE", 1800.0),
+                    ping_interval=env_float(prefix + "PING_INTERVAL", 30.0),
+                )
+                _POOLS[backend] = pool
+    return pool
+
+def close_pools():
+    """Закрыть все пулы; следующий get_conn() откроет новые (в т.ч. в дочернем процессе после fork)."""
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+    for pool in pools:
+        pool.close()
+
+def get_conn(backend: Optional[str] = None):
+    """Соединение из пула текущего бэкенда; в `with` возвращается в пул на выходе."""
+    conn = get_pool(backend).acquire()
+    if conn.backend not in _AUX_READY:
+        try:
+            ensure_aux_schema(conn)
+        except Exception:
+            conn.release(discard=True)
+            raise
+    return conn
 
 class AnyCursor:
-    """Единый курсор: в SQLite заменяет %s → ?"""
+    """Единый курсор: в SQLite заменяет %s → ?; при SQL_STATS_ENABLED замеряет каждый запрос."""
     def __init__(self, cur, backend: str):
         self._cur = cur
         self._backend = backend
+        self._stmt: Optional[Dict[str, Any]] = None   # замер текущего запроса
     def execute(self, sql, params=()):
         if self._backend == "sqlite":
             sql = sql.replace("%s", "?")
-        return self._cur.execute(sql, params or ())
+        if not SQL_STATS_ENABLED:
+            return self._cur.execute(sql, params or ())
+        return self._measured(self._cur.execute, sql, params or (), many=False)
     def executemany(self, sql, seq):
         if self._backend == "sqlite":
             sql = sql.replace("%s", "?")
-        return self._cur.executemany(sql, seq)
-    def fetchone(self): return self._cur.fetchone()
-    def fetchall(self): return self._cur.fetchall()
+        if not SQL_STATS_ENABLED:
+            return self._cur.executemany(sql, seq)
+        return self._measured(self._cur.executemany, sql, seq, many=True)
+    def copy_expert(self, sql, file):
+        if not SQL_STATS_ENABLED:
+            return self._cur.copy_expert(sql, file)
+        return self._measured(lambda q, f: self._cur.copy_expert(q, f), sql, file, many=True)
+    def fetchone(self):
+        if self._stmt is None:
+            return self._cur.fetchone()
+        t0 = time.perf_counter()
+        row = self._cur.fetchone()
+        self._fetched(t0, 0 if row is None else 1)
+        return row
+    def fetchall(self):
+        if self._stmt is None:
+            return self._cur.fetchall()
+        t0 = time.perf_counter()
+        rows = self._cur.fetchall()
+        self._fetched(t0, len(rows))
+        return rows
+    def fetchmany(self, size=None):
+        if self._stmt is None:
+            return self._cur.fetchmany() if size is None else self._cur.fetchmany(size)
+        t0 = time.perf_counter()
+        rows = self._cur.fetchmany() if size is None else self._cur.fetchmany(size)
+        self._fetched(t0, len(rows))
+        return rows
+    def __iter__(self):
+        return iter(self._cur) if self._stmt is None else self._iter_measured()
     def __getattr__(self, name): return getattr(self._cur, name)
 
+    # --- замеры ---
+    def _measured(self, run, sql, params, many: bool):
+        fp = sql_fingerprint(sql)
+        self._stmt = {'fp': fp, 'sql': sql, 'params': None if many else params, 'ms': 0.0, 'slow': None}
+        t0 = time.perf_counter()
+        try:
+            result = run(sql, params)
+        except Exception:
+            SQL_STATS.record(self._backend, fp, (time.perf_counter() - t0) * 1000.0, 0, calls=1, errors=1)
+            self._stmt = None
+            raise
+        # строки SELECT считаем при выборке, для INSERT/UPDATE/DELETE — rowcount
+        rows = self._cur.rowcount if not fp.startswith(("SELECT", "WITH", "PRAGMA")) and self._cur.rowcount > 0 else 0
+        self._account(t0, rows, calls=1)
+        return result
+
+    def _fetched(self, t0: float, rows: int):
+        self._account(t0, rows, calls=0)
+
+    def _iter_measured(self):
+        it = iter(self._cur)
+        ms, rows = 0.0, 0
+        try:
+            while True:
+                t0 = time.perf_counter()
+                try:
+                    row = next(it)
+                except StopIteration:
+                    break
+                finally:
+                    ms += (time.perf_counter() - t0) * 1000.0
+                rows += 1
+                yield row
+        finally:
+            if self._stmt is not None:
+                self._add(ms, rows, calls=0)
+
+    def _account(self, t0: float, rows: int, calls: int):
+        self._add((time.perf_counter() - t0) * 1000.0, rows, calls)
+
+    def _add(self, ms: float, rows: int, calls: int):
+        stmt = self._stmt
+        stmt['ms'] += ms
+        SQL_STATS.record(self._backend, stmt['fp'], ms, rows, calls=calls, stmt_ms=stmt['ms'])
+        if has_request_context():
+            g.sql_queries = g.get('sql_queries', 0) + calls
+            g.sql_ms = g.get('sql_ms', 0.0) + ms
+        if stmt['slow'] is not None:
+            stmt['slow']['ms'] = round(stmt['ms'], 1)
+            stmt['slow']['rows'] += rows
+        elif SLOW_QUERY_MS and stmt['ms'] >= SLOW_QUERY_MS:
+            stmt['slow'] = log_slow_query(self._cur, self._backend, stmt, rows)
+
 def tup_cur(conn):
-    return AnyCursor(conn.cursor(), "sqlite" if current_backend() == "sqlite" else "pg")
+    return AnyCursor(conn.cursor(), "sqlite" if _is_sqlite_conn(conn) else "pg")
+
+def run_queries(conn, queries: List[Tuple[str, List[Any]]]) -> List[List[tuple]]:
+    """Выполнить запросы [(sql, params)] по очереди; строки каждого — отдельным списком."""
+    cur = tup_cur(conn)
+    result = []
+    for sql, params in queries:
+        cur.execute(sql, params)
+        result.append(cur.fetchall())
+    return result
+
+# -------------------------------------------------
+# Замеры SQL: время, строки, отпечатки запросов, медленные запросы
+# -------------------------------------------------
+# Всё, что идёт через AnyCursor, складывается по отпечатку запроса (литералы, параметры
+# и списки IN (...) заменены на ?) и по эндпоинту: сколько запросов и времени БД уходит
+# на один HTTP-запрос — так видны N+1. Счётчики свои в каждом процессе.
+SQL_STATS_ENABLED = env_int("SQL_STATS_ENABLED", 1) == 1
+SLOW_QUERY_MS = env_float("SLOW_QUERY_MS", 200.0)          # 0 — не отслеживать
+SLOW_QUERY_EXPLAIN = env_int("SLOW_QUERY_EXPLAIN", 1) == 1
+SLOW_QUERY_LOG_SIZE = env_int("SLOW_QUERY_LOG_SIZE", 100)
+SQL_FINGERPRINTS_MAX = env_int("SQL_FINGERPRINTS_MAX", 1000)
+SQL_METRICS_TOP = 50            # сколько самых дорогих отпечатков отдавать в /admin/perf/metrics
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")   # Bearer-токен для сборщика метрик (иначе — только админ)
+
+_FP_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_FP_STRING = re.compile(r"'(?:[^']|'')*'")
+_FP_PARAM = re.compile(r"%s|\?|\$\d+")
+_FP_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_FP_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_FP_SPACE = re.compile(r"\s+")
+
+@lru_cache(maxsize=4096)
+def sql_fingerprint(sql: str) -> str:
+    """Запрос без литералов: `... IN (%s, %s)` и `... IN (1, 2, 3)` дают один отпечаток."""
+    s = _FP_COMMENT.sub(" ", sql)
+    s = _FP_STRING.sub("?", s)
+    s = _FP_PARAM.sub("?", s)
+    s = _FP_NUMBER.sub("?", s)
+    s = _FP_LIST.sub("(?...)", s)
+    return _FP_SPACE.sub(" ", s).strip()
+
+def query_id(fingerprint: str) -> str:
+    return hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()[:12]
+
+class SqlStats:
+    """Накопленные замеры процесса: по отпечаткам, по эндпоинтам и журнал медленных запросов."""
+    OTHER = "(прочие запросы)"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.since = time.time()
+            self.queries: Dict[Tuple[str, str], Dict[str, float]] = {}   # (backend, отпечаток) -> счётчики
+            self.endpoints: Dict[str, Dict[str, float]] = {}
+            self.slow: "deque[Dict[str, Any]]" = deque(maxlen=max(1, SLOW_QUERY_LOG_SIZE))
+            self.slow_total = 0
+
+    def record(self, backend: str, fp: str, ms: float, rows: int, calls: int = 0, errors: int = 0,
+               stmt_ms: float = 0.0):
+        """ms/rows — прирост (выполнение или выборка строк), stmt_ms — итог выполнения на сейчас."""
+        with self._lock:
+            item = self.queries.get((backend, fp))
+            if item is None:
+                if len(self.queries) >= SQL_FINGERPRINTS_MAX:
+                    fp = self.OTHER
+                item = self.queries.setdefault((backend, fp), {
+                    'calls': 0, 'ms': 0.0, 'max_ms': 0.0, 'rows': 0, 'errors': 0, 'slow': 0})
+            item['calls'] += calls
+            item['ms'] += ms
+            item['rows'] += rows
+            item['errors'] += errors
+            item['max_ms'] = max(item['max_ms'], stmt_ms or ms)
+
+    def record_request(self, endpoint: str, queries: int, ms: float):
+        with self._lock:
+            item = self.endpoints.setdefault(endpoint, {'requests': 0, 'queries': 0, 'ms': 0.0, 'max_queries': 0})
+            item['requests'] += 1
+            item['queries'] += queries
+            item['ms'] += ms
+            item['max_queries'] = max(item['max_queries'], queries)
+
+    def add_slow(self, backend: str, fp: str, entry: Dict[str, Any]):
+        with self._lock:
+            self.slow_total += 1
+            self.slow.appendleft(entry)
+            item = self.queries.get((backend, fp))
+            if item is not None:
+                item['slow'] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            queries = [dict(v, backend=b, fingerprint=fp, id=query_id(fp)) for (b, fp), v in self.queries.items()]
+            endpoints = [dict(v, endpoint=e) for e, v in self.endpoints.items()]
+            slow = [dict(e) for e in self.slow]
+            since, slow_total = self.since, self.slow_total
+        for q in queries:
+            q['avg_ms'] = q['ms'] / q['calls'] if q['calls'] else 0.0
+        for e in endpoints:
+            e['avg_queries'] = e['queries'] / e['requests']
+            e['avg_ms'] = e['ms'] / e['requests']
+        queries.sort(key=lambda q: q['ms'], reverse=True)
+        endpoints.sort(key=lambda e: e['ms'], reverse=True)
+        return {'since': since, 'pid': os.getpid(), 'queries': queries, 'endpoints': endpoints,
+                'slow': slow, 'slow_total': slow_total}
+
+SQL_STATS = SqlStats()
+
+_EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+
+def explain_query(raw_cur, backend: str, sql: str, params) -> str:
+    """План запроса отдельным курсором того же соединения (без выполнения самого запроса)."""
+    if params is None or not sql.lstrip().upper().startswith(_EXPLAINABLE):
+        return ""
+    cur = raw_cur.connection.cursor()
+    try:
+        if backend == "sqlite":
+            cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return "\n".join(str(r[-1]) for r in cur.fetchall())
+        # ошибка внутри транзакции PG испортила бы её — пробуем под точкой сохранения
+        cur.execute("SAVEPOINT slow_query_explain")
+        try:
+            cur.execute("EXPLAIN " + sql, params)
+            return "\n".join(r[0] for r in cur.fetchall())
+        except Exception:
+            cur.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            raise
+        finally:
+            cur.execute("RELEASE SAVEPOINT slow_query_explain")
+    except Exception as e:
+        return f"EXPLAIN не удался: {e}"
+    finally:
+        cur.close()
+
+def log_slow_query(raw_cur, backend: str, stmt: Dict[str, Any], rows: int) -> Dict[str, Any]:
+    endpoint = (request.endpoint or request.path) if has_request_context() else "-"
+    entry = {
+        'at': time.time(), 'backend': backend, 'endpoint': endpoint,
+        'ms': round(stmt['ms'], 1), 'rows': rows, 'fingerprint': stmt['fp'], 'id': query_id(stmt['fp']),
+        'plan': explain_query(raw_cur, backend, stmt['sql'], stmt['params']) if SLOW_QUERY_EXPLAIN else "",
+    }
+    app.logger.warning("Медленный запрос (%s, %s): %.1f мс: %s%s", backend, endpoint, stmt['ms'], stmt['fp'],
+                       "\n" + entry['plan'] if entry['plan'] else "")
+    SQL_STATS.add_slow(backend, stmt['fp'], entry)
+    return entry
+
+@app.after_request
+def _sql_server_timing(resp):
+    # для потоковых ответов здесь только запросы до начала отдачи; полный итог — в teardown
+    if SQL_STATS_ENABLED and g.get('sql_queries'):
+        timing = f'db;dur={g.sql_ms:.1f};desc="{g.sql_queries} SQL"'
+        existing = resp.headers.get('Server-Timing')
+        resp.headers['Server-Timing'] = f"{existing}, {timing}" if existing else timing
+    return resp
+
+@app.teardown_request
+def _sql_request_totals(exc):
+    if SQL_STATS_ENABLED:
+        SQL_STATS.record_request(request.endpoint or "(404)", g.get('sql_queries', 0), g.get('sql_ms', 0.0))
 
 def _sort_ci_tuples(rows, idx=1):
     return sorted(rows, key=lambda r: (str(r[idx]).strip().casefold(), r[idx]))
@@ -80,6 +395,7 @@ def _sort_ci_dicts(items, key_name="name"):
 # --------------------------
 def _is_sqlite_conn(conn) -> bool:
     """Return True if this is a sqlite3 connection."""
+    conn = getattr(conn, "raw", conn)  # соединение из пула
     return getattr(conn, "__class__", type("X",(object,),{})).__module__.split(".",1)[0] == "sqlite3"
 
 def _ph(conn) -> str:
@@ -160,98 +476,475 @@ def inject_db_backend():
 
 
 # -------------------------------------------------
-# Интроспекция БД (PostgreSQL)
+# Интроспекция БД: кэш схемы (PostgreSQL / SQLite)
 # -------------------------------------------------
+SCHEMA_CACHE_TTL = env_float("SCHEMA_CACHE_TTL", 300.0)   # сек; 0 — перечитывать всегда
+SCHEMA_STAMP_CHECK = 1.0   # как часто сверять версию схемы SQLite (PRAGMA schema_version), сек
+
+_SCHEMA_SQL_PG = """
+    SELECT 'col', c.relname, a.attname, a.attnum::int, NULL, NULL
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+    WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p') AND NOT c.relispartition
+    UNION ALL
+    SELECT 'pk', c.relname, a.attname, array_position(i.indkey, a.attnum)::int, NULL, NULL
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = ANY(i.indkey)
+    WHERE i.indisprimary AND n.nspname = 'public'
+    UNION ALL
+    SELECT 'fk', c.relname, a.attname, k.ord::int, rc.relname, ra.attname
+    FROM pg_constraint con
+    JOIN pg_class c ON c.oid = con.conrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_class rc ON rc.oid = con.confrelid
+    CROSS JOIN LATERAL unnest(con.conkey, con.confkey) WITH ORDINALITY AS k(attnum, refnum, ord)
+    JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+    JOIN pg_attribute ra ON ra.attrelid = con.confrelid AND ra.attnum = k.refnum
+    WHERE con.contype = 'f' AND n.nspname = 'public'
+"""
+
+_SCHEMA_SQL_SQLITE = """
+    SELECT 'col', m.name, p.name, p.cid, p.pk, NULL
+    FROM sqlite_master m JOIN pragma_table_info(m.name) p
+    WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%'
+    UNION ALL
+    SELECT 'fk', m.name, f."from", f.seq, f."table", f."to"
+    FROM sqlite_master m JOIN pragma_foreign_key_list(m.name) f
+    WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%'
+"""
+
+def _conn_backend(conn) -> str:
+    return "sqlite" if _is_sqlite_conn(conn) else "pg"
+
+def _schema_stamp(conn) -> Optional[int]:
+    """Версия схемы: у SQLite меняется при любом DDL; у PG нет — там только TTL и invalidate_schema()."""
+    if not _is_sqlite_conn(conn):
+        return None
+    with closing(conn.cursor()) as cur:
+        cur.execute("PRAGMA schema_version")
+        return cur.fetchone()[0]
+
+class SchemaCatalog:
+    """Снимок схемы одного бэкенда: таблицы, столбцы, PK и FK."""
+    def __init__(self, rows, stamp: Optional[int], sqlite_pk: bool):
+        self.columns: Dict[str, List[str]] = {}
+        self.fks: Dict[str, List[Tuple[str, str, str]]] = {}   # таблица -> [(столбец, ref_таблица, ref_столбец)]
+        pks: Dict[str, List[Tuple[int, str]]] = {}
+        cols: Dict[str, List[Tuple[int, str]]] = {}
+        for kind, table, col, pos, a, b in rows:
+            if kind == 'col':
+                cols.setdefault(table, []).append((pos, col))
+                if sqlite_pk and a:          # SQLite: p.pk — номер в составе PK
+                    pks.setdefault(table, []).append((a, col))
+            elif kind == 'pk':
+                pks.setdefault(table, []).append((pos, col))
+            else:
+                self.fks.setdefault(table, []).append((col, a, b))
+        for table, items in cols.items():
+            self.columns[table] = [c for _, c in sorted(items)]
+        self.pks: Dict[str, Optional[str]] = {t: min(items)[1] for t, items in pks.items()}
+        self.tables: List[str] = sorted(self.columns)
+        self.stamp = stamp
+        self.loaded_at = time.monotonic()
+        self.stamp_checked_at = self.loaded_at
+
+    def referencing(self, table_name: str) -> List[Tuple[str, str]]:
+        """Кто ссылается на таблицу: [(дочерняя_таблица, столбец)]."""
+        return [(t, col) for t, items in self.fks.items() for col, ref, _ in items if ref == table_name]
+
+_SCHEMA_CACHE: Dict[str, SchemaCatalog] = {}
+_SCHEMA_LOCK = threading.Lock()
+
+def invalidate_schema(backend: Optional[str] = None):
+    """Сбросить кэш схемы (после собственного DDL приложения)."""
+    with _SCHEMA_LOCK:
+        if backend:
+            _SCHEMA_CACHE.pop(backend, None)
+        else:
+            _SCHEMA_CACHE.clear()
+
+def schema_catalog(conn) -> SchemaCatalog:
+    """Схема бэкенда этого соединения: из кэша, либо одним запросом к каталогу."""
+    backend = _conn_backend(conn)
+    cat = _SCHEMA_CACHE.get(backend)
+    now = time.monotonic()
+    if cat is not None and SCHEMA_CACHE_TTL and now - cat.loaded_at < SCHEMA_CACHE_TTL:
+        if cat.stamp is None or now - cat.stamp_checked_at < SCHEMA_STAMP_CHECK:
+            return cat
+        if _schema_stamp(conn) == cat.stamp:
+            cat.stamp_checked_at = now
+            return cat
+
+    stamp = _schema_stamp(conn)
+    with closing(conn.cursor()) as cur:
+        cur.execute(_SCHEMA_SQL_SQLITE if backend == "sqlite" else _SCHEMA_SQL_PG)
+        cat = SchemaCatalog(cur.fetchall(), stamp, sqlite_pk=(backend == "sqlite"))
+    with _SCHEMA_LOCK:
+        _SCHEMA_CACHE[backend] = cat
+    return cat
+
 def get_pk_name(conn, table_name: str) -> Optional[str]:
+    """Имя первого столбца первичного ключа."""
+    return schema_catalog(conn).pks.get(table_name)
+
+def list_user_tables(conn) -> List[str]:
+    """Список пользовательских таблиц (SQLite/PG), без служебных таблиц приложения."""
+    return [t for t in schema_catalog(conn).tables if t not in _AUX_TABLES]
+
+def count_columns(conn, table_name: str) -> int:
+    """Количество столбцов (SQLite/PG)."""
+    return len(schema_catalog(conn).columns.get(table_name, ()))
+
+def columns_for_table(conn, table_name: str) -> List[str]:
+    return list(schema_catalog(conn).columns.get(table_name, ()))
+
+# -------------------------------------------------
+# Выдача id: PG — identity-последовательности, SQLite — rowid
+# -------------------------------------------------
+_PG_SEQUENCES: Dict[str, Optional[str]] = {}   # таблица -> имя последовательности (None — её нет)
+_PG_SEQUENCES_LOCK = threading.Lock()
+
+def _pg_sequence(conn, table_name: str, pk: str) -> Optional[str]:
     """
-    Возвращает имя первого столбца первичного ключа.
-    SQLite: PRAGMA table_info
-    PostgreSQL: системные каталоги.
+    Имя последовательности PK-столбца. При первом обращении в процессе
+    подтягивает её до MAX(pk): данные грузились с явными id, и последовательность
+    могла отстать. Назад последовательность не двигается.
     """
-    if _is_sqlite_conn(conn):
+    if table_name in _PG_SEQUENCES:
+        return _PG_SEQUENCES[table_name]
+    with _PG_SEQUENCES_LOCK:
+        if table_name in _PG_SEQUENCES:
+            return _PG_SEQUENCES[table_name]
         with closing(conn.cursor()) as cur:
-            cur.execute(f"PRAGMA table_info({table_name})")
-            # cols: cid, name, type, notnull, dflt_value, pk(0/1/seq)
-            for cid, name, ctype, notnull, dflt, pk in cur.fetchall():
-                if pk:  # первый участвующий в PK
-                    return name
-            return None
+            cur.execute("SELECT pg_get_serial_sequence(%s, %s)", (table_name, pk))
+            seq = cur.fetchone()[0]
+            if seq:
+                cur.execute(f"""
+                    SELECT setval(%s, GREATEST(
+                        (SELECT COALESCE(MAX({pk}), 0) FROM {table_name}),
+                        COALESCE(pg_sequence_last_value(%s::regclass), 0),
+                        1))
+                """, (seq, seq))
+        _PG_SEQUENCES[table_name] = seq
+        return seq
+
+def insert_returning_id(conn, table_name: str, row: Dict[str, Any], pk: Optional[str] = None) -> int:
+    """
+    INSERT без PK — id выдаёт сама БД, без MAX(pk)+1 и без гонок между писателями.
+    PostgreSQL: identity-последовательность + RETURNING.
+    SQLite: INTEGER PRIMARY KEY (псевдоним rowid) + lastrowid.
+    Для PG-таблиц без последовательности — MAX+1 под блокировкой таблицы.
+    """
+    pk = pk or get_pk_name(conn, table_name) or f"{table_name.rstrip('s')}_id"
+    cols = list(row.keys())
+    vals = list(row.values())
+    cur = tup_cur(conn)
+    if _is_sqlite_conn(conn):
+        if cols:
+            cur.execute(f"INSERT INTO {table_name} ({', '.join(cols)}) VALUES ({', '.join(['%s'] * len(cols))})", vals)
+        else:
+            cur.execute(f"INSERT INTO {table_name} DEFAULT VALUES")
+        return int(cur.lastrowid)
+
+    if _pg_sequence(conn, table_name, pk) is None:
+        cur.execute(f"LOCK TABLE {table_name} IN SHARE ROW EXCLUSIVE MODE")
+        cur.execute(f"SELECT COALESCE(MAX({pk}), 0) + 1 FROM {table_name}")
+        cols, vals = [pk] + cols, [cur.fetchone()[0]] + vals
+    if cols:
+        cur.execute(f"INSERT INTO {table_name} ({', '.join(cols)}) VALUES ({', '.join(['%s'] * len(cols))}) RETURNING {pk}", vals)
     else:
-        sql = """
-        SELECT a.attname
-        FROM pg_index i
-        JOIN pg_class c ON c.oid = i.indrelid
-        JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = ANY(i.indkey)
-        JOIN pg_namespace n ON n.oid = c.relnamespace
-        WHERE i.indisprimary = true
-          AND n.nspname = 'public'
-          AND c.relname = %s
-        ORDER BY array_position(i.indkey, a.attnum)
-        LIMIT 1;
-        """
-        with closing(conn.cursor()) as cur:
-            cur.execute(sql, (table_name,))
-            row = cur.fetchone()
-            return row[0] if row else None
+        cur.execute(f"INSERT INTO {table_name} DEFAULT VALUES RETURNING {pk}")
+    return int(cur.fetchone()[0])
 
-def next_id(conn, table_name: str) -> tuple[int, str]:
+class IdBlockAllocator:
     """
-    Возвращает (следующий_id, имя_pk) для заданной таблицы.
-    Следующий_id = COALESCE(MAX(pk), 0) + 1
+    Резерв диапазонов id для массовой загрузки: один запрос к БД на блок,
+    дальше id выдаются из памяти.
+
+    PostgreSQL: блок — `block_size` значений nextval() одной выборкой; они
+    не пересекаются ни с другими процессами, ни с обычными INSERT.
+    SQLite: писатель в базе один, поэтому блок берётся от MAX(rowid) под
+    BEGIN IMMEDIATE и действует, пока открыта эта транзакция на этом соединении;
+    в этой транзакции id для таблицы нужно брать только из блока.
     """
-    pk = get_pk_name(conn, table_name) or f"{table_name.rstrip('s')}_id"
-    with closing(conn.cursor()) as cur:
-        cur.execute(f"SELECT COALESCE(MAX({pk}), 0) + 1 FROM {table_name}")
-        nid = cur.fetchone()[0]
-    return int(nid), pk
+    def __init__(self, table_name: str, pk: Optional[str] = None, block_size: int = 1000):
+        self.table_name = table_name
+        self.pk = pk
+        self.block_size = max(1, block_size)
+        self._ids: List[int] = []
+        self._owner = None
+        self._high = 0      # SQLite: последний выданный id в текущей транзакции
+        self._lock = threading.Lock()
+
+    def next(self, conn) -> int:
+        with self._lock:
+            raw = getattr(conn, "raw", conn)
+            if _is_sqlite_conn(conn) and (self._owner is not raw or not raw.in_transaction):
+                self._ids, self._high = [], 0   # транзакция, под которой брали блок, уже закрыта
+            if not self._ids:
+                self._reserve(conn, raw)
+            self._high = self._ids.pop()
+            return self._high
+
+    def _reserve(self, conn, raw):
+        pk = self.pk = self.pk or get_pk_name(conn, self.table_name) or f"{self.table_name.rstrip('s')}_id"
+        with closing(conn.cursor()) as cur:
+            if _is_sqlite_conn(conn):
+                if not raw.in_transaction:
+                    cur.execute("BEGIN IMMEDIATE")
+                cur.execute(f"SELECT COALESCE(MAX({pk}), 0) FROM {self.table_name}")
+                start = max(int(cur.fetchone()[0]), self._high) + 1
+                ids = list(range(start, start + self.block_size))
+            else:
+                seq = _pg_sequence(conn, self.table_name, pk)
+                if seq is None:
+                    raise RuntimeError(f"{self.table_name}.{pk}: нет последовательности для резерва id")
+                cur.execute("SELECT nextval(%s) FROM generate_series(1, %s)", (seq, self.block_size))
+                ids = sorted(int(r[0]) for r in cur.fetchall())
+        self._ids = ids[::-1]   # pop() с конца выдаёт по возрастанию
+        self._owner = raw
+
+def reserve_ids(conn, table_name: str, pk: str, count: int) -> List[int]:
+    """
+    count новых id для явной вставки в текущей транзакции. PG-таблица без
+    последовательности блокируется до конца транзакции (как в insert_returning_id).
+    """
+    if count <= 0:
+        return []
+    if _is_sqlite_conn(conn) or _pg_sequence(conn, table_name, pk) is not None:
+        alloc = IdBlockAllocator(table_name, pk, block_size=count)
+        return [alloc.next(conn) for _ in range(count)]
+    cur = tup_cur(conn)
+    cur.execute(f"LOCK TABLE {table_name} IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute(f"SELECT COALESCE(MAX({pk}), 0) FROM {table_name}")
+    start = int(cur.fetchone()[0]) + 1
+    return list(range(start, start + count))
+
+def _pg_copy_value(value) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+def bulk_insert(conn, table_name: str, rows: List[Dict[str, Any]]) -> int:
+    """
+    Вставка пачки строк: PG — COPY FROM STDIN, SQLite — executemany.
+    Строки с разным набором столбцов пишутся отдельными группами, чтобы
+    для пропущенных столбцов сработали DEFAULT, как при обычном INSERT.
+    """
+    groups: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+    for row in rows:
+        groups.setdefault(tuple(row), []).append(row)
+    cur = tup_cur(conn)
+    for cols, items in groups.items():
+        if _is_sqlite_conn(conn):
+            cur.executemany(f"INSERT INTO {table_name} ({', '.join(cols)}) VALUES ({', '.join(['%s'] * len(cols))})",
+                            [[r[c] for c in cols] for r in items])
+        else:
+            buf = io.StringIO()
+            for r in items:
+                buf.write("\t".join(_pg_copy_value(r[c]) for c in cols))
+                buf.write("\n")
+            buf.seek(0)
+            cur.copy_expert(f"COPY {table_name} ({', '.join(cols)}) FROM STDIN", buf)
+    return len(rows)
 
-def list_user_tables(conn) -> List[str]:
-    """Список пользовательских таблиц (SQLite/PG)."""
-    if _is_sqlite_conn(conn):
+# -------------------------------------------------
+# Служебные таблицы и уведомления об изменениях данных
+# -------------------------------------------------
+# Проекции и сводки, которые приложение ведёт само. DDL выполняется один раз
+# на бэкенд при первом соединении процесса; bootstrap(conn) — начальное заполнение.
+_AUX_SCHEMA: List[Tuple[Dict[str, List[str]], Optional[Any]]] = []
+_AUX_TABLES: set = set()
+_AUX_READY: set = set()
+_AUX_LOCK = threading.Lock()
+_AUX_PG_LOCK_KEY = 0x44657644   # ключ pg_advisory_xact_lock для DDL служебных таблиц
+
+def register_aux_schema(tables: List[str], ddl: List[str], ddl_sqlite: Optional[List[str]] = None, bootstrap=None):
+    _AUX_SCHEMA.append(({'pg': ddl, 'sqlite': ddl_sqlite if ddl_sqlite is not None else ddl}, bootstrap))
+    _AUX_TABLES.update(tables)
+
+def ensure_aux_schema(conn):
+    backend = _conn_backend(conn)
+    if backend in _AUX_READY:
+        return
+    with _AUX_LOCK:
+        if backend in _AUX_READY:
+            return
         with closing(conn.cursor()) as cur:
-            cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name")
-            return [r[0] for r in cur.fetchall()]
+            if backend == "pg":
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (_AUX_PG_LOCK_KEY,))
+            for ddl, _ in _AUX_SCHEMA:
+                for stmt in ddl[backend]:
+                    cur.execute(stmt)
+        invalidate_schema(backend)
+        for _, bootstrap in _AUX_SCHEMA:
+            if bootstrap:
+                bootstrap(conn)
+        conn.commit()
+        _AUX_READY.add(backend)
+
+_CHANGE_LISTENERS: List[Any] = []
+
+def on_data_change(fn):
+    """Декоратор: fn(conn, table, device_ids) вызывается при каждом изменении данных."""
+    _CHANGE_LISTENERS.append(fn)
+    return fn
+
+def notify_data_change(conn, table_name: str, device_ids: Optional[List[int]] = None):
+    """
+    Сообщить проекциям и кэшам, что в таблице изменились данные.
+    Вызывается в той же транзакции, что и сама запись. device_ids=None — «не знаем, какие».
+    table_name='devices' с id означает, что устройство изменилось целиком (вместе с доп.
+    характеристиками и предложениями) — так сообщают о создании и удалении устройства.
+    Для справочника device_ids — устройства, которые ссылаются на изменённые строки
+    (referencing_device_ids); новая строка справочника — [], на неё ещё никто не ссылается.
+    """
+    for fn in _CHANGE_LISTENERS:
+        fn(conn, table_name.lower(), device_ids)
+
+def after_commit(conn, fn):
+    """
+    fn() после commit транзакции conn — так хуки сбрасывают кэши процесса: сброшенное
+    до commit параллельный запрос успел бы заново наполнить старыми строками.
+    При откате fn не вызывается; у соединения не из пула fn() выполняется сразу.
+    """
+    hook = getattr(conn, 'after_commit', None)
+    if hook is None:
+        fn()
     else:
-        sql = """
-        SELECT table_name
-        FROM information_schema.tables
-        WHERE table_schema = 'public' AND table_type = 'BASE TABLE'
-        ORDER BY table_name;
-        """
-        with closing(conn.cursor()) as cur:
+        hook(fn)
+
+# -------------------------------------------------
+# Справочники для форм: кэш
+# -------------------------------------------------
+# Отсортированные списки справочников для форм, по одному на бэкенд. Сбрасываются
+# хуками изменения данных после commit (чтение, начатое до сброса, в кэш не попадает);
+# REFERENCE_CACHE_TTL ограничивает отставание от изменений, сделанных другими процессами.
+REFERENCE_CACHE_TTL = env_int("REFERENCE_CACHE_TTL", 300)
+
+def _sort_os(rows):
+    return sorted(rows, key=lambda r: (str(r[1]).strip().casefold(), r[2]))
+
+def _first_column(rows):
+    return [row[0] for row in rows if row[0]]
+
+# имя списка (= имя переменной в шаблоне) -> (запрос, таблицы-источники, сортировка)
+REFERENCE_SETS: Dict[str, Tuple[str, set, Any]] = {
+    'manufacturers':     ("SELECT manufacturer_id, name FROM manufacturers", {'manufacturers'}, _sort_ci_tuples),
+    'categories':        ("SELECT category_id, name FROM categories", {'categories'}, _sort_ci_tuples),
+    'operating_systems': ("""SELECT osys.os_id, osn.name, osys.latest_version
+                             FROM operating_systems osys
+                             JOIN os_name osn ON osys.os_name_id = osn.os_name_id""",
+                          {'operating_systems', 'os_name'}, _sort_os),
+    'models':            ("SELECT model_id, name FROM model", {'model'}, _sort_ci_tuples),
+    'colors':            ("SELECT color_id, name FROM color", {'color'}, _sort_ci_tuples),
+    'proc_models':       ("SELECT proc_model_id, name FROM proc_model", {'proc_model'}, _sort_ci_tuples),
+    'storage_types':     ("SELECT storage_type_id, name FROM storage_type", {'storage_type'}, _sort_ci_tuples),
+    'techn_matrices':    ("SELECT techn_matr_id, name FROM techn_matr", {'techn_matr'}, _sort_ci_tuples),
+    'retailers':         ("SELECT retailer_id, name FROM retailers", {'retailers'}, _sort_ci_tuples),
+    'countries':         ("SELECT country_id, name FROM country", {'country'}, _sort_ci_tuples),
+    'os_names':          ("SELECT os_name_id, name FROM os_name", {'os_name'}, _sort_ci_tuples),
+    # камеры добавляются и вместе с устройством (notify 'devices')
+    'aperture_main':     ("""SELECT aperture_main
+                             FROM cameras
+                             WHERE aperture_main IS NOT NULL
+                             GROUP BY aperture_main
+                             ORDER BY LOWER(aperture_main)""",
+                          {'cameras', 'devices'}, _first_column),
+}
+
+_REF_CACHE: Dict[Tuple[str, str], Tuple[Any, float, int]] = {}   # (backend, имя) -> (список, когда, поколение)
+_REF_INVALIDATIONS: Dict[Tuple[str, str], int] = {}
+_REF_LOCK = threading.Lock()
+_REF_GENERATION = [0]
+_REF_BOOT = uuid.uuid4().hex[:8]
+
+def reference_data(names: List[str], conn=None) -> Dict[str, Any]:
+    """
+    Справочники по именам из REFERENCE_SETS. Если всё в кэше, к БД не обращаемся;
+    conn — уже открытое соединение, иначе берём своё из пула.
+    """
+    backend = _conn_backend(conn) if conn is not None else current_backend()
+    now = time.monotonic()
+    result: Dict[str, Any] = {}
+    missing = []
+    for name in names:
+        hit = _REF_CACHE.get((backend, name))
+        if hit is not None and (not REFERENCE_CACHE_TTL or now - hit[1] < REFERENCE_CACHE_TTL):
+            result[name] = hit[0]
+        else:
+            missing.append(name)
+    if not missing:
+        return result
+
+    with (nullcontext(conn) if conn is not None else get_conn(backend)) as c:
+        cur = tup_cur(c)
+        for name in missing:
+            sql, _, prepare = REFERENCE_SETS[name]
+            seen = _REF_INVALIDATIONS.get((backend, name), 0)
             cur.execute(sql)
-            return [r[0] for r in cur.fetchall()]
+            value = prepare(cur.fetchall())
+            with _REF_LOCK:
+                # сброс во время чтения — не кэшируем, возможно, уже устаревший список
+                if _REF_INVALIDATIONS.get((backend, name), 0) == seen:
+                    _REF_GENERATION[0] += 1
+                    _REF_CACHE[(backend, name)] = (value, now, _REF_GENERATION[0])
+            result[name] = value
+    return result
+
+def invalidate_reference(backend: str, tables: set):
+    with _REF_LOCK:
+        for name, (_, sources, _) in REFERENCE_SETS.items():
+            if sources & tables:
+                key = (backend, name)
+                _REF_CACHE.pop(key, None)
+                _REF_INVALIDATIONS[key] = _REF_INVALIDATIONS.get(key, 0) + 1
+
+@on_data_change
+def _reference_on_change(conn, table_name, device_ids):
+    backend = _conn_backend(conn)
+    after_commit(conn, lambda: invalidate_reference(backend, {table_name}))
+
+def reference_etag(names: List[str], *extra) -> Optional[str]:
+    """
+    ETag страницы-формы: поколения её справочников + всё, от чего ещё зависит HTML
+    (бэкенд, пользователь, адрес, прочие аргументы). None — что-то не в кэше.
+    """
+    backend = current_backend()
+    parts = [_REF_BOOT, backend, request.full_path,
+             str(current_user.get_id() if current_user.is_authenticated else ''),
+             str(getattr(current_user, 'is_admin', False))]
+    for name in names:
+        hit = _REF_CACHE.get((backend, name))
+        if hit is None:
+            return None
+        parts.append(f"{name}:{hit[2]}")
+    parts.extend(str(x) for x in extra)
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()[:20]
 
-def count_columns(conn, table_name: str) -> int:
-    """Количество столбцов (SQLite/PG)."""
-    if _is_sqlite_conn(conn):
-        with closing(conn.cursor()) as cur:
-            cur.execute(f"PRAGMA table_info({table_name})")
-            return len(cur.fetchall())
+def render_reference_form(template: str, names: List[str], **context):
+    """
+    render_template для GET формы со справочниками: данные из кэша, ETag по их версиям;
+    повторный запрос с тем же If-None-Match получает 304 без рендера и без БД.
+    """
+    refs = reference_data(names)
+    etag = reference_etag(names, *sorted(context.items()))
+    if etag is None or session.get('_flashes'):
+        return render_template(template, **refs, **context)
+    if etag in request.if_none_match:
+        resp = Response(status=304)
     else:
-        sql = """
-        SELECT COUNT(*)
-        FROM information_schema.columns
-        WHERE table_schema = 'public' AND table_name = %s;
-        """
-        with closing(conn.cursor()) as cur:
-            cur.execute(sql, (table_name,))
-            return cur.fetchone()[0] or 0
+        resp = make_response(render_template(template, **refs, **context))
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
 
-def columns_for_table(conn, table_name: str) -> List[str]:
-    if current_backend() == "pg":
-        with conn.cursor() as c:
-            c.execute("""
-                SELECT column_name
-                FROM information_schema.columns
-                WHERE table_schema='public' AND table_name=%s
-                ORDER BY ordinal_position
-            """, (table_name,))
-            return [r[0] for r in c.fetchall()]
-    else:
-        c = conn.cursor()
-        c.execute(f"PRAGMA table_info({table_name})")
-        return [r[1] for r in c.fetchall()]
 # -------------------------------------------------
 # Ограничения удаления
 # -------------------------------------------------
@@ -285,6 +978,26 @@ def value_in_use(conn, table_name: str, pk_value: str) -> Tuple[bool, str]:
             if cur.fetchone():
                 return (True, f"{ref_table}.{ref_col}")
     return (False, '')
+
+def referencing_device_ids(conn, table_name: str, pk_value) -> Optional[List[int]]:
+    """
+    Устройства, ссылающиеся на строку справочника — напрямую или через другой справочник
+    (страна — через производителя). None — таблица не из REFERENCE_MAP.
+    """
+    refs = REFERENCE_MAP.get(table_name)
+    if refs is None:
+        return None
+    found: set = set()
+    cur = tup_cur(conn)
+    for ref_table, ref_col in refs:
+        if ref_table in REFERENCE_MAP:
+            cur.execute(f"SELECT {get_pk_name(conn, ref_table)} FROM {ref_table} WHERE {ref_col} = %s", (pk_value,))
+            for (child,) in cur.fetchall():
+                found.update(referencing_device_ids(conn, ref_table, child))
+        else:
+            cur.execute(f"SELECT device_id FROM {ref_table} WHERE {ref_col} = %s", (pk_value,))
+            found.update(int(row[0]) for row in cur.fetchall())
+    return sorted(found)
 # -------------------------------------------------
 # Аутентификация
 # -------------------------------------------------
@@ -376,6 +1089,133 @@ def profile():
     devices = [{'device_id': r[0], 'model': r[1], 'manufacturer': r[2], 'category': r[3], 'current_price': r[4]} for r in rows]
     return render_template('profile.html', user=current_user, devices=devices)
 
+# -------------------------------------------------
+# Размеры таблиц
+# -------------------------------------------------
+TABLE_PURPOSE = {
+    'devices': 'главная',
+    'categories': 'справочник',
+    'manufacturers': 'справочник',
+    'retailers': 'справочник',
+    'color': 'справочник',
+    'country': 'справочник',
+    'os_name': 'справочник',
+    'proc_model': 'справочник',
+    'storage_type': 'справочник',
+    'techn_matr': 'справочник',
+    'model' : 'справочник',
+    'device_retailers': 'дополнительная',
+    'batteries': 'дополнительная',
+    'cameras': 'дополнительная',
+    'displays': 'дополнительная',
+    'specifications': 'дополнительная',
+    'operating_systems': 'дополнительная',
+    'users': 'дополнительная'
+}
+TABLE_RUS_DESC = {
+    'batteries': 'Характеристики батареи',
+    'cameras': 'Характеристики камер',
+    'categories': 'Справочник категорий',
+    'color': 'Справочник цветов',
+    'country': 'Справочник стран',
+    'device_retailers': 'Цены/наличие у продавцов',
+    'devices': 'Устройства (основная)',
+    'displays': 'Характеристики дисплея',
+    'manufacturers': 'Справочник производителей',
+    'operating_systems': 'Версии ОС для устройств',
+    'os_name': 'Справочник названий ОС',
+    'proc_model': 'Модели процессоров',
+    'retailers': 'Справочник продавцов',
+    'specifications': 'Прочие характеристики',
+    'storage_type': 'Типы накопителей',
+    'techn_matr': 'Типы матрицы дисплея',
+    'model' : 'Справочник моделей устройств',
+    'users': 'Пользователи системы'
+}
+TABLE_PURPOSE_ORDER = {'главная': 0, 'справочник': 1, 'дополнительная': 2}
+
+# SQLite: точные счётчики строк, которые ведут триггеры AFTER INSERT/DELETE.
+# PostgreSQL: оценки планировщика (pg_stat_user_tables.n_live_tup / pg_class.reltuples).
+_ROWCOUNT_SQL_PG = """
+    SELECT c.relname,
+           CASE WHEN s.n_live_tup IS NOT NULL AND (s.n_live_tup > 0 OR c.reltuples <= 0)
+                THEN s.n_live_tup
+                ELSE GREATEST(c.reltuples, 0)::bigint END
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p')
+"""
+
+def _rowcount_bootstrap(conn):
+    """Вешает триггеры-счётчики на пользовательские таблицы SQLite, у которых их ещё нет."""
+    if not _is_sqlite_conn(conn):
+        return
+    raw = getattr(conn, "raw", conn)
+    with closing(conn.cursor()) as cur:
+        cur.execute("SELECT table_name FROM table_row_counts")
+        done = {r[0] for r in cur.fetchall()}
+        todo = [t for t in list_user_tables(conn) if t not in done]
+        if not todo:
+            return
+        if not raw.in_transaction:
+            cur.execute("BEGIN IMMEDIATE")   # чтобы между COUNT(*) и триггером не вклинилась запись
+        for t in todo:
+            cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_rowcount_{t}_ins AFTER INSERT ON {t}
+                BEGIN UPDATE table_row_counts SET row_count = row_count + 1 WHERE table_name = '{t}'; END
+            """)
+            cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_rowcount_{t}_del AFTER DELETE ON {t}
+                BEGIN UPDATE table_row_counts SET row_count = row_count - 1 WHERE table_name = '{t}'; END
+            """)
+            cur.execute(f"INSERT OR REPLACE INTO table_row_counts (table_name, row_count) "
+                        f"SELECT '{t}', COUNT(*) FROM {t}")
+
+register_aux_schema(
+    ['table_row_counts'],
+    [],
+    ["CREATE TABLE IF NOT EXISTS table_row_counts (table_name text PRIMARY KEY, row_count integer NOT NULL)"],
+    bootstrap=_rowcount_bootstrap,
+)
+
+def table_row_counts(conn, tables: List[str], exact: bool = False) -> Dict[str, int]:
+    """
+    Число строк по таблицам. По умолчанию без сканирования таблиц:
+    SQLite — счётчики table_row_counts, PostgreSQL — оценка из статистики.
+    exact=True (или таблицы без счётчика) — COUNT(*) одним запросом.
+    """
+    if not tables:
+        return {}
+    cur = tup_cur(conn)
+    result: Dict[str, int] = {}
+    if not exact:
+        if _is_sqlite_conn(conn):
+            cur.execute("SELECT table_name, row_count FROM table_row_counts")
+        else:
+            cur.execute(_ROWCOUNT_SQL_PG)
+        known = {name: int(cnt) for name, cnt in cur.fetchall() if cnt is not None}
+        result = {t: known[t] for t in tables if t in known}
+    missing = [t for t in tables if t not in result]
+    if missing:
+        cur.execute(" UNION ALL ".join(f"SELECT '{t}', COUNT(*) FROM {t}" for t in missing))
+        result.update({name: int(cnt or 0) for name, cnt in cur.fetchall()})
+    return result
+
+def tables_info_for(conn, exact: bool = False) -> List[Dict[str, Any]]:
+    """Список таблиц с назначением, числом строк и столбцов — для главной и статистики."""
+    table_names = list_user_tables(conn)
+    counts = table_row_counts(conn, table_names, exact=exact)
+    tables_info = [{
+        'name': name,
+        'rus': TABLE_RUS_DESC.get(name, '—'),
+        'purpose': TABLE_PURPOSE.get(name, 'дополнительная'),
+        'rows': counts.get(name, 0),
+        'columns': count_columns(conn, name),
+    } for name in table_names]
+    tables_info.sort(key=lambda x: (TABLE_PURPOSE_ORDER.get(x['purpose'], 99), x['name']))
+    return tables_info
+
 # -------------------------------------------------
 # Главная
 # -------------------------------------------------
@@ -384,117 +1224,28 @@ def index():
     mode = request.form.get('mode') if request.method == 'POST' else None
     info_by = request.form.get('info_by', 'retailer') if mode == 'info' else None
     info_results = None
-
-    purpose_map = {
-        'devices': 'главная',
-        'categories': 'справочник',
-        'manufacturers': 'справочник',
-        'retailers': 'справочник',
-        'color': 'справочник',
-        'models': 'справочник',
-        'country': 'справочник',
-        'os_name': 'справочник',
-        'proc_model': 'справочник',
-        'storage_type': 'справочник',
-        'techn_matr': 'справочник',
-        'device_retailers': 'дополнительная',
-        'batteries': 'дополнительная',
-        'cameras': 'дополнительная',
-        'displays': 'дополнительная',
-        'specifications': 'дополнительная',
-        'operating_systems': 'дополнительная',
-        'users': 'дополнительная'
-    }
-    rus_desc = {
-        'batteries': 'Характеристики батареи',
-        'cameras': 'Характеристики камер',
-        'categories': 'Справочник категорий',
-        'color': 'Справочник цветов',
-        'country': 'Справочник стран',
-        'device_retailers': 'Цены/наличие у продавцов',
-        'devices': 'Устройства (основная)',
-        'displays': 'Характеристики дисплея',
-        'manufacturers': 'Справочник производителей',
-        'models': 'Справочник моделей',
-        'operating_systems': 'Версии ОС для устройств',
-        'os_name': 'Справочник названий ОС',
-        'proc_model': 'Модели процессоров',
-        'retailers': 'Справочник продавцов',
-        'specifications': 'Прочие характеристики',
-        'storage_type': 'Типы накопителей',
-        'techn_matr': 'Типы матрицы дисплея',
-        'users': 'Пользователи системы'
-    }
+    # точные COUNT(*) — только по запросу администратора, иначе счётчики/оценки
+    exact = bool(request.args.get('exact')) and current_user.is_authenticated and getattr(current_user, 'is_admin', False)
 
     with get_conn() as conn:
-        cur = tup_cur(conn)
-
-        totals = {}
-        for t in ['devices','categories','manufacturers','retailers','color','country','os_name']:
-            try:
-                cur.execute(f"SELECT COUNT(*) FROM {t}")
-                totals[t] = cur.fetchone()[0]
-            except Exception:
-                totals[t] = 0
-
-        cur.execute("SELECT MIN(current_price), AVG(current_price), MAX(current_price) FROM devices")
-        price_min, price_avg, price_max = cur.fetchone()
-        price_min = int(price_min or 0)
-        price_avg = int(price_avg or 0)
-        price_max = int(price_max or 0)
-
-        cur.execute("SELECT MIN(release_date), MAX(release_date) FROM devices")
-        release_min, release_max = cur.fetchone()
-
-        try:
-            cur.execute("SELECT MAX(last_updated) FROM device_retailers")
-            last_update = cur.fetchone()[0]
-        except:
-            last_update = None
-
-        cur.execute("SELECT COUNT(DISTINCT device_id) FROM device_retailers WHERE in_stock = %s", (True,))
-        in_stock_devices = cur.fetchone()[0] or 0
-        cur.execute("SELECT COUNT(*) FROM device_retailers")
-        offers_total = cur.fetchone()[0] or 0
-
-        table_names = list_user_tables(conn)
-        tables_info = []
-        for name in table_names:
-            try:
-                cur.execute(f"SELECT COUNT(*) FROM {name}")
-                rows = cur.fetchone()[0] or 0
-            except Exception:
-                rows = 0
-            cols = count_columns(conn, name)
-            tables_info.append({
-                'name': name,
-                'rus': rus_desc.get(name, '—'),
-                'purpose': purpose_map.get(name, 'дополнительная'),
-                'rows': rows,
-                'columns': cols
-            })
-        order = {'главная': 0, 'справочник': 1, 'дополнительная': 2}
-        tables_info.sort(key=lambda x: (order.get(x['purpose'], 99), x['name']))
+        tables_info = tables_info_for(conn, exact=exact)
+        rows_by_table = {t['name']: t['rows'] for t in tables_info}
+        totals = {t: rows_by_table.get(t, 0)
+                  for t in ['devices','categories','manufacturers','retailers','color','country','os_name']}
+        offers_total = rows_by_table.get('device_retailers', 0)
+
+        stats = load_statistic_snapshot(conn)
+        price_min = stats['min_price']
+        price_avg = stats['avg_price']
+        price_max = stats['max_price']
+        release_min, release_max = stats['release_min'], stats['release_max']
+        last_update = stats['last_update']
+        in_stock_devices = stats['in_stock_devices']
 
         if mode == 'info':
-            if info_by == 'retailer':
-                cur.execute("""
-                    SELECT r.name, COUNT(DISTINCT dr.device_id)
-                    FROM device_retailers dr
-                    JOIN retailers r ON dr.retailer_id = r.retailer_id
-                    GROUP BY r.name
-                    ORDER BY COUNT(DISTINCT dr.device_id) DESC
-                """)
-            else:
-                cur.execute("""
-                    SELECT co.name, COUNT(DISTINCT d.device_id)
-                    FROM devices d
-                    JOIN manufacturers m ON d.manufacturer_id = m.manufacturer_id
-                    JOIN country co ON m.country_id = co.country_id
-                    GROUP BY co.name
-                    ORDER BY COUNT(DISTINCT d.device_id) DESC
-                """)
-            info_results = cur.fetchall()
+            # число устройств по продавцу / стране уже есть в сводке статистики
+            info_by = 'retailer' if info_by == 'retailer' else 'country'
+            info_results = [(r[0], r[1]) for r in stats['breakdowns'][info_by]]
 
     return render_template(
         'index.html',
@@ -517,360 +1268,1924 @@ def index():
     )
 
 # -------------------------------------------------
-# CRUD устройств и таблиц
+# Добавление устройства: проверка формы и запись одной транзакцией
 # -------------------------------------------------
-@app.route('/add_device', methods=['GET', 'POST'])
-@login_required
-@admin_required
-def add_device():
-    min_date = '1990-01-01'
-    today = _Date.today().isoformat()
+class PhaseTimer:
+    """Время по фазам обработки запроса, отдаётся в заголовке Server-Timing."""
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + (time.perf_counter() - t0) * 1000.0
+
+    def header(self) -> str:
+        return ", ".join(f"{k};dur={v:.1f}" for k, v in self.phases.items())
+
+DEVICE_EXTRA_PKS = {
+    'devices': 'device_id',
+    'specifications': 'spec_id',
+    'displays': 'display_id',
+    'cameras': 'camera_id',
+    'batteries': 'battery_id',
+    'device_retailers': 'device_retailer_id',
+}
 
-    # для формы: и базовые списки, и словари для "доп. характеристик"
-    with get_conn() as conn:
-        cur = tup_cur(conn)
-        cur.execute("SELECT manufacturer_id, name FROM manufacturers")
-        manufacturers = _sort_ci_tuples(cur.fetchall())
-        cur.execute("SELECT category_id, name FROM categories")
-        categories = _sort_ci_tuples(cur.fetchall())
-        cur.execute("""
-            SELECT osys.os_id, osn.name, osys.latest_version
-            FROM operating_systems osys
-            JOIN os_name osn ON osys.os_name_id = osn.os_name_id
-        """)
-        operating_systems = sorted(cur.fetchall(), key=lambda r: (str(r[1]).strip().casefold(), r[2]))
-        cur.execute("SELECT model_id, name FROM model")
-        models = _sort_ci_tuples(cur.fetchall())
-        cur.execute("SELECT color_id, name FROM color")
-        colors = _sort_ci_tuples(cur.fetchall())
-
-        # справочники для доп. форм (как в edit_extras)
-        cur.execute("SELECT proc_model_id, name FROM proc_model")
-        proc_models = _sort_ci_tuples(cur.fetchall())
-        cur.execute("SELECT storage_type_id, name FROM storage_type")
-        storage_types = _sort_ci_tuples(cur.fetchall())
-        cur.execute("SELECT techn_matr_id, name FROM techn_matr")
-        techn_matrices = _sort_ci_tuples(cur.fetchall())
-        cur.execute("SELECT retailer_id, name FROM retailers")
-        retailers = _sort_ci_tuples(cur.fetchall())
-        cur.execute("""
-            SELECT aperture_main
-            FROM cameras
-            WHERE aperture_main IS NOT NULL
-            GROUP BY aperture_main
-            ORDER BY LOWER(aperture_main)
-        """)
-        aperture_main = [row[0] for row in cur.fetchall() if row[0]]
+def _form_has_any(form, names) -> bool:
+    for n in names:
+        v = form.get(n)
+        if v is None:
+            continue
+        if n in ('has_ai_enhance', 'wireless_charging'):
+            if v:
+                return True
+        elif str(v).strip() != '':
+            return True
+    return False
+
+def parse_device_form(form, today: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Проверяет всю форму add_device до записи.
+    Возвращает (план записи, None) или (None, текст ошибки).
+    План: {'devices': {...}, 'specifications': {...}|None, 'displays': ..., 'cameras': ...,
+           'batteries': ..., 'device_retailers': ...}
+    """
+    try:
+        current_price   = int(float(form.get('current_price') or 0))
+        weight_grams    = int(float(form.get('weight_grams') or 0))
+        warranty_months = int(float(form.get('warranty_months') or 0))
+    except ValueError:
+        return None, "Поля цена/вес/гарантия должны быть целыми числами."
+
+    plan: Dict[str, Any] = {
+        'devices': {
+            'manufacturer_id': form.get('manufacturer_id'),
+            'category_id':     form.get('category_id'),
+            'os_id':           form.get('os_id'),
+            'model_id':        form.get('model_id'),
+            'release_date':    form.get('release_date'),
+            'current_price':   current_price,
+            'weight_grams':    weight_grams,
+            'color_id':        form.get('color_id'),
+            'is_waterproof':   form.get('is_waterproof') == 'on',
+            'warranty_months': warranty_months,
+        },
+        'specifications': None, 'displays': None, 'cameras': None,
+        'batteries': None, 'device_retailers': None,
+    }
 
-    if request.method == 'POST':
-        # --- Базовые поля устройства ---
-        manufacturer_id = request.form.get('manufacturer_id')
-        category_id     = request.form.get('category_id')
-        os_id           = request.form.get('os_id')
-        model_id        = request.form.get('model_id')
-        color_id        = request.form.get('color_id')
-        release_date    = request.form.get('release_date')
+    # --- specifications ---
+    if _form_has_any(form, ['proc_model_id', 'processor_cores', 'ram_gb', 'storage_gb', 'storage_type_id']):
+        data: Dict[str, Any] = {}
+        for name in ('proc_model_id', 'storage_type_id'):
+            val = form.get(name)
+            if not val:
+                continue
+            try:
+                data[name] = int(val)
+            except ValueError:
+                return None, f'{name}: ожидается id из справочника'
+        for name, lo, hi in (('processor_cores', 1, 20), ('ram_gb', 1, 32), ('storage_gb', 1, 2048)):
+            val = form.get(name)
+            if not val:
+                continue
+            try:
+                iv = int(val)
+                if not (lo <= iv <= hi): raise ValueError
+            except ValueError:
+                return None, f'{name}: {lo}-{hi}'
+            data[name] = iv
+        plan['specifications'] = data
+
+    # --- displays ---
+    if _form_has_any(form, ['diagonal_inches', 'resolution', 'techn_matr_id', 'refresh_rate_hz', 'brightness_nits']):
+        try:
+            diagonal_inches = form.get('diagonal_inches')
+            diagonal_inches = float(diagonal_inches) if diagonal_inches else None
+            if diagonal_inches is not None and not (1.0 <= diagonal_inches <= 100.0): raise ValueError
+            techn_matr_id = int(form.get('techn_matr_id')) if form.get('techn_matr_id') else None
+            rr = form.get('refresh_rate_hz')
+            refresh_rate_hz = int(rr) if rr else None
+            if refresh_rate_hz is not None and not (1 <= refresh_rate_hz <= 360): raise ValueError
+            bn = form.get('brightness_nits')
+            brightness_nits = int(bn) if bn else None
+            if brightness_nits is not None and not (1 <= brightness_nits <= 10000): raise ValueError
+        except ValueError:
+            return None, 'Проверьте поля дисплея (диапазоны/формат).'
+        plan['displays'] = {
+            'diagonal_inches': diagonal_inches, 'resolution': form.get('resolution') or None,
+            'techn_matr_id': techn_matr_id, 'refresh_rate_hz': refresh_rate_hz,
+            'brightness_nits': brightness_nits,
+        }
 
+    # --- cameras ---
+    if _form_has_any(form, ['megapixels_main', 'aperture_main', 'optical_zoom_x', 'video_resolution', 'has_ai_enhance']):
         try:
-            current_price  = int(float(request.form.get('current_price') or 0))
-            weight_grams   = int(float(request.form.get('weight_grams') or 0))
-            warranty_months = int(float(request.form.get('warranty_months') or 0))
+            mp = form.get('megapixels_main')
+            megapixels_main = float(mp) if mp else None
+            if megapixels_main is not None and not (2.0 <= megapixels_main <= 200.0): raise ValueError
+            aperture_main = (form.get('aperture_main') or '').strip() or None
+            if aperture_main is not None and not (3 <= len(aperture_main) <= 6): raise ValueError
+            oz = form.get('optical_zoom_x')
+            optical_zoom_x = float(oz) if oz else None
+            if optical_zoom_x is not None and not (0.0 <= optical_zoom_x <= 144.0): raise ValueError
+            vr = form.get('video_resolution')
+            video_resolution = vr.strip() if vr else None
+            if video_resolution is not None and not (7 <= len(video_resolution) <= 11): raise ValueError
         except ValueError:
-            flash("Поля цена/вес/гарантия должны быть целыми числами.", "danger")
-            return redirect(request.url)
+            return None, 'Проверьте поля камеры (диапазоны/формат).'
+        plan['cameras'] = {
+            'megapixels_main': megapixels_main, 'aperture_main': aperture_main,
+            'optical_zoom_x': optical_zoom_x, 'video_resolution': video_resolution,
+            'has_ai_enhance': bool(form.get('has_ai_enhance')),
+        }
 
-        is_waterproof   = True if request.form.get('is_waterproof') == 'on' else False
+    # --- batteries ---
+    if _form_has_any(form, ['capacity_mah', 'fast_charging_w', 'wireless_charging', 'estimated_life_hours']):
+        try:
+            cm = form.get('capacity_mah')
+            capacity_mah = int(cm) if cm else None
+            if capacity_mah is not None and not (1 <= capacity_mah <= 20000): raise ValueError
+            fc = form.get('fast_charging_w')
+            fast_charging_w = float(fc) if fc else None
+            if fast_charging_w is not None and not (0.0 <= fast_charging_w <= 20.0): raise ValueError
+            elh = form.get('estimated_life_hours')
+            estimated_life_hours = float(elh) if elh else None
+            if estimated_life_hours is not None and not (0.0 <= estimated_life_hours <= 96.0): raise ValueError
+        except ValueError:
+            return None, 'Проверьте поля батареи (диапазоны).'
+        plan['batteries'] = {
+            'capacity_mah': capacity_mah, 'fast_charging_w': fast_charging_w,
+            'wireless_charging': bool(form.get('wireless_charging')),
+            'estimated_life_hours': estimated_life_hours,
+        }
 
-        # --- Создаём устройство ---
-        with get_conn() as conn:
-            cur = tup_cur(conn)
-            new_id, _ = next_id(conn, 'devices')
-            if current_backend() == "pg":
-                cur.execute("""
-                    INSERT INTO devices
-                        (device_id, manufacturer_id, category_id, os_id, model_id, release_date,
-                         current_price, weight_grams, color_id, is_waterproof, warranty_months, created_by)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                    RETURNING device_id
-                """, (new_id, manufacturer_id, category_id, os_id, model_id, release_date,
-                      current_price, weight_grams, color_id, is_waterproof, warranty_months, current_user.id))
-                device_id = cur.fetchone()[0]
+    # --- опционально сразу одно предложение продавца ---
+    if _form_has_any(form, ['retailer_id', 'site_price', 'in_stock', 'last_updated']):
+        retailer_id  = form.get('retailer_id')
+        site_price   = form.get('site_price')
+        last_updated = form.get('last_updated') or today
+        try:
+            price_val = float(site_price) if site_price else None
+            if price_val is not None and not (0.0 <= price_val <= 1_000_000.0): raise ValueError
+            _DT.strptime(last_updated, "%Y-%m-%d")
+        except ValueError:
+            return None, 'Проверьте цену продавца (0–1 000 000) и дату (YYYY-MM-DD).'
+        if retailer_id and site_price:
+            plan['device_retailers'] = {
+                'retailer_id': retailer_id, 'price': price_val,
+                'in_stock': form.get('in_stock') == 'on', 'last_updated': last_updated,
+            }
+
+    return plan, None
+
+def insert_device_bundle(conn, plan: Dict[str, Any], created_by, timer: Optional[PhaseTimer] = None) -> int:
+    """
+    Пишет устройство и все его доп. характеристики на одном соединении.
+    Коммит делает вызывающий (выход из `with get_conn()`), так что при ошибке
+    не остаётся «половины» устройства.
+    """
+    timer = timer or PhaseTimer()
+    with timer.phase('insert'):
+        device_id = insert_returning_id(conn, 'devices', dict(plan['devices'], created_by=created_by),
+                                        DEVICE_EXTRA_PKS['devices'])
+        for t, pk in DEVICE_EXTRA_PKS.items():
+            if t != 'devices' and plan.get(t):
+                insert_returning_id(conn, t, dict(plan[t], device_id=device_id), pk)
+        if plan.get('device_retailers'):
+            record_price_history(conn, [dict(plan['device_retailers'], device_id=device_id)])
+    with timer.phase('projections'):
+        notify_data_change(conn, 'devices', [device_id])
+    return device_id
+
+# -------------------------------------------------
+# Массовая загрузка устройств (CSV / NDJSON)
+# -------------------------------------------------
+# Строка файла — то же, что форма add_device, только справочники можно указывать
+# названиями (manufacturer, model, ...) вместо id. Названия переводятся в id по
+# словарям в памяти, строки проверяются parse_device_form и пишутся пачками:
+# PG — COPY, SQLite — executemany, одна транзакция на пачку.
+IMPORT_BATCH_SIZE = env_int("IMPORT_BATCH_SIZE", 1000)
+
+# столбец с названием -> (поле формы add_device, справочник из REFERENCE_SETS)
+IMPORT_NAME_FIELDS = {
+    'manufacturer': ('manufacturer_id', 'manufacturers'),
+    'category':     ('category_id', 'categories'),
+    'model':        ('model_id', 'models'),
+    'color':        ('color_id', 'colors'),
+    'os':           ('os_id', 'operating_systems'),
+    'proc_model':   ('proc_model_id', 'proc_models'),
+    'storage_type': ('storage_type_id', 'storage_types'),
+    'techn_matr':   ('techn_matr_id', 'techn_matrices'),
+    'retailer':     ('retailer_id', 'retailers'),
+}
+IMPORT_REQUIRED = ('manufacturer_id', 'category_id', 'model_id')
+IMPORT_FLAG_FIELDS = ('is_waterproof', 'has_ai_enhance', 'wireless_charging', 'in_stock')
+_IMPORT_TRUTHY = {'1', 'true', 'yes', 'y', 'on', 'да', '+'}
+
+def _import_key(name) -> str:
+    return " ".join(str(name).split()).casefold()
+
+class ImportLookups:
+    """
+    Справочники «название -> id» на время загрузки. Названия сравниваются без учёта
+    регистра и лишних пробелов; ОС — название с версией или просто название,
+    если такая ОС одна. Неоднозначное название хранится как None.
+    """
+    def __init__(self, conn, create_models: bool = False):
+        self.create_models = create_models
+        data = reference_data(sorted({ref for _, ref in IMPORT_NAME_FIELDS.values()}), conn)
+        self.maps: Dict[str, Dict[str, Optional[int]]] = {}
+        for column, (_, ref) in IMPORT_NAME_FIELDS.items():
+            names: Dict[str, Optional[int]] = {}
+            if ref == 'operating_systems':
+                for os_id, name, version in data[ref]:
+                    self._add(names, f"{name} {version}", os_id)
+                    if _import_key(version).startswith(_import_key(name)):
+                        self._add(names, version, os_id)   # «Android 14» при версии «Android 14»
+                short: Dict[str, Optional[int]] = {}
+                for os_id, name, _ in data[ref]:
+                    self._add(short, name, os_id)
+                for key, os_id in short.items():
+                    names.setdefault(key, os_id)
             else:
-                cur.execute("""
-                    INSERT INTO devices
-                        (device_id, manufacturer_id, category_id, os_id, model_id, release_date,
-                         current_price, weight_grams, color_id, is_waterproof, warranty_months, created_by)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                """, (new_id, manufacturer_id, category_id, os_id, model_id, release_date,
-                      current_price, weight_grams, color_id, is_waterproof, warranty_months, current_user.id))
-                device_id = new_id
+                for row in data[ref]:
+                    self._add(names, row[1], row[0])
+            self.maps[column] = names
+        self.pending_models: Dict[str, int] = {}   # созданы в текущей пачке, ещё не закоммичены
+
+    @staticmethod
+    def _add(names: Dict[str, Optional[int]], name, value: int):
+        key = _import_key(name)
+        names[key] = value if names.get(key, value) == value else None
+
+    def resolve(self, column: str, name: str) -> Tuple[Optional[int], Optional[str]]:
+        key = _import_key(name)
+        names = self.maps[column]
+        if key not in names:
+            return None, f"{column}: «{name}» нет в справочнике"
+        if names[key] is None:
+            return None, f"{column}: «{name}» неоднозначно" + (" — укажите версию" if column == 'os' else "")
+        return names[key], None
+
+    def model_id(self, conn, name: str) -> int:
+        """id модели для записи; новую модель создаёт в текущей транзакции."""
+        key = _import_key(name)
+        model_id = self.maps['model'].get(key) or self.pending_models.get(key)
+        if model_id is None:
+            model_id = insert_returning_id(conn, 'model', {'name': " ".join(str(name).split())}, 'model_id')
+            self.pending_models[key] = model_id
+        return model_id
+
+    def commit(self):
+        self.maps['model'].update(self.pending_models)
+        self.pending_models = {}
+
+    def rollback(self):
+        self.pending_models = {}
+
+class ImportReport:
+    """Счётчики загрузки; to_dict() — для прогресса и итога."""
+    def __init__(self):
+        self.started = time.monotonic()
+        self.read = 0
+        self.imported = 0
+        self.rejected = 0
+        self.batches = 0
+        self.counters: Dict[str, int] = {}   # свои для каждого вида загрузки: new_models, updated, ...
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self.started
+        return dict({
+            'read': self.read, 'imported': self.imported, 'rejected': self.rejected,
+            'batches': self.batches, 'seconds': round(elapsed, 2),
+            'rows_per_second': round(self.imported / elapsed, 1) if elapsed > 0 else None,
+        }, **self.counters)
+
+def iter_import_records(stream, fmt: Optional[str] = None, name: str = ""):
+    """
+    (номер строки, запись, ошибка) из файла CSV или NDJSON (формат — по fmt,
+    расширению name или первому символу). stream — текстовый или бинарный поток.
+    """
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    first = stream.readline()
+    if fmt is None:
+        lower = name.lower()
+        if lower.endswith((".ndjson", ".jsonl", ".json")):
+            fmt = "ndjson"
+        elif lower.endswith(".csv"):
+            fmt = "csv"
+        else:
+            fmt = "ndjson" if first.lstrip().startswith("{") else "csv"
+
+    if fmt == "ndjson":
+        for line_no, line in enumerate(itertools.chain([first], stream), 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_no, None, f"некорректный JSON: {e}"
+                continue
+            if isinstance(record, dict):
+                yield line_no, record, None
+            else:
+                yield line_no, None, "ожидался объект JSON"
+        return
+
+    # CSV: первая строка — заголовок; разделитель «,» или «;»
+    delimiter = ";" if first.count(";") > first.count(",") else ","
+    columns = [c.strip() for c in next(csv.reader([first], delimiter=delimiter), [])]
+    reader = csv.reader(stream, delimiter=delimiter)
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        if len(row) > len(columns):
+            yield reader.line_num + 1, None, f"лишние значения: {len(row)} при {len(columns)} столбцах"
+            continue
+        yield reader.line_num + 1, dict(zip(columns, row)), None
+
+def import_plan(record: Dict[str, Any], lookups: ImportLookups,
+                today: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """Запись файла -> план insert_device_bundle (как parse_device_form) или текст ошибки."""
+    form: Dict[str, str] = {}
+    for key, value in record.items():
+        if value is None or key is None:
+            continue
+        if isinstance(value, bool):
+            value = 'on' if value else ''
+        value = str(value).strip()
+        if value != '':
+            form[str(key).strip()] = value
+    for flag in IMPORT_FLAG_FIELDS:
+        if flag in form:
+            form[flag] = 'on' if form[flag].casefold() in _IMPORT_TRUTHY else ''
+
+    new_model = None
+    for column, (field, _) in IMPORT_NAME_FIELDS.items():
+        name = form.pop(column, None)
+        if name is None or form.get(field):
+            continue   # явный id важнее названия
+        value, error = lookups.resolve(column, name)
+        if error:
+            if column == 'model' and lookups.create_models and value is None and "нет в справочнике" in error:
+                new_model = name
+                continue
+            return None, error
+        form[field] = str(value)
+    for field in IMPORT_REQUIRED:
+        if not form.get(field) and not (field == 'model_id' and new_model):
+            return None, f"не указано: {field[:-3]}"
+
+    plan, error = parse_device_form(form, today)
+    if plan is not None:
+        plan['new_model'] = new_model
+    return plan, error
+
+def write_import_batch(conn, plans: List[Dict[str, Any]], created_by, lookups: ImportLookups) -> List[int]:
+    """Пачка устройств с доп. характеристиками: id резервируются блоком, строки — bulk_insert."""
+    for plan in plans:
+        if plan.get('new_model'):
+            plan['devices']['model_id'] = lookups.model_id(conn, plan['new_model'])
+    if lookups.pending_models:
+        # у новых моделей ещё нет устройств: проекции обновит notify по device_ids ниже,
+        # а полный notify 'model' пересобирал бы device_search / device_suggest на каждой пачке
+        backend = _conn_backend(conn)
+        after_commit(conn, lambda: invalidate_reference(backend, {'model'}))
+
+    device_ids = reserve_ids(conn, 'devices', DEVICE_EXTRA_PKS['devices'], len(plans))
+    rows: Dict[str, List[Dict[str, Any]]] = {t: [] for t in DEVICE_EXTRA_PKS}
+    for device_id, plan in zip(device_ids, plans):
+        rows['devices'].append(dict(plan['devices'], device_id=device_id, created_by=created_by))
+        for table in DEVICE_EXTRA_PKS:
+            if table != 'devices' and plan.get(table):
+                rows[table].append(dict(plan[table], device_id=device_id))
+    for table, items in rows.items():
+        if not items:
+            continue
+        pk = DEVICE_EXTRA_PKS[table]
+        if table != 'devices':
+            for item, row_id in zip(items, reserve_ids(conn, table, pk, len(items))):
+                item[pk] = row_id
+        bulk_insert(conn, table, items)
+    record_price_history(conn, rows['device_retailers'])
+    notify_data_change(conn, 'devices', device_ids)
+    return device_ids
+
+def run_import(records, backend: str, report: ImportReport, prepare, write,
+               batch_size: int, lookups: Optional[ImportLookups] = None):
+    """
+    Общий цикл загрузки файла; генератор событий ('rejected', line_no, record, error)
+    и ('progress', report) после каждой пачки.
+    prepare(record) -> (элемент, ошибка); write(conn, элементы) -> ({позиция: ошибка}, счётчики) —
+    пачка пишется в одной транзакции, счётчики попадают в report после коммита.
+    Пачка, которую БД не приняла целиком (нарушено ограничение и т.п.), повторяется
+    по одной строке — отклоняются только виноватые.
+    """
+    batch_size = max(1, batch_size)
+
+    def flush(batch) -> List[Tuple[int, Any, str]]:
+        try:
+            with get_conn(backend) as conn:
+                rejected, counters = write(conn, [item for _, _, item in batch])
+        except (psycopg2.Error, sqlite3.Error) as e:
+            if lookups is not None:
+                lookups.rollback()
+            if len(batch) == 1:
+                line_no, record, _ = batch[0]
+                return [(line_no, record, f"БД: {e}")]
+            return [item for one in batch for item in flush([one])]
+        if lookups is not None:
+            lookups.commit()
+        for name, n in counters.items():
+            report.count(name, n)
+        report.imported += len(batch) - len(rejected)
+        return [(batch[pos][0], batch[pos][1], error) for pos, error in sorted(rejected.items())]
+
+    def finish(batch):
+        rejected = flush(batch)
+        report.rejected += len(rejected)
+        report.batches += 1
+        for item in rejected:
+            yield ('rejected',) + item
+        yield ('progress', report)
+
+    batch: List[Tuple[int, Any, Any]] = []
+    for line_no, record, error in records:
+        report.read += 1
+        item = None
+        if error is None:
+            item, error = prepare(record)
+        if error:
+            report.rejected += 1
+            yield ('rejected', line_no, record, error)
+            continue
+        batch.append((line_no, record, item))
+        if len(batch) >= batch_size:
+            yield from finish(batch)
+            batch = []
+    if batch:
+        yield from finish(batch)
+
+def import_devices(records, backend: str, report: ImportReport, created_by=None,
+                   batch_size: int = IMPORT_BATCH_SIZE, create_models: bool = False):
+    """Загрузка устройств из записей iter_import_records(); события — как у run_import."""
+    today = _Date.today().isoformat()
+    with get_conn(backend) as conn:
+        lookups = ImportLookups(conn, create_models)
+    report.count('new_models', 0)
+
+    def write(conn, plans):
+        write_import_batch(conn, plans, created_by, lookups)
+        return {}, {'new_models': len(lookups.pending_models)}
+
+    return run_import(records, backend, report, lambda record: import_plan(record, lookups, today),
+                      write, batch_size, lookups)
+
+# -------------------------------------------------
+# Прайс-листы продавцов: пакетный upsert в device_retailers
+# -------------------------------------------------
+# Строка прайса — device_id, продавец (retailer_id или retailer по названию; для
+# файла одного продавца его можно задать на весь файл), price, in_stock, last_updated.
+# Предложение на пару (устройство, продавец) одно — за этим следит уникальный индекс,
+# запись идёт INSERT ... ON CONFLICT DO UPDATE. Строки, где цена и наличие не
+# изменились, не переписываются (и last_updated у них остаётся прежним): ежедневный
+# прайс обычно почти весь совпадает со вчерашним.
+PRICE_FEED_BATCH_SIZE = env_int("PRICE_FEED_BATCH_SIZE", 5000)
+PRICE_FEED_FIELDS = ('device_id', 'retailer_id', 'retailer', 'price', 'in_stock', 'last_updated')
+OFFER_UNIQUE_INDEX = "ux_device_retailers_device_retailer"
+_OFFER_UNIQUE_ON = "device_retailers (device_id, retailer_id)"
+_OFFER_COLUMNS = ('device_id', 'retailer_id', 'price', 'in_stock', 'last_updated')
+
+_OFFER_UNIQUE_MISSING: set = set()   # бэкенды без уникального индекса: запись предложений выключена
+
+def _offer_unique_exists(conn) -> bool:
+    cur = tup_cur(conn)
+    if _is_sqlite_conn(conn):
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = %s", (OFFER_UNIQUE_INDEX,))
+    else:
+        # прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс — он не считается
+        cur.execute("SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+                    "WHERE c.relname = %s AND i.indisvalid", (OFFER_UNIQUE_INDEX,))
+    return cur.fetchone() is not None
+
+def offer_duplicates(conn) -> int:
+    """Сколько пар (device_id, retailer_id) имеют больше одного предложения."""
+    cur = tup_cur(conn)
+    cur.execute("""
+        SELECT COUNT(*) FROM (
+            SELECT 1 FROM device_retailers GROUP BY device_id, retailer_id HAVING COUNT(*) > 1) dup
+    """)
+    return cur.fetchone()[0]
+
+def _offer_unique_bootstrap(conn):
+    """
+    Есть ли уникальный индекс (device_id, retailer_id). Повторы здесь не удаляются и индекс
+    на живой таблице PostgreSQL не строится — это migrate_offers.py; до него запись
+    предложений выключена. SQLite без повторов получает индекс сразу.
+    """
+    if _offer_unique_exists(conn):
+        return
+    duplicates = offer_duplicates(conn)
+    backend = _conn_backend(conn)
+    if backend == 'sqlite' and not duplicates:
+        tup_cur(conn).execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {OFFER_UNIQUE_INDEX} ON {_OFFER_UNIQUE_ON}")
+        return
+    _OFFER_UNIQUE_MISSING.add(backend)
+    app.logger.warning("device_retailers: нет индекса %s (пар с повторами: %s), запись предложений "
+                       "выключена до python migrate_offers.py --backend %s%s", OFFER_UNIQUE_INDEX,
+                       duplicates, backend, " --dedupe" if duplicates else "")
+
+def require_offer_unique_index(conn):
+    """Без уникального индекса ON CONFLICT не работает — отказ с подсказкой вместо ошибки БД."""
+    backend = _conn_backend(conn)
+    if backend not in _OFFER_UNIQUE_MISSING:
+        return
+    if _offer_unique_exists(conn):
+        _OFFER_UNIQUE_MISSING.discard(backend)
+        return
+    raise RuntimeError(f"device_retailers: нет уникального индекса {OFFER_UNIQUE_INDEX}, "
+                       f"выполните python migrate_offers.py --backend {backend}")
+
+def dedupe_offers(conn) -> int:
+    """
+    Схлопнуть повторы пар в последнее предложение (наибольший device_retailer_id) в
+    транзакции conn; оставшееся попадает в историю цен, проекции получают уведомление.
+    Возвращает число удалённых строк.
+    """
+    cur = tup_cur(conn)
+    cur.execute("""
+        SELECT device_id, retailer_id, price, in_stock FROM device_retailers
+        WHERE device_retailer_id IN (
+            SELECT MAX(device_retailer_id) FROM device_retailers
+            GROUP BY device_id, retailer_id HAVING COUNT(*) > 1)
+    """)
+    kept = [{'device_id': r[0], 'retailer_id': r[1], 'price': r[2], 'in_stock': r[3]} for r in cur.fetchall()]
+    if not kept:
+        return 0
+    cur.execute("""
+        DELETE FROM device_retailers
+        WHERE device_retailer_id NOT IN (
+            SELECT MAX(device_retailer_id) FROM device_retailers GROUP BY device_id, retailer_id)
+    """)
+    removed = cur.rowcount
+    record_price_history(conn, kept)
+    notify_data_change(conn, 'device_retailers', sorted({int(o['device_id']) for o in kept}))
+    return removed
+
+def create_offer_unique_index(backend: str):
+    """
+    Уникальный индекс пар, когда валидного ещё нет (повторов быть не должно);
+    PostgreSQL — CONCURRENTLY на отдельном соединении вне транзакции: запись не блокируется.
+    """
+    if backend == 'sqlite':
+        with get_conn(backend) as conn:
+            tup_cur(conn).execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {OFFER_UNIQUE_INDEX} ON {_OFFER_UNIQUE_ON}")
             conn.commit()
+    else:
+        raw = _connect_pg()
+        try:
+            raw.autocommit = True
+            with closing(raw.cursor()) as cur:
+                # невалидный остаток прерванной попытки
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {OFFER_UNIQUE_INDEX}")
+                cur.execute(f"CREATE UNIQUE INDEX CONCURRENTLY {OFFER_UNIQUE_INDEX} ON {_OFFER_UNIQUE_ON}")
+        finally:
+            raw.close()
+    _OFFER_UNIQUE_MISSING.discard(backend)
+
+register_aux_schema([], [], bootstrap=_offer_unique_bootstrap)
+
+def _same_offer(old: Tuple[Any, Any], offer: Dict[str, Any]) -> bool:
+    price, in_stock = old
+    return (price is not None and round(float(price), 2) == round(float(offer['price']), 2)
+            and bool(in_stock) == bool(offer['in_stock']))
+
+def _write_offers(conn, offers: List[Dict[str, Any]], only_changed: bool):
+    """INSERT ... ON CONFLICT (device_id, retailer_id) DO UPDATE; PG — через COPY во временную таблицу."""
+    cols = ', '.join(_OFFER_COLUMNS)
+    guard = ""
+    cur = tup_cur(conn)
+    if _is_sqlite_conn(conn):
+        if only_changed:
+            guard = ("WHERE device_retailers.price IS NOT excluded.price "
+                     "OR device_retailers.in_stock IS NOT excluded.in_stock")
+        cur.executemany(f"""
+            INSERT INTO device_retailers ({cols}) VALUES ({', '.join(['%s'] * len(_OFFER_COLUMNS))})
+            ON CONFLICT (device_id, retailer_id) DO UPDATE
+            SET price = excluded.price, in_stock = excluded.in_stock, last_updated = excluded.last_updated
+            {guard}
+        """, [[o[c] for c in _OFFER_COLUMNS] for o in offers])
+        return
+
+    # столбцы временной таблицы — тех же типов, что в device_retailers
+    cur.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS offer_feed_stage ON COMMIT DELETE ROWS
+        AS SELECT {cols} FROM device_retailers WITH NO DATA
+    """)
+    bulk_insert(conn, 'offer_feed_stage', [{c: o[c] for c in _OFFER_COLUMNS} for o in offers])
+    pk_col = pk_expr = ""
+    if _pg_sequence(conn, 'device_retailers', 'device_retailer_id') is None:
+        cur.execute("LOCK TABLE device_retailers IN SHARE ROW EXCLUSIVE MODE")
+        pk_col = "device_retailer_id, "
+        pk_expr = "(SELECT COALESCE(MAX(device_retailer_id), 0) FROM device_retailers) + row_number() OVER (), "
+    if only_changed:
+        guard = ("WHERE device_retailers.price IS DISTINCT FROM EXCLUDED.price "
+                 "OR device_retailers.in_stock IS DISTINCT FROM EXCLUDED.in_stock")
+    cur.execute(f"""
+        INSERT INTO device_retailers ({pk_col}{cols})
+        SELECT {pk_expr}{cols} FROM offer_feed_stage
+        ON CONFLICT (device_id, retailer_id) DO UPDATE
+        SET price = EXCLUDED.price, in_stock = EXCLUDED.in_stock, last_updated = EXCLUDED.last_updated
+        {guard}
+    """)
+    cur.execute("TRUNCATE offer_feed_stage")
+
+def upsert_offers(conn, offers: List[Dict[str, Any]], only_changed: bool = True) -> Dict[str, Any]:
+    """
+    Записать предложения (device_id, retailer_id, price, in_stock, last_updated) в текущей
+    транзакции. Для повторов пары в пачке берётся последнее. only_changed — строки с той же
+    ценой и наличием не трогать. Предложения несуществующих устройств не пишутся.
+    Возвращает {'inserted', 'updated', 'unchanged': n, 'missing': [device_id, ...]}.
+    """
+    latest: Dict[Tuple[int, int], Dict[str, Any]] = {}
+    for offer in offers:
+        latest[(int(offer['device_id']), int(offer['retailer_id']))] = offer
+    result: Dict[str, Any] = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'missing': []}
+    if not latest:
+        return result
+    require_offer_unique_index(conn)
+    device_ids = sorted({d for d, _ in latest})
+    retailer_ids = sorted({r for _, r in latest})
+    dev_ph = ', '.join(['%s'] * len(device_ids))
+    found, existing = run_queries(conn, [
+        (f"SELECT device_id FROM devices WHERE device_id IN ({dev_ph})", device_ids),
+        (f"""SELECT device_id, retailer_id, price, in_stock FROM device_retailers
+             WHERE device_id IN ({dev_ph}) AND retailer_id IN ({', '.join(['%s'] * len(retailer_ids))})""",
+         device_ids + retailer_ids),
+    ])
+    found_ids = {r[0] for r in found}
+    current = {(r[0], r[1]): (r[2], r[3]) for r in existing}
+
+    changed, history = [], []
+    for key, offer in latest.items():
+        if key[0] not in found_ids:
+            continue
+        old = current.get(key)
+        same = old is not None and _same_offer(old, offer)
+        if old is None:
+            result['inserted'] += 1
+        elif only_changed and same:
+            result['unchanged'] += 1
+            continue
+        else:
+            result['updated'] += 1
+        changed.append(offer)
+        if not same:
+            history.append(offer)
+    result['missing'] = [d for d in device_ids if d not in found_ids]
+    if changed:
+        _write_offers(conn, changed, only_changed)
+        record_price_history(conn, history)
+        notify_data_change(conn, 'device_retailers', sorted({int(o['device_id']) for o in changed}))
+    return result
+
+def price_feed_offer(record: Dict[str, Any], lookups: ImportLookups, retailer_ids: set,
+                     retailer_id: Optional[int], today: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """Строка прайса -> предложение для upsert_offers или текст ошибки (проверки — как в форме)."""
+    values: Dict[str, str] = {}
+    for key, value in record.items():
+        if value is None or key is None:
+            continue
+        if isinstance(value, bool):
+            value = '1' if value else '0'
+        value = str(value).strip()
+        if value != '':
+            values[str(key).strip()] = value
+    try:
+        device_id = int(values.get('device_id', ''))
+    except ValueError:
+        return None, "device_id: нужен целый id устройства"
 
+    if 'retailer_id' in values:
+        try:
+            retailer_id = int(values['retailer_id'])
+        except ValueError:
+            return None, "retailer_id: нужно целое число"
+    elif 'retailer' in values:
+        retailer_id, error = lookups.resolve('retailer', values['retailer'])
+        if error:
+            return None, error
+    if retailer_id is None:
+        return None, "не указан продавец: retailer_id или retailer"
+    if retailer_id not in retailer_ids:
+        return None, f"retailer_id: {retailer_id} нет в справочнике"
 
+    try:
+        # «1 299,90» из выгрузок — тоже цена
+        price = float(values.get('price', '').replace('\xa0', '').replace(' ', '').replace(',', '.'))
+        if not (0.0 <= price <= 1_000_000.0):
+            raise ValueError
+    except ValueError:
+        return None, "price: нужна цена от 0 до 1 000 000"
+    last_updated = values.get('last_updated') or today
+    try:
+        _DT.strptime(last_updated, "%Y-%m-%d")
+    except ValueError:
+        return None, "last_updated: нужна дата YYYY-MM-DD"
+    in_stock = values['in_stock'].casefold() in _IMPORT_TRUTHY if 'in_stock' in values else True
+    return {'device_id': device_id, 'retailer_id': retailer_id, 'price': price,
+            'in_stock': in_stock, 'last_updated': last_updated}, None
+
+def import_price_feed(records, backend: str, report: ImportReport, retailer_id: Optional[int] = None,
+                      batch_size: int = PRICE_FEED_BATCH_SIZE):
+    """
+    Загрузка прайса из записей iter_import_records() через upsert_offers; события — как
+    у run_import. retailer_id — продавец для строк, где он не указан.
+    """
+    today = _Date.today().isoformat()
+    with get_conn(backend) as conn:
+        require_offer_unique_index(conn)
+        lookups = ImportLookups(conn)
+        retailer_ids = {row[0] for row in reference_data(['retailers'], conn)['retailers']}
+    for name in ('inserted', 'updated', 'unchanged'):
+        report.count(name, 0)
+
+    def write(conn, offers):
+        result = upsert_offers(conn, offers)
+        missing = set(result.pop('missing'))
+        rejected = {pos: f"устройства {offer['device_id']} нет" for pos, offer in enumerate(offers)
+                    if offer['device_id'] in missing}
+        return rejected, result
+
+    return run_import(records, backend, report,
+                      lambda record: price_feed_offer(record, lookups, retailer_ids, retailer_id, today),
+                      write, batch_size)
 
-        # ===== Доп. характеристики: сохраняем только если что-то заполнено =====
-        def _has_any(names):
-            for n in names:
-                v = request.form.get(n)
-                if v is None:
-                    # чекбоксы: проверим .getlist на on
-                    continue
-                if n in ('has_ai_enhance', 'wireless_charging'):
-                    if request.form.get(n): return True
-                elif str(v).strip() != '':
-                    return True
-            return False
+# -------------------------------------------------
+# История цен предложений
+# -------------------------------------------------
+# device_retailers хранит только текущее предложение; каждое изменение цены или
+# наличия дописывается в price_history (только вставки; price=NULL — предложение снято).
+# PostgreSQL — таблица, секционированная по месяцам (секции создаются по мере надобности,
+# старые можно отсоединить или удалить целиком); SQLite — компактная WITHOUT ROWID
+# с ключом (device_id, recorded_at, retailer_id) и временем в секундах Unix.
+PRICE_HISTORY_POINTS = env_int("PRICE_HISTORY_POINTS", 200)
+PRICE_HISTORY_POINTS_MAX = 2000
+# длина корзины выбирается из «круглых» значений, чтобы границы не плавали от запроса к запросу
+_PRICE_HISTORY_STEPS = (60, 300, 900, 3600, 6 * 3600, 86400, 7 * 86400, 30 * 86400, 91 * 86400, 365 * 86400)
+# PG: на сколько месяцев вперёд секции создаются заранее (при старте и когда запас кончился)
+PRICE_HISTORY_MONTHS_AHEAD = max(1, env_int("PRICE_HISTORY_MONTHS_AHEAD", 3))
+_PRICE_HISTORY_MONTHS: set = set()   # PG: месяцы, секции которых уже есть
+
+def _month_start(value: _Date) -> _Date:
+    return _Date(value.year, value.month, 1)
+
+def _next_month(value: _Date) -> _Date:
+    return (_month_start(value) + timedelta(days=32)).replace(day=1)
+
+def _create_history_partitions(conn, months):
+    """Секции price_history на месяцы (UTC) в транзакции conn."""
+    cur = tup_cur(conn)
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (_AUX_PG_LOCK_KEY,))
+    for month in sorted(months):
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS price_history_{month:%Y%m} PARTITION OF price_history
+            FOR VALUES FROM ('{month} 00:00+00') TO ('{_next_month(month)} 00:00+00')
+        """)
 
-        # --- specifications ---
-        if _has_any(['proc_model_id','processor_cores','ram_gb','storage_gb','storage_type_id']):
-            data = {}
-            pm = request.form.get('proc_model_id') or None
-            st = request.form.get('storage_type_id') or None
-            if pm: data['proc_model_id'] = int(pm)
-            if st: data['storage_type_id'] = int(st)
+def _history_months_ahead(today: _Date) -> set:
+    """Этот месяц и PRICE_HISTORY_MONTHS_AHEAD следующих."""
+    months = {_month_start(today)}
+    for _ in range(PRICE_HISTORY_MONTHS_AHEAD):
+        months.add(_next_month(max(months)))
+    return months
 
-            def _int_in(name, lo, hi):
-                val = request.form.get(name)
-                if not val: return True
-                try:
-                    iv = int(val)
-                    if not (lo <= iv <= hi): raise ValueError
-                except:
-                    flash(f'{name}: {lo}-{hi}', 'danger'); return False
-                data[name] = iv; return True
+def ensure_price_history_partitions(conn, months):
+    """
+    Секции для месяцев, которых процесс ещё не видел, — в транзакции conn (второе
+    соединение из пула здесь не берём: пишущий уже держит своё). Обычно всё создано
+    заранее при старте; сюда попадает только процесс, переживший запас месяцев, — тогда
+    запас продлевается. Месяцы запоминаются после commit: откат уносит и секции.
+    """
+    todo = {_month_start(m) for m in months} - _PRICE_HISTORY_MONTHS
+    if not todo:
+        return
+    todo |= _history_months_ahead(max(todo))
+    _create_history_partitions(conn, todo)
+    after_commit(conn, lambda: _PRICE_HISTORY_MONTHS.update(todo))
+
+def _price_history_bootstrap(conn):
+    """Секции на этот месяц и PRICE_HISTORY_MONTHS_AHEAD вперёд; пустая история начинается с текущих предложений."""
+    cur = tup_cur(conn)
+    sqlite = _is_sqlite_conn(conn)
+    if not sqlite:
+        months = _history_months_ahead(_DT.now(timezone.utc).date())
+        _create_history_partitions(conn, months)
+        _PRICE_HISTORY_MONTHS.update(months)
+    cur.execute("SELECT 1 FROM price_history LIMIT 1")
+    if cur.fetchone():
+        return
+    if sqlite:
+        cur.execute("""
+            INSERT OR REPLACE INTO price_history (device_id, recorded_at, retailer_id, price, in_stock)
+            SELECT device_id, CAST((COALESCE(julianday(last_updated), julianday('now')) - 2440587.5) * 86400 AS INTEGER),
+                   retailer_id, price, COALESCE(in_stock, 0)
+            FROM device_retailers
+        """)
+        return
+    stamp = "COALESCE(last_updated::timestamptz, now())"
+    cur.execute(f"SELECT DISTINCT date_trunc('month', {stamp} AT TIME ZONE 'UTC')::date FROM device_retailers")
+    months = {row[0] for row in cur.fetchall()} - _PRICE_HISTORY_MONTHS
+    if months:
+        _create_history_partitions(conn, months)
+        _PRICE_HISTORY_MONTHS.update(months)
+    cur.execute(f"""
+        INSERT INTO price_history (device_id, retailer_id, recorded_at, price, in_stock)
+        SELECT device_id, retailer_id, {stamp}, price, COALESCE(in_stock, false)
+        FROM device_retailers
+    """)
+
+register_aux_schema(
+    ['price_history'],
+    ["""CREATE TABLE IF NOT EXISTS price_history (
+            device_id   integer NOT NULL,
+            retailer_id integer NOT NULL,
+            recorded_at timestamptz NOT NULL DEFAULT now(),
+            price       numeric(12, 2),
+            in_stock    boolean NOT NULL
+        ) PARTITION BY RANGE (recorded_at)""",
+     "CREATE INDEX IF NOT EXISTS ix_price_history_device ON price_history (device_id, recorded_at)"],
+    ["""CREATE TABLE IF NOT EXISTS price_history (
+            device_id   INTEGER NOT NULL,
+            recorded_at INTEGER NOT NULL,
+            retailer_id INTEGER NOT NULL,
+            price       REAL,
+            in_stock    INTEGER NOT NULL,
+            PRIMARY KEY (device_id, recorded_at, retailer_id)
+        ) WITHOUT ROWID"""],
+    bootstrap=_price_history_bootstrap,
+)
 
-            if not _int_in('processor_cores', 1, 20) or not _int_in('ram_gb', 1, 32) or not _int_in('storage_gb', 1, 2048):
-                return redirect(url_for('add_device'))
+def record_price_history(conn, offers: List[Dict[str, Any]]):
+    """
+    Дописать точки истории (device_id, retailer_id, price, in_stock) с текущим временем
+    в транзакции conn; price=None — предложение снято. SQLite: две точки пары за одну
+    секунду схлопываются в последнюю.
+    """
+    if not offers:
+        return
+    rows = [{'device_id': int(o['device_id']), 'retailer_id': int(o['retailer_id']),
+             'price': o.get('price'), 'in_stock': bool(o.get('in_stock'))} for o in offers]
+    cur = tup_cur(conn)
+    if _is_sqlite_conn(conn):
+        now = int(time.time())
+        cur.executemany("""
+            INSERT OR REPLACE INTO price_history (device_id, recorded_at, retailer_id, price, in_stock)
+            VALUES (%s, %s, %s, %s, %s)
+        """, [(r['device_id'], now, r['retailer_id'], r['price'], int(r['in_stock'])) for r in rows])
+        return
+    # recorded_at — DEFAULT now(), время начала транзакции
+    today = _DT.now(timezone.utc).date()
+    ensure_price_history_partitions(conn, [today, today - timedelta(days=1)])
+    bulk_insert(conn, 'price_history', rows)
+
+def _history_time(value: Optional[str]) -> Optional[int]:
+    """?from= / ?to=: секунды Unix или дата YYYY-MM-DD (UTC)."""
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    return int(_DT.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp())
+
+def price_history_step(start: int, end: int, points: int) -> int:
+    """Длина корзины, с: наименьшая «круглая», при которой корзин не больше points."""
+    raw = max(1, -(-(end - start + 1) // max(1, points)))
+    for step in _PRICE_HISTORY_STEPS:
+        if step >= raw:
+            return step
+    top = _PRICE_HISTORY_STEPS[-1]
+    return -(-raw // top) * top
+
+def price_history_series(conn, device_id: int, start: int, end: int, step: int,
+                         retailer_id: Optional[int] = None) -> List[Tuple]:
+    """
+    Точки истории устройства, сведённые в корзины по step секунд:
+    (retailer_id, корзина, min, max, последняя цена, наличие по последней точке).
+    """
+    if _is_sqlite_conn(conn):
+        t_expr, bucket_expr, bound = "recorded_at", "recorded_at / %s", "%s"
+    else:
+        t_expr = "EXTRACT(EPOCH FROM recorded_at)"
+        bucket_expr, bound = "FLOOR(EXTRACT(EPOCH FROM recorded_at) / %s)::bigint", "to_timestamp(%s)"
+    where = f"device_id = %s AND recorded_at >= {bound} AND recorded_at <= {bound}"
+    params: List[Any] = [step, device_id, start, end]
+    if retailer_id is not None:
+        where += " AND retailer_id = %s"
+        params.append(retailer_id)
+    cur = tup_cur(conn)
+    cur.execute(f"""
+        SELECT retailer_id, bucket, MIN(price), MAX(price),
+               MAX(CASE WHEN rn = 1 THEN price END),
+               MAX(CASE WHEN rn = 1 AND in_stock THEN 1 WHEN rn = 1 THEN 0 END)
+        FROM (
+            SELECT retailer_id, bucket, price, in_stock,
+                   ROW_NUMBER() OVER (PARTITION BY retailer_id, bucket ORDER BY t DESC) AS rn
+            FROM (SELECT retailer_id, {bucket_expr} AS bucket, {t_expr} AS t, price, in_stock
+                  FROM price_history WHERE {where}) h
+        ) b
+        GROUP BY retailer_id, bucket
+        ORDER BY retailer_id, bucket
+    """, params)
+    return cur.fetchall()
+
+def _history_price(value) -> Optional[float]:
+    return None if value is None else round(float(value), 2)
+
+@app.route('/api/device/<int:device_id>/price_history')
+def api_price_history(device_id):
+    """
+    История цен устройства по продавцам: ?from=&to= (YYYY-MM-DD или секунды Unix;
+    по умолчанию — вся история), ?points=<до 2000>, ?retailer_id=.
+    Точки сводятся в корзины по step секунд: min/max/последняя цена и наличие по последней
+    точке корзины (null в last — предложение было снято). Ряды — по столбцам:
+    {"retailers": [{"retailer_id", "name", "t": [...], "min": [...], "max": [...], "last": [...], "in_stock": [...]}]}.
+    """
+    try:
+        start, end = _history_time(request.args.get('from')), _history_time(request.args.get('to'))
+    except ValueError:
+        return jsonify({'ok': False, 'reason': 'bad_range'}), 400
+    points = max(1, min(request.args.get('points', PRICE_HISTORY_POINTS, type=int), PRICE_HISTORY_POINTS_MAX))
+    retailer_id = request.args.get('retailer_id', type=int)
 
-            with get_conn() as conn:
-                cur = tup_cur(conn)
-                new_sid, _ = next_id(conn, 'specifications')
-                fields = ['spec_id', 'device_id'] + list(data.keys())
-                ph = ", ".join(['%s'] * len(fields))
-                cur.execute(f"INSERT INTO specifications ({', '.join(fields)}) VALUES ({ph})",
-                            (new_sid, device_id, *data.values()))
-                conn.commit()
+    with get_conn() as conn:
+        span = ("SELECT MIN(recorded_at), MAX(recorded_at) FROM price_history WHERE device_id = %s"
+                if _is_sqlite_conn(conn) else
+                "SELECT EXTRACT(EPOCH FROM MIN(recorded_at)), EXTRACT(EPOCH FROM MAX(recorded_at)) "
+                "FROM price_history WHERE device_id = %s")
+        found, bounds = run_queries(conn, [
+            ("SELECT 1 FROM devices WHERE device_id = %s", [device_id]),
+            (span, [device_id]),
+        ])
+        first, last = bounds[0] if bounds else (None, None)
+        if not found and first is None:
+            return jsonify({'ok': False, 'reason': 'not_found'}), 404
+        start = start if start is not None else int(first or 0)
+        end = end if end is not None else int(last or time.time())
+        if end < start:
+            return jsonify({'ok': False, 'reason': 'bad_range'}), 400
+        step = price_history_step(start, end, points)
+        rows = price_history_series(conn, device_id, start, end, step, retailer_id)
+        names = dict(reference_data(['retailers'], conn)['retailers'])
+
+    series: Dict[int, Dict[str, Any]] = {}
+    for rid, bucket, low, high, last_price, in_stock in rows:
+        s = series.setdefault(rid, {'retailer_id': rid, 'name': names.get(rid),
+                                    't': [], 'min': [], 'max': [], 'last': [], 'in_stock': []})
+        s['t'].append(int(bucket) * step)
+        s['min'].append(_history_price(low))
+        s['max'].append(_history_price(high))
+        s['last'].append(_history_price(last_price))
+        s['in_stock'].append(bool(in_stock))
+    return jsonify({'device_id': device_id, 'from': start, 'to': end, 'step': step,
+                    'retailers': list(series.values())})
 
-        # --- displays ---
-        if _has_any(['diagonal_inches','resolution','techn_matr_id','refresh_rate_hz','brightness_nits']):
-            try:
-                diagonal_inches = request.form.get('diagonal_inches')
-                diagonal_inches = float(diagonal_inches) if diagonal_inches else None
-                if diagonal_inches is not None and not (1.0 <= diagonal_inches <= 100.0): raise ValueError
-                resolution = request.form.get('resolution') or None
-                techn_matr_id = int(request.form.get('techn_matr_id')) if request.form.get('techn_matr_id') else None
-                rr = request.form.get('refresh_rate_hz')
-                refresh_rate_hz = int(rr) if rr else None
-                if refresh_rate_hz is not None and not (1 <= refresh_rate_hz <= 360): raise ValueError
-                bn = request.form.get('brightness_nits')
-                brightness_nits = int(bn) if bn else None
-                if brightness_nits is not None and not (1 <= brightness_nits <= 10000): raise ValueError
-            except:
-                flash('Проверьте поля дисплея (диапазоны/формат).', 'danger')
-                return redirect(url_for('add_device'))
+# -------------------------------------------------
+# Лучшее предложение по устройству (device_best_offer)
+# -------------------------------------------------
+# Строка на устройство: минимальная цена в наличии и у кого она, сколько всего
+# предложений и в наличии, когда предложения обновлялись. Ведётся по уведомлениям
+# об изменениях; «самые дешёвые планшеты в наличии дешевле X» — проход по индексу
+# (category_id, best_price) вместо агрегации device_retailers.
+BEST_OFFER_TABLES = {'devices', 'device_retailers'}
+BEST_OFFERS_LIMIT = 50
+BEST_OFFERS_LIMIT_MAX = 500
+_BEST_OFFER_COLS = ("device_id, category_id, best_price, best_retailer_id, "
+                    "offer_count, in_stock_count, last_updated")
+
+def _best_offer_select(ids_filter: str = "") -> str:
+    """SELECT строк device_best_offer; ids_filter — «IN (...)» для частичного пересчёта."""
+    dev_where = f"WHERE d.device_id {ids_filter}" if ids_filter else ""
+    dr_where = f"WHERE device_id {ids_filter}" if ids_filter else ""
+    dr_and = f"AND device_id {ids_filter}" if ids_filter else ""
+    return f"""
+        SELECT d.device_id, d.category_id, b.price, b.retailer_id,
+               COALESCE(a.offer_count, 0), COALESCE(a.in_stock_count, 0), a.last_updated
+        FROM devices d
+        LEFT JOIN (
+            SELECT device_id, COUNT(*) AS offer_count,
+                   SUM(CASE WHEN in_stock THEN 1 ELSE 0 END) AS in_stock_count,
+                   MAX(last_updated) AS last_updated
+            FROM device_retailers {dr_where}
+            GROUP BY device_id
+        ) a ON a.device_id = d.device_id
+        LEFT JOIN (
+            SELECT device_id, price, retailer_id,
+                   ROW_NUMBER() OVER (PARTITION BY device_id ORDER BY price, retailer_id) AS rn
+            FROM device_retailers WHERE in_stock AND price IS NOT NULL {dr_and}
+        ) b ON b.device_id = d.device_id AND b.rn = 1
+        {dev_where}
+    """
 
-            with get_conn() as conn:
-                cur = tup_cur(conn)
-                new_did, _ = next_id(conn, 'displays')
-                cur.execute("""
-                    INSERT INTO displays
-                      (display_id, device_id, diagonal_inches, resolution, techn_matr_id, refresh_rate_hz, brightness_nits)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s)
-                """, (new_did, device_id, diagonal_inches, resolution, techn_matr_id, refresh_rate_hz, brightness_nits))
-                conn.commit()
+def refresh_best_offers(conn, device_ids: Optional[List[int]] = None):
+    """Пересчитать строки device_best_offer для устройств (None — для всех)."""
+    cur = tup_cur(conn)
+    if device_ids is None:
+        cur.execute("DELETE FROM device_best_offer")
+        cur.execute(f"INSERT INTO device_best_offer ({_BEST_OFFER_COLS}) {_best_offer_select()}")
+        return
+    ids = sorted({int(i) for i in device_ids})
+    if not ids:
+        return
+    ph = ", ".join(['%s'] * len(ids))
+    cur.execute(f"DELETE FROM device_best_offer WHERE device_id IN ({ph})", ids)
+    # фильтр по id стоит в трёх местах запроса — параметры повторяются
+    cur.execute(f"INSERT INTO device_best_offer ({_BEST_OFFER_COLS}) {_best_offer_select(f'IN ({ph})')}",
+                ids * 3)
+
+def _best_offer_bootstrap(conn):
+    cur = tup_cur(conn)
+    cur.execute("SELECT 1 FROM device_best_offer LIMIT 1")
+    if cur.fetchone() is None:
+        refresh_best_offers(conn)
+
+register_aux_schema(
+    ['device_best_offer'],
+    [
+        """CREATE TABLE IF NOT EXISTS device_best_offer (
+               device_id        integer PRIMARY KEY,
+               category_id      integer,
+               best_price       double precision,
+               best_retailer_id integer,
+               offer_count      integer NOT NULL DEFAULT 0,
+               in_stock_count   integer NOT NULL DEFAULT 0,
+               last_updated     text
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_best_offer_category ON device_best_offer (category_id, best_price)",
+        "CREATE INDEX IF NOT EXISTS idx_best_offer_price ON device_best_offer (best_price)",
+    ],
+    bootstrap=_best_offer_bootstrap,
+)
 
-        # --- cameras ---
-        if _has_any(['megapixels_main','aperture_main','optical_zoom_x','video_resolution','has_ai_enhance']):
-            try:
-                mp = request.form.get('megapixels_main')
-                megapixels_main = float(mp) if mp else None
-                if megapixels_main is not None and not (2.0 <= megapixels_main <= 200.0): raise ValueError
-                aperture_main = (request.form.get('aperture_main') or '').strip() or None
-                if aperture_main is not None and not (3 <= len(aperture_main) <= 6): raise ValueError
-                oz = request.form.get('optical_zoom_x')
-                optical_zoom_x = float(oz) if oz else None
-                if optical_zoom_x is not None and not (0.0 <= optical_zoom_x <= 144.0): raise ValueError
-                vr = request.form.get('video_resolution')
-                video_resolution = vr.strip() if vr else None
-                if video_resolution is not None and not (7 <= len(video_resolution) <= 11): raise ValueError
-                has_ai_enhance = True if request.form.get('has_ai_enhance') else False
-            except:
-                flash('Проверьте поля камеры (диапазоны/формат).', 'danger')
-                return redirect(url_for('add_device'))
+@on_data_change
+def _best_offer_on_change(conn, table_name, device_ids):
+    if table_name in BEST_OFFER_TABLES:
+        refresh_best_offers(conn, device_ids)
 
-            with get_conn() as conn:
-                cur = tup_cur(conn)
-                new_cid, _ = next_id(conn, 'cameras')
-                cur.execute("""
-                    INSERT INTO cameras
-                      (camera_id, device_id, megapixels_main, aperture_main, optical_zoom_x, video_resolution, has_ai_enhance)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s)
-                """, (new_cid, device_id, megapixels_main, aperture_main, optical_zoom_x, video_resolution, has_ai_enhance))
-                conn.commit()
+def best_offers(conn, category_id: Optional[int] = None, max_price: Optional[float] = None,
+                limit: int = BEST_OFFERS_LIMIT) -> List[Tuple]:
+    """
+    Самые дешёвые устройства в наличии: (device_id, model, manufacturer, category, price,
+    retailer_id, retailer, offer_count, in_stock_count, last_updated), по возрастанию цены.
+    """
+    where, params = ["b.best_price IS NOT NULL"], []
+    if category_id is not None:
+        where.append("b.category_id = %s")
+        params.append(category_id)
+    if max_price is not None:
+        where.append("b.best_price <= %s")
+        params.append(max_price)
+    cur = tup_cur(conn)
+    cur.execute(f"""
+        SELECT b.device_id, s.model, s.manufacturer, s.category, b.best_price,
+               b.best_retailer_id, r.name, b.offer_count, b.in_stock_count, b.last_updated
+        FROM device_best_offer b
+        JOIN device_search s ON s.device_id = b.device_id
+        LEFT JOIN retailers r ON r.retailer_id = b.best_retailer_id
+        WHERE {' AND '.join(where)}
+        ORDER BY b.best_price, b.device_id
+        LIMIT {int(limit)}
+    """, params)
+    return cur.fetchall()
+
+@app.route('/api/best_offers')
+def api_best_offers():
+    """Самые дешёвые устройства в наличии: ?category_id=&max_price=&limit=<до 500>."""
+    category_id = request.args.get('category_id', type=int)
+    max_price = request.args.get('max_price', type=float)
+    limit = max(1, min(request.args.get('limit', BEST_OFFERS_LIMIT, type=int), BEST_OFFERS_LIMIT_MAX))
+    with get_conn() as conn:
+        rows = best_offers(conn, category_id, max_price, limit)
+    keys = ('device_id', 'model', 'manufacturer', 'category', 'price', 'retailer_id', 'retailer',
+            'offer_count', 'in_stock_count', 'last_updated')
+    return jsonify({'items': [dict(zip(keys, map(json_cell, row))) for row in rows]})
 
-        # --- batteries ---
-        if _has_any(['capacity_mah','fast_charging_w','wireless_charging','estimated_life_hours']):
-            try:
-                cm = request.form.get('capacity_mah')
-                capacity_mah = int(cm) if cm else None
-                if capacity_mah is not None and not (1 <= capacity_mah <= 20000): raise ValueError
-                fc = request.form.get('fast_charging_w')
-                fast_charging_w = float(fc) if fc else None
-                if fast_charging_w is not None and not (0.0 <= fast_charging_w <= 20.0): raise ValueError
-                elh = request.form.get('estimated_life_hours')
-                estimated_life_hours = float(elh) if elh else None
-                if estimated_life_hours is not None and not (0.0 <= estimated_life_hours <= 96.0): raise ValueError
-                wireless_charging = True if request.form.get('wireless_charging') else False
-            except:
-                flash('Проверьте поля батареи (диапазоны).', 'danger')
-                return redirect(url_for('add_device'))
+@app.route('/admin/import', methods=['GET', 'POST'])
+@admin_required
+def admin_import():
+    """
+    Загрузка файла устройств (kind=devices) или прайса продавца (kind=prices).
+    Ответ POST — NDJSON по ходу загрузки: {"progress": {...}} после каждой пачки,
+    {"rejected": {"line", "error", "record"}} на каждую отклонённую строку и {"done": {...}} в конце.
+    """
+    if request.method == 'GET':
+        return render_template('admin_import.html', batch_size=IMPORT_BATCH_SIZE, fields=IMPORT_NAME_FIELDS,
+                               price_batch_size=PRICE_FEED_BATCH_SIZE, price_fields=PRICE_FEED_FIELDS,
+                               retailers=reference_data(['retailers'])['retailers'])
+
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({'ok': False, 'reason': 'no_file'}), 400
+    fmt = request.form.get('format') or None
+    if fmt not in (None, 'csv', 'ndjson'):
+        return jsonify({'ok': False, 'reason': 'bad_format'}), 400
+    kind = request.form.get('kind') or 'devices'
+    if kind not in ('devices', 'prices'):
+        return jsonify({'ok': False, 'reason': 'bad_kind'}), 400
+    default_size = PRICE_FEED_BATCH_SIZE if kind == 'prices' else IMPORT_BATCH_SIZE
+    batch_size = request.form.get('batch_size', default_size, type=int) or default_size
+    create_models = request.form.get('create_models') == 'on'
+    retailer_id = request.form.get('retailer_id', type=int)
+    backend, user_id = current_backend(), current_user.id
+
+    # файлы запроса закрываются, как только view вернёт ответ, — загрузка идёт из своей копии
+    data = tempfile.TemporaryFile()
+    upload.save(data)
+    data.seek(0)
+    filename = upload.filename
+
+    def generate():
+        report = ImportReport()
+        try:
+            records = iter_import_records(data, fmt, filename)
+            if kind == 'prices':
+                events = import_price_feed(records, backend, report, retailer_id, batch_size)
+            else:
+                events = import_devices(records, backend, report, user_id, batch_size, create_models)
+            for event in events:
+                if event[0] == 'rejected':
+                    _, line_no, record, error = event
+                    line = {'rejected': {'line': line_no, 'error': error, 'record': record}}
+                else:
+                    line = {'progress': report.to_dict()}
+                yield json.dumps(line, ensure_ascii=False, default=str) + "\n"
+        finally:
+            data.close()
+        yield json.dumps({'done': report.to_dict()}) + "\n"
 
-            with get_conn() as conn:
-                cur = tup_cur(conn)
-                new_bid, _ = next_id(conn, 'batteries')
-                cur.execute("""
-                    INSERT INTO batteries
-                      (battery_id, device_id, capacity_mah, fast_charging_w, wireless_charging, estimated_life_hours)
-                    VALUES (%s,%s,%s,%s,%s,%s)
-                """, (new_bid, device_id, capacity_mah, fast_charging_w, wireless_charging, estimated_life_hours))
-                conn.commit()
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
-        # --- опционально сразу одно предложение продавца ---
-        if _has_any(['retailer_id','site_price','in_stock','last_updated']):
-            retailer_id  = request.form.get('retailer_id')
-            site_price   = request.form.get('site_price')
-            in_stock     = True if request.form.get('in_stock') == 'on' else False
-            last_updated = request.form.get('last_updated') or today
-            try:
-                price_val = float(site_price) if site_price else None
-                if price_val is not None and not (0.0 <= price_val <= 1_000_000.0): raise ValueError
-                _DT.strptime(last_updated, "%Y-%m-%d")
-            except:
-                flash('Проверьте цену продавца (0–1 000 000) и дату (YYYY-MM-DD).', 'danger')
-                return redirect(url_for('add_device'))
+# -------------------------------------------------
+# Постраничный вывод (keyset) и потоковая отдача
+# -------------------------------------------------
+TABLE_PAGE_SIZE = env_int("TABLE_PAGE_SIZE", 200)
+TABLE_PAGE_MAX = env_int("TABLE_PAGE_MAX", 5000)
+PG_ITERSIZE = 500   # строк за одно обращение к серверному курсору PG
 
-            if retailer_id and site_price:
-                with get_conn() as conn:
-                    cur = tup_cur(conn)
-                    new_dr, _ = next_id(conn, 'device_retailers')
-                    cur.execute("""
-                        INSERT INTO device_retailers (device_retailer_id, device_id, retailer_id, price, in_stock, last_updated)
-                        VALUES (%s,%s,%s,%s,%s,%s)
-                    """, (new_dr, device_id, retailer_id, price_val, in_stock, last_updated))
-                    conn.commit()
+def encode_page_cursor(values: List[Any]) -> str:
+    raw = json.dumps(values, default=str, ensure_ascii=False).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
 
-        flash('Устройство добавлено.', 'success')
-        return redirect(url_for('device_detail', device_id=device_id, added=1))
-
-    # GET — рендерим форму
-    return render_template('add_device.html',
-                           manufacturers=manufacturers,
-                           categories=categories,
-                           operating_systems=operating_systems,
-                           models=models,
-                           colors=colors,
-                           proc_models=proc_models,
-                           storage_types=storage_types,
-                           techn_matrices=techn_matrices,
-                           retailers=retailers,
-                           aperture_main=aperture_main,
-                           min_date=min_date,
-                           max_date=today,
-                           today=today)
+def decode_page_cursor(token: Optional[str]) -> Optional[List[Any]]:
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) and values else None
 
+def page_limit(value, default: int = TABLE_PAGE_SIZE) -> int:
+    try:
+        return max(1, min(int(value), TABLE_PAGE_MAX))
+    except (TypeError, ValueError):
+        return default
 
-@app.route('/all_devices')
-def all_devices():
+def keyset_sql(select_sql: str, sort: str, pk: str, desc: bool, after: Optional[List[Any]],
+               limit: int, where: Optional[List[str]] = None,
+               params: Optional[List[Any]] = None) -> Tuple[str, List[Any]]:
+    """
+    Запрос страницы «после курсора» вместо OFFSET: WHERE (sort, pk) > курсор ORDER BY sort, pk.
+    Сортировка не по PK — с PK вторым ключом; NULL в sort идут последними на обоих бэкендах.
+    Возвращает LIMIT limit+1, чтобы узнать, есть ли следующая страница.
+    """
+    where = list(where or [])
+    params = list(params or [])
+    cmp, direction = ('<', 'DESC') if desc else ('>', 'ASC')
+    if sort == pk:
+        if after:
+            where.append(f"{pk} {cmp} %s")
+            params.append(after[-1])
+        order = f"{pk} {direction}"
+    else:
+        if after and len(after) == 2:
+            v, p = after
+            if v is None:
+                where.append(f"({sort} IS NULL AND {pk} {cmp} %s)")
+                params.append(p)
+            else:
+                where.append(f"({sort} IS NULL OR {sort} {cmp} %s OR ({sort} = %s AND {pk} {cmp} %s))")
+                params += [v, v, p]
+        order = f"({sort} IS NULL), {sort} {direction}, {pk} {direction}"
+    sql = select_sql
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {order} LIMIT {int(limit) + 1}"
+    return sql, params
+
+class KeysetPage:
+    """
+    Строки одной страницы, читаемые лениво — прямо во время рендера шаблона.
+    PostgreSQL: именованный (серверный) курсор, строки приходят пачками по PG_ITERSIZE.
+    После обхода заполнены has_more и next_cursor.
+    """
+    def __init__(self, backend: str, sql: str, params: List[Any], limit: int,
+                 key_idx: List[int], row_fn=None):
+        self.backend = backend
+        self.sql = sql
+        self.params = params
+        self.limit = limit
+        self.key_idx = key_idx          # индексы столбцов курсора в строке: [sort, pk] или [pk]
+        self.row_fn = row_fn
+        self.has_more = False
+        self.next_cursor: Optional[str] = None
+        self.count = 0
+
+    def __iter__(self):
+        last = None
+        with get_conn(self.backend) as conn:
+            raw = getattr(conn, "raw", conn)
+            if self.backend == "pg":
+                named = raw.cursor(name=f"page_{uuid.uuid4().hex[:12]}")
+                named.itersize = min(self.limit + 1, PG_ITERSIZE)
+                cur = AnyCursor(named, "pg")
+            else:
+                cur = AnyCursor(raw.cursor(), "sqlite")
+            try:
+                cur.execute(self.sql, self.params)
+                for row in cur:
+                    if self.count >= self.limit:
+                        self.has_more = True
+                        break
+                    self.count += 1
+                    last = row
+                    yield self.row_fn(row) if self.row_fn else row
+            finally:
+                cur.close()
+        if self.has_more and last is not None:
+            self.next_cursor = encode_page_cursor([last[i] for i in self.key_idx])
+
+def json_cell(value):
+    """Значение ячейки для JSON: даты — ISO, Decimal — число."""
+    if isinstance(value, (_DT, _Date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (bytes, memoryview)):
+        return None
+    return value
+
+# -------------------------------------------------
+# Карточка устройства: загрузка одним запросом и кэш
+# -------------------------------------------------
+DEVICE_CACHE_SIZE = env_int("DEVICE_CACHE_SIZE", 2000)
+DEVICE_CACHE_TTL = env_int("DEVICE_CACHE_TTL", 300)
+
+# части карточки: (имя, столбец-признак наличия строки, столбцы); все 1:1 с устройством
+_DEVICE_DETAIL_PARTS = [
+    ('main', 'd.device_id', [
+        'ml.name', 'c.name', 'm.name', 'd.release_date',
+        'd.current_price', 'd.is_waterproof', 'd.warranty_months', 'col.name']),
+    ('os_info', 'osys.os_id', ['osn.name', 'osys.developer', 'osys.latest_version', 'osys.release_date']),
+    ('display', 'disp.display_id', [
+        'disp.diagonal_inches', 'disp.resolution', 'tm.name', 'disp.refresh_rate_hz', 'disp.brightness_nits']),
+    ('specs', 's.spec_id', ['pm.name', 's.processor_cores', 's.ram_gb', 's.storage_gb', 'st.name']),
+    ('battery', 'b.battery_id', ['b.capacity_mah', 'b.fast_charging_w', 'b.wireless_charging', 'b.estimated_life_hours']),
+    ('camera', 'cam.camera_id', [
+        'cam.megapixels_main', 'cam.aperture_main', 'cam.optical_zoom_x', 'cam.video_resolution', 'cam.has_ai_enhance']),
+]
+_DEVICE_DETAIL_OFFER = ['dr.device_retailer_id', 'r.name', 'r.website', 'dr.price', 'dr.in_stock', 'dr.last_updated']
+_DEVICE_DETAIL_COLUMNS = ", ".join(col for _, flag, cols in _DEVICE_DETAIL_PARTS for col in [flag] + cols)
+_DEVICE_DETAIL_JOINS = """
+    FROM devices d
+    JOIN model ml ON d.model_id = ml.model_id
+    JOIN categories c ON d.category_id = c.category_id
+    JOIN manufacturers m ON d.manufacturer_id = m.manufacturer_id
+    LEFT JOIN color col ON d.color_id = col.color_id
+    LEFT JOIN operating_systems osys ON d.os_id = osys.os_id
+    LEFT JOIN os_name osn ON osys.os_name_id = osn.os_name_id
+    LEFT JOIN displays disp ON disp.device_id = d.device_id
+    LEFT JOIN techn_matr tm ON disp.techn_matr_id = tm.techn_matr_id
+    LEFT JOIN specifications s ON s.device_id = d.device_id
+    LEFT JOIN proc_model pm ON s.proc_model_id = pm.proc_model_id
+    LEFT JOIN storage_type st ON s.storage_type_id = st.storage_type_id
+    LEFT JOIN batteries b ON b.device_id = d.device_id
+    LEFT JOIN cameras cam ON cam.device_id = d.device_id
+"""
+# сначала в наличии и по цене — первое в наличии и есть лучшее
+_DEVICE_OFFER_ORDER = "CASE WHEN dr.in_stock THEN 0 ELSE 1 END, dr.price, dr.device_retailer_id"
+# предложения продавцов (1:N) присоединяются последними: строка на предложение
+_DEVICE_DETAIL_SQL = "SELECT " + _DEVICE_DETAIL_COLUMNS + ", " + ", ".join(_DEVICE_DETAIL_OFFER) + \
+    _DEVICE_DETAIL_JOINS + f"""
+    LEFT JOIN device_retailers dr ON dr.device_id = d.device_id
+    LEFT JOIN retailers r ON dr.retailer_id = r.retailer_id
+    WHERE d.device_id = %s
+    ORDER BY {_DEVICE_OFFER_ORDER}
+"""
+DEVICE_DETAIL_TABLES = {
+    'devices', 'specifications', 'displays', 'cameras', 'batteries', 'device_retailers',
+}
+
+class DeviceDetail:
+    """Карточка устройства целиком: части как кортежи (или None) и предложения продавцов."""
+    __slots__ = ('parts', 'retailers', 'etag', 'loaded_at')
+
+    def __init__(self, parts: Dict[str, Optional[tuple]], retailers: List[tuple]):
+        self.parts = parts
+        self.retailers = retailers
+        payload = json.dumps([parts, retailers], default=str, sort_keys=True)
+        self.etag = hashlib.sha1(payload.encode()).hexdigest()[:20]
+        self.loaded_at = time.monotonic()
+
+def _detail_parts(row) -> Tuple[Dict[str, Optional[tuple]], int]:
+    """Части карточки из строки _DEVICE_DETAIL_COLUMNS; вторым — позиция за ними."""
+    parts: Dict[str, Optional[tuple]] = {}
+    pos = 0
+    for name, _, cols in _DEVICE_DETAIL_PARTS:
+        present = row[pos] is not None
+        parts[name] = tuple(row[pos + 1:pos + 1 + len(cols)]) if present else None
+        pos += 1 + len(cols)
+    return parts, pos
+
+def load_device_detail(conn, device_id: int) -> Optional[DeviceDetail]:
+    """Карточка одним запросом; None — устройства нет."""
+    cur = tup_cur(conn)
+    cur.execute(_DEVICE_DETAIL_SQL, (device_id,))
+    rows = cur.fetchall()
+    if not rows:
+        return None
+    parts, pos = _detail_parts(rows[0])
+    # без device_retailer_id — в шаблон идут (name, website, price, in_stock, last_updated)
+    retailers = [tuple(row[pos + 1:]) for row in rows if row[pos] is not None]
+    return DeviceDetail(parts, retailers)
+
+def load_device_details(conn, device_ids: List[int]) -> Dict[int, DeviceDetail]:
+    """
+    Карточки нескольких устройств за два запроса при любом их числе: части 1:1 одной
+    выборкой, все предложения — другой (PG — = ANY(массив), SQLite — IN (...)).
+    Нет устройства — нет и ключа в ответе.
+    """
+    ids = sorted({int(i) for i in device_ids})
+    if not ids:
+        return {}
+    if _is_sqlite_conn(conn):
+        cond, params = f"IN ({', '.join(['%s'] * len(ids))})", ids
+    else:
+        cond, params = "= ANY(%s)", [ids]
+    part_rows, offer_rows = run_queries(conn, [
+        (f"SELECT d.device_id, {_DEVICE_DETAIL_COLUMNS} {_DEVICE_DETAIL_JOINS} WHERE d.device_id {cond}", params),
+        (f"""SELECT dr.device_id, {', '.join(_DEVICE_DETAIL_OFFER[1:])}
+             FROM device_retailers dr
+             LEFT JOIN retailers r ON dr.retailer_id = r.retailer_id
+             WHERE dr.device_id {cond}
+             ORDER BY dr.device_id, {_DEVICE_OFFER_ORDER}""", params),
+    ])
+    offers: Dict[int, List[tuple]] = {}
+    for row in offer_rows:
+        offers.setdefault(row[0], []).append(tuple(row[1:]))
+    return {row[0]: DeviceDetail(_detail_parts(row[1:])[0], offers.get(row[0], [])) for row in part_rows}
+
+_DEVICE_CACHE: "OrderedDict[Tuple[str, int], DeviceDetail]" = OrderedDict()
+_DEVICE_CACHE_LOCK = threading.Lock()
+_DEVICE_CACHE_EPOCH: Dict[str, int] = {}   # backend -> число сбросов; чтение, пересёкшееся со сбросом, не кэшируется
+
+def _device_cache_epoch(backend: str) -> int:
+    with _DEVICE_CACHE_LOCK:
+        return _DEVICE_CACHE_EPOCH.get(backend, 0)
+
+def _device_cache_get(key: Tuple[str, int]) -> Optional[DeviceDetail]:
+    with _DEVICE_CACHE_LOCK:
+        item = _DEVICE_CACHE.get(key)
+        if item is not None and (not DEVICE_CACHE_TTL or time.monotonic() - item.loaded_at < DEVICE_CACHE_TTL):
+            _DEVICE_CACHE.move_to_end(key)
+            return item
+    return None
+
+def _device_cache_put(key: Tuple[str, int], item: DeviceDetail, epoch: int):
+    if DEVICE_CACHE_SIZE <= 0:
+        return
+    with _DEVICE_CACHE_LOCK:
+        if _DEVICE_CACHE_EPOCH.get(key[0], 0) != epoch:
+            return
+        _DEVICE_CACHE[key] = item
+        _DEVICE_CACHE.move_to_end(key)
+        while len(_DEVICE_CACHE) > DEVICE_CACHE_SIZE:
+            _DEVICE_CACHE.popitem(last=False)
+
+def device_detail_cached(device_id: int) -> Optional[DeviceDetail]:
+    """Карточка из памяти (LRU на DEVICE_CACHE_SIZE устройств), иначе из БД."""
+    key = (current_backend(), device_id)
+    item = _device_cache_get(key)
+    if item is not None:
+        return item
+    epoch = _device_cache_epoch(key[0])
     with get_conn() as conn:
-        cur = tup_cur(conn)
-        cur.execute("""
-            SELECT d.device_id, ml.name as model, c.name as category, m.name as manufacturer
-            FROM devices d
-            JOIN model ml ON d.model_id = ml.model_id
-            JOIN categories c ON d.category_id = c.category_id
-            JOIN manufacturers m ON d.manufacturer_id = m.manufacturer_id
-            ORDER BY d.device_id
-        """)
-        devices = cur.fetchall()
-    return render_template("all_devices.html", devices=devices)
+        item = load_device_detail(conn, device_id)
+    if item is not None:
+        _device_cache_put(key, item, epoch)
+    return item
+
+def device_details_cached(device_ids: List[int]) -> Dict[int, DeviceDetail]:
+    """Несколько карточек: что есть в памяти — оттуда, остальные — load_device_details."""
+    backend = current_backend()
+    found: Dict[int, DeviceDetail] = {}
+    for device_id in device_ids:
+        item = _device_cache_get((backend, device_id))
+        if item is not None:
+            found[device_id] = item
+    missing = [i for i in device_ids if i not in found]
+    if missing:
+        epoch = _device_cache_epoch(backend)
+        with get_conn() as conn:
+            loaded = load_device_details(conn, missing)
+        for device_id, item in loaded.items():
+            _device_cache_put((backend, device_id), item, epoch)
+        found.update(loaded)
+    return found
+
+@on_data_change
+def _device_cache_on_change(conn, table_name, device_ids):
+    backend = _conn_backend(conn)
+    after_commit(conn, lambda: _device_cache_drop(backend, table_name, device_ids))
+
+def _device_cache_drop(backend: str, table_name: str, device_ids: Optional[List[int]]):
+    with _DEVICE_CACHE_LOCK:
+        _DEVICE_CACHE_EPOCH[backend] = _DEVICE_CACHE_EPOCH.get(backend, 0) + 1
+        if table_name in DEVICE_DETAIL_TABLES and device_ids is not None:
+            for device_id in device_ids:
+                _DEVICE_CACHE.pop((backend, int(device_id)), None)
+        else:
+            # справочники видны в карточке по имени — проще сбросить всё
+            for key in [k for k in _DEVICE_CACHE if k[0] == backend]:
+                del _DEVICE_CACHE[key]
 
-@app.route('/device/<int:device_id>')
-def device_detail(device_id):
+# -------------------------------------------------
+# Сравнение устройств
+# -------------------------------------------------
+# /compare?ids=1,2,3 и /api/compare: карточки берутся из кэша, недостающие — одной
+# пачкой (load_device_details), так что 20 устройств стоят столько же запросов, сколько 2.
+# Ответ — по столбцам: для каждого поля список значений в порядке ids.
+COMPARE_MAX_DEVICES = env_int("COMPARE_MAX_DEVICES", 50)
+
+# ключи и подписи столбцов _DEVICE_DETAIL_PARTS, в том же порядке
+COMPARE_FIELDS: Dict[str, List[Tuple[str, str]]] = {
+    'main': [('model', 'Модель'), ('category', 'Категория'), ('manufacturer', 'Производитель'),
+             ('release_date', 'Дата выпуска'), ('current_price', 'Цена'),
+             ('is_waterproof', 'Водонепроницаемость'), ('warranty_months', 'Гарантия (мес)'), ('color', 'Цвет')],
+    'os_info': [('os', 'Название'), ('os_developer', 'Разработчик'), ('os_version', 'Версия'),
+                ('os_release_date', 'Дата релиза')],
+    'display': [('diagonal_inches', 'Диагональ, дюймов'), ('resolution', 'Разрешение'), ('matrix', 'Тип матрицы'),
+                ('refresh_rate_hz', 'Частота обновления, Гц'), ('brightness_nits', 'Яркость, нит')],
+    'specs': [('processor', 'Модель процессора'), ('processor_cores', 'Ядер'), ('ram_gb', 'RAM, Гб'),
+              ('storage_gb', 'Память, Гб'), ('storage_type', 'Тип накопителя')],
+    'battery': [('capacity_mah', 'Ёмкость, мАч'), ('fast_charging_w', 'Быстрая зарядка, Вт'),
+                ('wireless_charging', 'Беспроводная зарядка'), ('estimated_life_hours', 'Время работы, ч')],
+    'camera': [('megapixels_main', 'Мегапиксели'), ('aperture_main', 'Диафрагма'), ('optical_zoom_x', 'Зум, x'),
+               ('video_resolution', 'Видео'), ('has_ai_enhance', 'ИИ-улучшение')],
+    'offers': [('best_price', 'Лучшая цена'), ('best_retailer', 'Продавец'),
+               ('offer_count', 'Предложений'), ('in_stock_count', 'В наличии у')],
+}
+COMPARE_PART_TITLES = {
+    'main': 'Основная информация', 'os_info': 'Операционная система', 'display': 'Дисплей',
+    'specs': 'Технические характеристики', 'battery': 'Батарея', 'camera': 'Камера', 'offers': 'Где купить',
+}
+COMPARE_FLAGS = {'is_waterproof', 'wireless_charging', 'has_ai_enhance'}
+
+def parse_compare_ids(value: Optional[str]) -> List[int]:
+    """?ids=1,2,3 -> [1, 2, 3]: без повторов, в порядке запроса, не больше COMPARE_MAX_DEVICES."""
+    ids: List[int] = []
+    for part in (value or '').replace(' ', ',').split(','):
+        if part.strip().isdigit() and int(part) not in ids:
+            ids.append(int(part))
+    return ids[:COMPARE_MAX_DEVICES]
+
+def _offer_summary(retailers: List[tuple]) -> Dict[str, Any]:
+    """Сводка предложений карточки (они уже отсортированы: первое в наличии — лучшее)."""
+    best = retailers[0] if retailers and retailers[0][3] else None
+    return {
+        'best_price': json_cell(best[2]) if best else None,
+        'best_retailer': best[0] if best else None,
+        'offer_count': len(retailers),
+        'in_stock_count': sum(1 for r in retailers if r[3]),
+    }
+
+def compare_payload(device_ids: List[int]) -> Dict[str, Any]:
+    """Сравнение по столбцам: fields [{part, key, label, values, same}] и offers — списки по устройствам."""
+    details = device_details_cached(device_ids)
+    ids = [i for i in device_ids if i in details]
+    summaries = [_offer_summary(details[i].retailers) for i in ids]
+    fields = []
+    for part, columns in COMPARE_FIELDS.items():
+        for pos, (key, label) in enumerate(columns):
+            if part == 'offers':
+                values = [s[key] for s in summaries]
+            else:
+                values = [json_cell(details[i].parts[part][pos]) if details[i].parts[part] else None for i in ids]
+            if key in COMPARE_FLAGS:
+                values = [None if v is None else bool(v) for v in values]
+            fields.append({'part': part, 'key': key, 'label': label, 'values': values,
+                           'same': all(v == values[0] for v in values)})
+    offer_keys = ('retailer', 'website', 'price', 'in_stock', 'last_updated')
+    return {
+        'ids': ids,
+        'missing': [i for i in device_ids if i not in details],
+        'fields': fields,
+        'offers': [[dict(zip(offer_keys, map(json_cell, r)), in_stock=bool(r[3])) for r in details[i].retailers]
+                   for i in ids],
+    }
+
+@app.route('/compare')
+def compare():
+    ids = parse_compare_ids(request.args.get('ids'))
+    payload = compare_payload(ids) if ids else None
+    return render_template('compare.html', ids=ids, payload=payload, titles=COMPARE_PART_TITLES,
+                           max_devices=COMPARE_MAX_DEVICES)
+
+@app.route('/api/compare')
+def api_compare():
+    """Сравнение устройств: ?ids=1,2,3 (до COMPARE_MAX_DEVICES); ответ — compare_payload()."""
+    ids = parse_compare_ids(request.args.get('ids'))
+    if not ids:
+        return jsonify({'ok': False, 'reason': 'no_ids'}), 400
+    return jsonify(compare_payload(ids))
+
+# -------------------------------------------------
+# Похожие устройства: kNN по числовым характеристикам (NumPy)
+# -------------------------------------------------
+# Векторы характеристик всех устройств лежат в памяти матрицей NumPy. Строки
+# меняются на месте по уведомлениям об изменениях (как индекс цен), нормированная
+# матрица пересчитывается целиком — векторно — при первом запросе после изменений.
+# Без numpy функция выключена: /api/device/<id>/similar отвечает 503.
+SIMILAR_K = 6
+SIMILAR_K_MAX = 50
+SIMILAR_INDEX_MAX_AGE = env_int("SIMILAR_INDEX_MAX_AGE", 300)   # 0 — только по уведомлениям
+SIMILAR_TABLES = {'devices', 'specifications', 'displays', 'cameras', 'batteries'}
+
+# (признак, столбец, вес, логарифмировать) — у цены, памяти и ёмкости «длинный хвост»
+SIMILAR_FEATURES = [
+    ('current_price',   'd.current_price',      2.0, True),
+    ('weight_grams',    'd.weight_grams',       1.0, False),
+    ('ram_gb',          's.ram_gb',             1.0, True),
+    ('storage_gb',      's.storage_gb',         1.0, True),
+    ('processor_cores', 's.processor_cores',    1.0, False),
+    ('diagonal_inches', 'disp.diagonal_inches', 1.5, False),
+    ('refresh_rate_hz', 'disp.refresh_rate_hz', 1.0, False),
+    ('brightness_nits', 'disp.brightness_nits', 1.0, False),
+    ('megapixels_main', 'cam.megapixels_main',  1.0, False),
+    ('optical_zoom_x',  'cam.optical_zoom_x',   1.0, False),
+    ('capacity_mah',    'b.capacity_mah',       1.0, True),
+    ('fast_charging_w', 'b.fast_charging_w',    1.0, False),
+]
+_SIMILAR_SQL = "SELECT d.device_id, d.category_id, " + ", ".join(col for _, col, _, _ in SIMILAR_FEATURES) + """
+    FROM devices d
+    LEFT JOIN specifications s ON s.device_id = d.device_id
+    LEFT JOIN displays disp ON disp.device_id = d.device_id
+    LEFT JOIN cameras cam ON cam.device_id = d.device_id
+    LEFT JOIN batteries b ON b.device_id = d.device_id
+"""
+
+def _feature_value(value) -> float:
+    return float('nan') if value is None else float(value)
+
+class SimilarIndex:
+    def __init__(self):
+        width = len(SIMILAR_FEATURES)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.categories = np.empty(0, dtype=np.int64)
+        self.raw = np.empty((0, width))          # сырые значения, NaN — нет данных
+        self.size = 0                            # занятые строки; дальше — запас под новые
+        self.pos: Dict[int, int] = {}            # device_id -> строка
+        self.weights = np.array([w for _, _, w, _ in SIMILAR_FEATURES])
+        self.log_cols = np.array([log for _, _, _, log in SIMILAR_FEATURES])
+        self._norm = None
+        self.built_at = time.monotonic()
+
+    @staticmethod
+    def queries(device_ids: Optional[List[int]] = None) -> List[Tuple[str, List[Any]]]:
+        if device_ids is None:
+            return [(_SIMILAR_SQL, [])]
+        return [(_SIMILAR_SQL + f" WHERE d.device_id IN ({', '.join(['%s'] * len(device_ids))})", list(device_ids))]
+
+    def _remove(self, device_id: int):
+        """Удаление переносом последней строки на место удалённой."""
+        i = self.pos.pop(device_id, None)
+        if i is None:
+            return
+        last = self.size - 1
+        if i != last:
+            self.ids[i], self.categories[i], self.raw[i] = self.ids[last], self.categories[last], self.raw[last]
+            self.pos[int(self.ids[i])] = i
+        self.size = last
+
+    def _put(self, row):
+        if self.size == len(self.ids):
+            capacity = max(16, 2 * self.size)
+            self.ids = np.resize(self.ids, capacity)
+            self.categories = np.resize(self.categories, capacity)
+            raw = np.full((capacity, self.raw.shape[1]), np.nan)
+            raw[:self.size] = self.raw[:self.size]
+            self.raw = raw
+        i = self.size
+        self.ids[i] = row[0]
+        self.categories[i] = -1 if row[1] is None else row[1]
+        self.raw[i] = [_feature_value(v) for v in row[2:]]
+        self.pos[int(row[0])] = i
+        self.size += 1
+
+    def apply_rows(self, rows, device_ids: Optional[List[int]] = None):
+        """Загрузить всё (device_ids=None) или заменить векторы перечисленных устройств."""
+        if device_ids is None:
+            rows = list(rows)
+            self.ids = np.array([r[0] for r in rows], dtype=np.int64)
+            self.categories = np.array([-1 if r[1] is None else r[1] for r in rows], dtype=np.int64)
+            self.raw = np.array([[_feature_value(v) for v in r[2:]] for r in rows],
+                                dtype=float).reshape(len(rows), len(SIMILAR_FEATURES))
+            self.size = len(rows)
+            self.pos = {int(device_id): i for i, device_id in enumerate(self.ids)}
+            self.built_at = time.monotonic()
+        else:
+            for device_id in device_ids:
+                self._remove(int(device_id))
+            for row in rows:
+                self._put(row)
+        self._norm = None
+
+    def matrix(self):
+        """
+        Нормированные векторы: log1p для «длинных хвостов», z-оценка по столбцу
+        (среднее и разброс — по известным значениям), пропуск — 0 (среднее), затем веса.
+        """
+        if self._norm is None:
+            x = self.raw[:self.size].copy()
+            x[:, self.log_cols] = np.log1p(np.clip(x[:, self.log_cols], 0, None))
+            known = ~np.isnan(x)
+            count = np.maximum(known.sum(axis=0), 1)
+            mean = np.where(known, x, 0.0).sum(axis=0) / count
+            std = np.sqrt(np.where(known, (x - mean) ** 2, 0.0).sum(axis=0) / count)
+            std[std == 0] = 1.0
+            z = np.where(known, (x - mean) / std, 0.0)
+            self._norm = z * self.weights
+        return self._norm
+
+    def nearest(self, device_id: int, k: int, same_category: bool = True) -> Optional[List[Tuple[int, float]]]:
+        """
+        k ближайших (device_id, расстояние) по евклидовой метрике; сравниваются только
+        признаки, известные у самого устройства. None — устройства нет в индексе.
+        """
+        i = self.pos.get(device_id)
+        if i is None:
+            return None
+        z = self.matrix()
+        cols = ~np.isnan(self.raw[i])
+        diff = z[:, cols] - z[i, cols]
+        dist = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+        dist[i] = np.inf
+        if same_category:
+            dist[self.categories[:self.size] != self.categories[i]] = np.inf
+        k = min(k, int(np.isfinite(dist).sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(dist, k - 1)[:k]
+        top = top[np.argsort(dist[top], kind='stable')]
+        return [(int(self.ids[j]), float(dist[j])) for j in top]
+
+_SIMILAR_INDEX: Dict[str, SimilarIndex] = {}
+_SIMILAR_PENDING: Dict[str, Optional[set]] = {}
+_SIMILAR_LOCK = threading.Lock()
+
+@on_data_change
+def _similar_on_change(conn, table_name, device_ids):
+    if np is None or table_name not in SIMILAR_TABLES:
+        return
+    backend = _conn_backend(conn)
+    ids = None if device_ids is None else {int(i) for i in device_ids}
+    after_commit(conn, lambda: _similar_queue(backend, ids))
+
+def _similar_queue(backend: str, device_ids: Optional[set]):
+    # после commit: запрос до него забрал бы id и перечитал старые строки
+    with _SIMILAR_LOCK:
+        pending = _SIMILAR_PENDING.get(backend, set())
+        _SIMILAR_PENDING[backend] = None if device_ids is None or pending is None else pending | device_ids
+
+def similar_pending(backend: str) -> Optional[List[int]]:
+    """Что обновить в индексе: [] — ничего, список id — эти устройства, None — всё."""
+    with _SIMILAR_LOCK:
+        index = _SIMILAR_INDEX.get(backend)
+        pending = _SIMILAR_PENDING.pop(backend, set())
+    if index is None or pending is None or (SIMILAR_INDEX_MAX_AGE and time.monotonic() - index.built_at > SIMILAR_INDEX_MAX_AGE):
+        return None
+    return sorted(pending)
+
+def similar_apply(backend: str, rows, device_ids: Optional[List[int]]):
+    if device_ids is None:
+        # полная сборка матрицы — без блокировки, под ней только подмена
+        index = SimilarIndex()
+        index.apply_rows(rows, None)
+        with _SIMILAR_LOCK:
+            _SIMILAR_INDEX[backend] = index
+        return
+    with _SIMILAR_LOCK:
+        _SIMILAR_INDEX[backend].apply_rows(rows, device_ids)
+
+@contextmanager
+def similar_index(conn):
+    """Индекс похожих устройств бэкенда этого соединения, под блокировкой на время чтения."""
+    backend = _conn_backend(conn)
+    device_ids = similar_pending(backend)
+    if device_ids != []:
+        similar_apply(backend, run_queries(conn, SimilarIndex.queries(device_ids))[0], device_ids)
+    with _SIMILAR_LOCK:
+        yield _SIMILAR_INDEX[backend]
+
+@app.route('/api/device/<int:device_id>/similar')
+def api_similar_devices(device_id):
+    """
+    Похожие устройства: ?k=<до 50>&any_category=1 (по умолчанию — только той же категории).
+    items — по возрастанию расстояния: device_id, model, manufacturer, category, current_price, distance.
+    """
+    if np is None:
+        return jsonify({'ok': False, 'reason': 'numpy_missing'}), 503
+    k = max(1, min(request.args.get('k', SIMILAR_K, type=int), SIMILAR_K_MAX))
+    same_category = request.args.get('any_category') != '1'
     with get_conn() as conn:
-        cur = tup_cur(conn)
-        cur.execute("""
-            SELECT ml.name as model, c.name as category, m.name as manufacturer, d.release_date,
-                   d.current_price, d.is_waterproof, d.warranty_months, col.name as color
-            FROM devices d
-            JOIN model ml ON d.model_id = ml.model_id
-            JOIN categories c ON d.category_id = c.category_id
-            JOIN manufacturers m ON d.manufacturer_id = m.manufacturer_id
-            JOIN color col ON d.color_id = col.color_id
-            WHERE d.device_id = %s
-        """, (device_id,))
-        main = cur.fetchone()
+        with similar_index(conn) as index:
+            found = index.nearest(device_id, k, same_category)
+        if found is None:
+            return jsonify({'ok': False, 'reason': 'not_found'}), 404
+        names = {}
+        if found:
+            ids = [device_id for device_id, _ in found]
+            cur = tup_cur(conn)
+            cur.execute(f"SELECT device_id, model, manufacturer, category, current_price FROM device_search "
+                        f"WHERE device_id IN ({', '.join(['%s'] * len(ids))})", ids)
+            names = {row[0]: row[1:] for row in cur.fetchall()}
+    items = []
+    for other_id, distance in found:
+        model, manufacturer, category, price = names.get(other_id, (None, None, None, None))
+        items.append({'device_id': other_id, 'model': model, 'manufacturer': manufacturer, 'category': category,
+                      'current_price': json_cell(price), 'distance': round(distance, 4)})
+    return jsonify({'device_id': device_id, 'features': [name for name, _, _, _ in SIMILAR_FEATURES],
+                    'items': items})
 
-        cur.execute("""
-            SELECT r.name, r.website, dr.price, dr.in_stock, dr.last_updated
-            FROM device_retailers dr
-            JOIN retailers r ON dr.retailer_id = r.retailer_id
-            WHERE dr.device_id = %s
-        """, (device_id,))
-        retailers = cur.fetchall()
+# -------------------------------------------------
+# CRUD устройств и таблиц
+# -------------------------------------------------
+@app.route('/add_device', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def add_device():
+    min_date = '1990-01-01'
+    today = _Date.today().isoformat()
+
+    if request.method == 'POST':
+        timer = PhaseTimer()
+        with timer.phase('validate'):
+            plan, error = parse_device_form(request.form, today)
+        if error:
+            flash(error, 'danger')
+            return redirect(url_for('add_device'))
+
+        try:
+            with timer.phase('total_db'):
+                with get_conn() as conn:
+                    device_id = insert_device_bundle(conn, plan, current_user.id, timer)
+                    with timer.phase('commit'):
+                        conn.commit()
+        except (sqlite3.Error, psycopg2.Error) as e:
+            # транзакция откатана целиком — «половины» устройства в БД нет
+            flash(f'Устройство не сохранено: {e}', 'danger')
+            return redirect(url_for('add_device'))
+        app.logger.debug("add_device %s: %s", device_id, timer.header())
+
+        flash('Устройство добавлено.', 'success')
+        resp = redirect(url_for('device_detail', device_id=device_id, added=1))
+        resp.headers['Server-Timing'] = timer.header()
+        return resp
+
+    # GET — форма; справочники (и для "доп. характеристик") берём из кэша
+    return render_reference_form('add_device.html', [
+        'manufacturers', 'categories', 'operating_systems', 'models', 'colors',
+        'proc_models', 'storage_types', 'techn_matrices', 'retailers', 'aperture_main',
+    ], min_date=min_date, max_date=today, today=today)
+
+
+DEVICE_LIST_SELECT = """
+    SELECT d.device_id, ml.name as model, c.name as category, m.name as manufacturer
+    FROM devices d
+    JOIN model ml ON d.model_id = ml.model_id
+    JOIN categories c ON d.category_id = c.category_id
+    JOIN manufacturers m ON d.manufacturer_id = m.manufacturer_id
+"""
+DEVICE_LIST_FIELDS = ('device_id', 'model', 'category', 'manufacturer')
+DEVICE_COUNT_TTL = env_int("DEVICE_COUNT_TTL", 60)
+_DEVICE_COUNT: Dict[str, Tuple[int, float]] = {}   # backend -> (число устройств, когда посчитано)
+
+def device_list_total(conn) -> int:
+    """Число устройств в списке /all_devices; COUNT(*) не чаще раза в DEVICE_COUNT_TTL секунд."""
+    backend = _conn_backend(conn)
+    cached = _DEVICE_COUNT.get(backend)
+    if cached is not None and time.monotonic() - cached[1] < DEVICE_COUNT_TTL:
+        return cached[0]
+    cur = tup_cur(conn)
+    cur.execute(f"SELECT COUNT(*) FROM ({DEVICE_LIST_SELECT}) t")
+    total = int(cur.fetchone()[0] or 0)
+    _DEVICE_COUNT[backend] = (total, time.monotonic())
+    return total
+
+@on_data_change
+def _device_count_on_change(conn, table_name, device_ids):
+    if table_name in ('devices', 'model', 'categories', 'manufacturers'):
+        backend = _conn_backend(conn)
+        after_commit(conn, lambda: _DEVICE_COUNT.pop(backend, None))
+
+def _device_item(row) -> Dict[str, Any]:
+    return dict(zip(DEVICE_LIST_FIELDS, row))
+
+def _device_list_page(backend: str, limit: int, after: Optional[List[Any]], row_fn=None) -> KeysetPage:
+    sql, params = keyset_sql(DEVICE_LIST_SELECT, 'd.device_id', 'd.device_id', False, after, limit)
+    return KeysetPage(backend, sql, params, limit, [0], row_fn=row_fn)
 
-        cur.execute("""
-            SELECT osn.name, osys.developer, osys.latest_version, osys.release_date
-            FROM devices d
-            JOIN operating_systems osys ON d.os_id = osys.os_id
-            JOIN os_name osn ON osys.os_name_id = osn.os_name_id
-            WHERE d.device_id = %s
-        """, (device_id,))
-        os_info = cur.fetchone()
+@app.route('/all_devices')
+def all_devices():
+    backend = current_backend()
+    limit = page_limit(request.args.get('limit'))
+    try:
+        page_no = max(1, int(request.args.get('page', 1)))
+    except ValueError:
+        page_no = 1
+    with get_conn() as conn:
+        total = device_list_total(conn)
+    devices = _device_list_page(backend, limit, decode_page_cursor(request.args.get('after')))
+    get_flashed_messages(with_categories=True)
+    return stream_template("all_devices.html", devices=devices, total=total, limit=limit,
+                           page=page_no, pages=max(1, -(-total // limit)))
+
+@app.route('/api/devices')
+def api_devices():
+    """
+    Список устройств страницами по device_id: ?limit=&after=<курсор>.
+    JSON — {total, devices, next_after}; ?format=ndjson (или Accept: application/x-ndjson) —
+    по строке на устройство, последней строкой {"next_after": ...}, если есть продолжение.
+    """
+    backend = current_backend()
+    limit = page_limit(request.args.get('limit'))
+    after = decode_page_cursor(request.args.get('after'))
 
-        cur.execute("""
-            SELECT disp.diagonal_inches, disp.resolution, tm.name as matrix_type,
-                   disp.refresh_rate_hz, disp.brightness_nits
-            FROM displays disp
-            JOIN techn_matr tm ON disp.techn_matr_id = tm.techn_matr_id
-            WHERE disp.device_id = %s
-        """, (device_id,))
-        display = cur.fetchone()
+    if (request.args.get('format') == 'ndjson'
+            or request.accept_mimetypes.best == 'application/x-ndjson'):
+        devices = _device_list_page(backend, limit, after, row_fn=_device_item)
 
-        cur.execute("""
-            SELECT pm.name as proc_model, s.processor_cores, s.ram_gb, s.storage_gb, st.name as storage_type
-            FROM specifications s
-            JOIN proc_model pm ON s.proc_model_id = pm.proc_model_id
-            JOIN storage_type st ON s.storage_type_id = st.storage_type_id
-            WHERE s.device_id = %s
-        """, (device_id,))
-        specs = cur.fetchone()
+        def generate():
+            for item in devices:
+                yield json.dumps(item, ensure_ascii=False) + "\n"
+            if devices.next_cursor:
+                yield json.dumps({'next_after': devices.next_cursor}) + "\n"
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
-        cur.execute("""
-            SELECT capacity_mah, fast_charging_w, wireless_charging, estimated_life_hours
-            FROM batteries
-            WHERE device_id = %s
-        """, (device_id,))
-        battery = cur.fetchone()
+    with get_conn() as conn:
+        total = device_list_total(conn)
+    devices = _device_list_page(backend, limit, after, row_fn=_device_item)
+    items = list(devices)
+    return jsonify({'total': total, 'limit': limit, 'devices': items,
+                    'next_after': devices.next_cursor})
 
-        cur.execute("""
-            SELECT megapixels_main, aperture_main, optical_zoom_x, video_resolution, has_ai_enhance
-            FROM cameras
-            WHERE device_id = %s
-        """, (device_id,))
-        camera = cur.fetchone()
+@app.route('/device/<int:device_id>')
+def device_detail(device_id):
+    detail = device_detail_cached(device_id)
+    if detail is None:
+        abort(404)
 
     if request.args.get('added'):
         flash('Устройство добавлено', 'success')
 
-    return render_template("device_detail.html",
-                           device_id=device_id,
-                           main=main,
-                           retailers=retailers,
-                           os_info=os_info,
-                           display=display,
-                           specs=specs,
-                           battery=battery,
-                           camera=camera)
+    # HTML зависит ещё от пользователя (кнопки админа) и адреса (embedded)
+    etag = hashlib.sha1("|".join([
+        detail.etag, current_backend(), request.full_path,
+        str(current_user.get_id() if current_user.is_authenticated else ''),
+        str(getattr(current_user, 'is_admin', False)),
+    ]).encode()).hexdigest()[:20]
+    cacheable = not session.get('_flashes')
+    if cacheable and etag in request.if_none_match:
+        resp = Response(status=304)
+    else:
+        resp = make_response(render_template("device_detail.html",
+                                             device_id=device_id,
+                                             retailers=detail.retailers,
+                                             **detail.parts))
+    if cacheable:
+        # только ETag: Last-Modified по дате предложений не видит правок характеристик
+        # и смен цены в тот же день — If-Modified-Since отдавал бы старую карточку
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
 
 @app.route('/tables_list')
 def tables_list():
@@ -880,40 +3195,91 @@ def tables_list():
         tables = [t for t in tables if t.lower() != 'users']
     return render_template('table_list.html', tables=tables)
 
+DICTIONARY_TABLES = {
+    'categories','manufacturers','retailers','color', 'model',
+    'country','os_name','proc_model','storage_type','techn_matr'
+}
+
+def _table_page_request(conn, table_name: str):
+    """
+    Разбор параметров страницы таблицы: ?limit=&sort=&dir=asc|desc&after=<курсор>.
+    Возвращает None, если таблицы нет.
+    """
+    if table_name not in list_user_tables(conn):
+        return None
+    columns = columns_for_table(conn, table_name)
+    pk_name = get_pk_name(conn, table_name) or (columns[0] if columns else None)
+    sort = request.args.get('sort') or pk_name
+    if sort not in columns:
+        sort = pk_name
+    desc = (request.args.get('dir') or '').lower() == 'desc'
+    limit = page_limit(request.args.get('limit'))
+    after = decode_page_cursor(request.args.get('after'))
+    sql, params = keyset_sql(f"SELECT * FROM {table_name}", sort, pk_name, desc, after, limit)
+    key_idx = [columns.index(pk_name)] if sort == pk_name else [columns.index(sort), columns.index(pk_name)]
+    return {
+        'columns': columns, 'pk_name': pk_name, 'sort': sort, 'desc': desc,
+        'limit': limit, 'after': after, 'sql': sql, 'params': params, 'key_idx': key_idx,
+    }
+
+def _can_view_table(table_name: str) -> bool:
+    return table_name.lower() != 'users' or (current_user.is_authenticated and current_user.username == SUPERADMIN_USERNAME)
+
 @app.route('/table/<table_name>')
 def table_view(table_name):
-    if table_name.lower() == 'users' and (not current_user.is_authenticated or current_user.username != SUPERADMIN_USERNAME):
+    if not _can_view_table(table_name):
         return redirect(url_for('tables_list'))
+    backend = current_backend()
     with get_conn() as conn:
-        cur = tup_cur(conn)
-        cur.execute(f"SELECT * FROM {table_name}")
-        rows = cur.fetchall()
-        columns = columns_for_table(conn, table_name)
-        pk_name = get_pk_name(conn, table_name) or (columns[0] if columns else None)
-
-        # 2) Затем выбираем строки с нужной сортировкой
-        t = table_name.lower()
-        if t == 'devices':
-            order_by = 'device_id'     # Явно по device_id
-        else:
-            order_by = pk_name         # Для прочих таблиц — по PK (если есть)
-
-        if order_by:
-            cur.execute(f"SELECT * FROM {table_name} ORDER BY {order_by}")
-        else:
-            cur.execute(f"SELECT * FROM {table_name}")
-        rows = cur.fetchall()
+        page = _table_page_request(conn, table_name)
+    if page is None:
+        abort(404)
 
-    is_dictionary = table_name in {
-        'categories','manufacturers','retailers','color', 'model',
-        'country','os_name','proc_model','storage_type','techn_matr'
-    }
-    return render_template('table_view.html',
+    rows = KeysetPage(backend, page['sql'], page['params'], page['limit'], page['key_idx'])
+    # flash-сообщения забираем из сессии до начала потока: после отправки заголовков
+    # cookie сессии уже не обновить
+    get_flashed_messages(with_categories=True)
+    return stream_template('table_view.html',
                            table=table_name,
-                           columns=columns,
+                           columns=page['columns'],
                            rows=rows,
-                           pk_name=pk_name,
-                           is_dictionary=is_dictionary)
+                           pk_name=page['pk_name'],
+                           sort=page['sort'],
+                           sort_dir='desc' if page['desc'] else 'asc',
+                           limit=page['limit'],
+                           after=request.args.get('after'),
+                           is_dictionary=table_name in DICTIONARY_TABLES)
+
+@app.route('/api/table/<table_name>')
+def api_table_page(table_name):
+    """JSON-вариант /table/<table_name>: те же limit/sort/dir/after, в ответе next_after."""
+    if not _can_view_table(table_name):
+        abort(403)
+    with get_conn() as conn:
+        page = _table_page_request(conn, table_name)
+        if page is None:
+            abort(404)
+        cur = tup_cur(conn)
+        cur.execute(page['sql'], page['params'])
+        rows = cur.fetchall()
+
+    columns = page['columns']
+    hidden = {'password_hash'}
+    if table_name.lower() == 'devices' and not (current_user.is_authenticated and getattr(current_user, 'is_admin', False)):
+        hidden.add('created_by')
+    keep = [i for i, c in enumerate(columns) if c not in hidden]
+    has_more = len(rows) > page['limit']
+    rows = rows[:page['limit']]
+    next_after = encode_page_cursor([rows[-1][i] for i in page['key_idx']]) if has_more and rows else None
+    return jsonify({
+        'table': table_name,
+        'columns': [columns[i] for i in keep],
+        'rows': [[json_cell(r[i]) for i in keep] for r in rows],
+        'sort': page['sort'],
+        'dir': 'desc' if page['desc'] else 'asc',
+        'limit': page['limit'],
+        'next_after': next_after,
+    })
 
 @app.route('/add/<table_name>', methods=['GET', 'POST'])
 @admin_required
@@ -935,27 +3301,28 @@ def add_row(table_name):
         with get_conn() as conn:
             cur = tup_cur(conn)
 
-            insert_cols = []
-            insert_vals = []
+            # поля — по данным формы (в порядке columns, кроме pk)
+            row = {col: request.form.get(col) for col in columns if col != pk_name}
 
-            # если есть явный PK — выдаём новый id и вставляем его первым
+            # если есть явный PK — id выдаёт БД (последовательность / rowid)
+            new_pk = None
             if pk_name and pk_name.endswith('_id'):
-                new_pk, _ = next_id(conn, table_name)
-                insert_cols.append(pk_name)
-                insert_vals.append(new_pk)
-
-            # остальные поля — по данным формы (в порядке columns, кроме pk)
-            for col in columns:
-                if col == pk_name:
-                    continue
-                insert_cols.append(col)
-                insert_vals.append(request.form.get(col))
-
-            placeholders = ','.join(['%s'] * len(insert_cols))
-            cur.execute(
-                f'INSERT INTO {table_name} ({",".join(insert_cols)}) VALUES ({placeholders})',
-                insert_vals
-            )
+                new_pk = insert_returning_id(conn, table_name, row, pk_name)
+            else:
+                placeholders = ','.join(['%s'] * len(row))
+                cur.execute(
+                    f'INSERT INTO {table_name} ({",".join(row)}) VALUES ({placeholders})',
+                    list(row.values())
+                )
+            if table_name.lower() == 'devices':
+                changed = [new_pk]
+            elif row.get('device_id'):
+                changed = [int(row['device_id'])]
+            elif table_name.lower() in REFERENCE_MAP:
+                changed = []   # новая строка справочника: устройств, которые на неё ссылаются, нет
+            else:
+                changed = None
+            notify_data_change(conn, table_name, changed)
             conn.commit()
 
         flash('Запись добавлена!', 'success')
@@ -1014,8 +3381,10 @@ def delete_row(table_name, pk):
             flash(f"Нельзя удалить: значение используется ({where}).", "danger")
             return redirect(url_for('table_view', table_name=table_name))
 
+        changed = referencing_device_ids(conn, table_name, pk)
         cur = tup_cur(conn)
         cur.execute(f"DELETE FROM {table_name} WHERE {pk_name} = %s", (pk,))
+        notify_data_change(conn, table_name, changed)
         conn.commit()
 
     flash("Удалено", "success")
@@ -1033,6 +3402,7 @@ def delete_device(device_id):
         cur.execute("DELETE FROM batteries WHERE device_id=%s", (device_id,))
         cur.execute("DELETE FROM device_retailers WHERE device_id=%s", (device_id,))
         cur.execute("DELETE FROM devices WHERE device_id=%s", (device_id,))
+        notify_data_change(conn, 'devices', [device_id])
         conn.commit()
     flash("Устройство и все связанные данные удалены", "success")
     return redirect(url_for('table_view', table_name='devices'))
@@ -1040,264 +3410,449 @@ def delete_device(device_id):
 # -------------------------------------------------
 # Статистика
 # -------------------------------------------------
-@app.route('/statistic', methods=['GET', 'POST'])
-def statistic():
-    info_by = request.form.get('info_by') or request.args.get('info_by') or 'category'
-    is_admin = current_user.is_authenticated and getattr(current_user, 'is_admin', False)
+# Сводка для /statistic:
+#  stat_device_facts — по строке на устройство со всем, что нужно группировкам
+#    (категория, производитель, страна, цена, есть ли в наличии); обновляется
+#    точечно при записи устройства/предложений;
+#  stat_snapshot — готовые данные страницы (JSON) и built_version — версия данных,
+#    из которых он собран. Версию увеличивает каждое изменение STATS_VERSION_TABLES:
+#    в SQLite — столбец version той же строки (писатели и так идут по одному), в PG —
+#    последовательность stat_version_seq после commit, чтобы писатели не ждали друг
+#    друга на блокировке одной строки.
+STATS_SNAPSHOT = 'statistic'
+STATS_MAX_STALENESS = env_float("STATS_MAX_STALENESS", 60.0)   # сек
+STATS_FACT_TABLES = {'devices', 'device_retailers', 'specifications'}
+# таблицы, которые читает страница: факты и справочники группировок и списков
+STATS_VERSION_TABLES = STATS_FACT_TABLES | {
+    'model', 'categories', 'manufacturers', 'country', 'retailers',
+    'operating_systems', 'os_name', 'storage_type',
+}
 
-    with get_conn() as conn:
-        cur = tup_cur(conn)
-        cur.execute("""
-            SELECT MIN(current_price), AVG(current_price), MAX(current_price)
-            FROM devices
-            WHERE current_price IS NOT NULL
+_STAT_FACTS_SELECT = """
+    SELECT d.device_id, d.category_id, d.manufacturer_id, m.country_id, d.model_id, d.current_price,
+           CASE WHEN d.is_waterproof THEN 1 ELSE 0 END,
+           CASE WHEN EXISTS (SELECT 1 FROM specifications s WHERE s.device_id = d.device_id) THEN 1 ELSE 0 END,
+           CASE WHEN EXISTS (SELECT 1 FROM device_retailers dr
+                             WHERE dr.device_id = d.device_id AND dr.in_stock) THEN 1 ELSE 0 END
+    FROM devices d
+    LEFT JOIN manufacturers m ON m.manufacturer_id = d.manufacturer_id
+"""
+
+def refresh_device_facts(conn, device_ids: Optional[List[int]] = None):
+    """Пересчитать строки stat_device_facts для устройств (None — для всех)."""
+    cur = tup_cur(conn)
+    cols = ("device_id, category_id, manufacturer_id, country_id, model_id, current_price, "
+            "is_waterproof, has_specs, in_stock_any")
+    if device_ids is None:
+        cur.execute("DELETE FROM stat_device_facts")
+        cur.execute(f"INSERT INTO stat_device_facts ({cols}) {_STAT_FACTS_SELECT}")
+        return
+    ids = sorted({int(i) for i in device_ids})
+    if not ids:
+        return
+    ph = ", ".join(['%s'] * len(ids))
+    cur.execute(f"DELETE FROM stat_device_facts WHERE device_id IN ({ph})", ids)
+    cur.execute(f"INSERT INTO stat_device_facts ({cols}) {_STAT_FACTS_SELECT} WHERE d.device_id IN ({ph})", ids)
+
+def _stats_bootstrap(conn):
+    cur = tup_cur(conn)
+    cur.execute("SELECT 1 FROM stat_snapshot WHERE name = %s", (STATS_SNAPSHOT,))
+    if cur.fetchone():
+        return
+    refresh_device_facts(conn)
+    cur.execute("INSERT INTO stat_snapshot (name, payload, built_at, version, built_version) VALUES (%s, NULL, 0, 1, 0)",
+                (STATS_SNAPSHOT,))
+
+def _stats_version_bootstrap(conn):
+    # счёт продолжается с версий stat_snapshot (снимок мог собираться по старой схеме);
+    # после setval last_value «занят», и первый же nextval его увеличит
+    if not _is_sqlite_conn(conn):
+        tup_cur(conn).execute("""
+            SELECT setval('stat_version_seq', GREATEST(
+                (SELECT last_value FROM stat_version_seq),
+                (SELECT COALESCE(MAX(GREATEST(version, built_version)), 0) FROM stat_snapshot)) + 1)
         """)
-        min_p, avg_p, max_p = cur.fetchone()
-        min_price = int(min_p or 0)
-        avg_price = int(avg_p or 0)
-        max_price = int(max_p or 0)
 
-        cur.execute("""
-            SELECT d.device_id, ml.name AS model, d.current_price
-            FROM devices d
-            JOIN model ml ON d.model_id = ml.model_id
-            WHERE current_price IS NOT NULL
-            ORDER BY current_price ASC
-            LIMIT 5
-        """)
-        cheapest = cur.fetchall()
+register_aux_schema(
+    ['stat_device_facts', 'stat_snapshot'],
+    [
+        """CREATE TABLE IF NOT EXISTS stat_device_facts (
+               device_id       integer PRIMARY KEY,
+               category_id     integer,
+               manufacturer_id integer,
+               country_id      integer,
+               model_id        integer,
+               current_price   integer,
+               is_waterproof   smallint NOT NULL DEFAULT 0,
+               has_specs       smallint NOT NULL DEFAULT 0,
+               in_stock_any    smallint NOT NULL DEFAULT 0
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_stat_facts_price ON stat_device_facts (current_price)",
+        "CREATE INDEX IF NOT EXISTS idx_stat_facts_category ON stat_device_facts (category_id, current_price)",
+        """CREATE TABLE IF NOT EXISTS stat_snapshot (
+               name          text PRIMARY KEY,
+               payload       text,
+               built_at      double precision NOT NULL DEFAULT 0,
+               version       bigint NOT NULL DEFAULT 0,
+               built_version bigint NOT NULL DEFAULT 0
+           )""",
+    ],
+    bootstrap=_stats_bootstrap,
+)
+# версия данных для PG (в SQLite — stat_snapshot.version)
+register_aux_schema([], ["CREATE SEQUENCE IF NOT EXISTS stat_version_seq"], [], bootstrap=_stats_version_bootstrap)
 
-        cur.execute("""
-            SELECT d.device_id, ml.name AS model, d.current_price
-            FROM devices d
-            JOIN model ml ON d.model_id = ml.model_id
-            WHERE current_price IS NOT NULL
-            ORDER BY current_price DESC
-            LIMIT 5
-        """)
-        expensive = cur.fetchall()
+def _bump_stats_version(conn):
+    try:
+        tup_cur(conn).execute("SELECT nextval('stat_version_seq')")
+    except psycopg2.Error as e:
+        # данные уже записаны; снимок догонит их при следующем изменении
+        app.logger.warning("stat_version_seq: %s", e)
+
+@on_data_change
+def _stats_on_change(conn, table_name, device_ids):
+    if table_name in STATS_FACT_TABLES:
+        refresh_device_facts(conn, device_ids)
+    if table_name not in STATS_VERSION_TABLES:
+        return
+    if _is_sqlite_conn(conn):
+        tup_cur(conn).execute("UPDATE stat_snapshot SET version = version + 1 WHERE name = %s", (STATS_SNAPSHOT,))
+    else:
+        after_commit(conn, lambda: _bump_stats_version(conn))
 
-        cur.execute("""
-            SELECT COUNT(*)
-            FROM devices d
-            LEFT JOIN specifications s ON s.device_id = d.device_id
-            WHERE s.device_id IS NULL
-        """)
-        devices_without_specs = cur.fetchone()[0] or 0
+def stats_version(conn) -> int:
+    """Текущая версия данных /statistic (растёт с каждым изменением STATS_VERSION_TABLES)."""
+    cur = tup_cur(conn)
+    if _is_sqlite_conn(conn):
+        cur.execute("SELECT version FROM stat_snapshot WHERE name = %s", (STATS_SNAPSHOT,))
+    else:
+        cur.execute("SELECT last_value FROM stat_version_seq")
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+def _int0(v) -> int:
+    return int(v) if v is not None else 0
+
+def _sql_statistic_summary(cur) -> Tuple[tuple, Dict[str, List[List[Any]]]]:
+    """Итоги и четыре сводки запросами GROUP BY — когда нет numpy."""
+    cur.execute("""
+        SELECT MIN(current_price), AVG(current_price), MAX(current_price),
+               SUM(1 - has_specs), SUM(1 - is_waterproof), SUM(in_stock_any)
+        FROM stat_device_facts
+    """)
+    totals = cur.fetchone()
+
+    # категории / производители / страны — одним запросом по фактам
+    cur.execute("""
+        SELECT 'category', c.name, COUNT(*), SUM(f.in_stock_any),
+               MIN(f.current_price), AVG(f.current_price), MAX(f.current_price)
+        FROM stat_device_facts f JOIN categories c ON c.category_id = f.category_id
+        GROUP BY c.category_id, c.name
+        UNION ALL
+        SELECT 'manufacturer', m.name, COUNT(*), SUM(f.in_stock_any),
+               MIN(f.current_price), AVG(f.current_price), MAX(f.current_price)
+        FROM stat_device_facts f JOIN manufacturers m ON m.manufacturer_id = f.manufacturer_id
+        GROUP BY m.manufacturer_id, m.name
+        UNION ALL
+        SELECT 'country', co.name, COUNT(*), SUM(f.in_stock_any),
+               MIN(f.current_price), AVG(f.current_price), MAX(f.current_price)
+        FROM stat_device_facts f JOIN country co ON co.country_id = f.country_id
+        GROUP BY co.country_id, co.name
+    """)
+    breakdowns: Dict[str, List[List[Any]]] = {'category': [], 'manufacturer': [], 'country': [], 'retailer': []}
+    for dim, name, cnt, in_stock, mn, av, mx in cur.fetchall():
+        breakdowns[dim].append([name, _int0(cnt), _int0(in_stock), _int0(mn), _int0(av), _int0(mx)])
+
+    # продавцы
+    cur.execute("""
+        SELECT r.name,
+               COUNT(DISTINCT dr.device_id)                                  AS devices_count,
+               COUNT(DISTINCT CASE WHEN dr.in_stock THEN dr.device_id END)   AS in_stock_devices,
+               MIN(dr.price), AVG(dr.price), MAX(dr.price)
+        FROM retailers r
+        JOIN device_retailers dr ON dr.retailer_id = r.retailer_id
+        GROUP BY r.retailer_id, r.name
+    """)
+    breakdowns['retailer'] = [[r[0], _int0(r[1]), _int0(r[2]), _int0(r[3]), _int0(r[4]), _int0(r[5])]
+                              for r in cur.fetchall()]
+    for rows in breakdowns.values():
+        rows.sort(key=lambda r: (-r[1], r[0]))
+    return totals, breakdowns
+
+def build_statistic_payload(conn) -> Dict[str, Any]:
+    """Все данные страницы /statistic; читает stat_device_facts, а не devices × device_retailers."""
+    cur = tup_cur(conn)
+    if analytics is not None:
+        frame = analytics_frame(conn)
+        totals = frame.totals()
+        breakdowns = {dim: [_breakdown_row(item) for item in analytics_breakdown(conn, frame, dim)]
+                      for dim in ANALYTICS_DIMENSIONS}
+    else:
+        totals, breakdowns = _sql_statistic_summary(cur)
+    min_p, avg_p, max_p, without_specs, without_waterproof, in_stock_devices = totals
+
+    cheap_sql = """
+        SELECT f.device_id, ml.name AS model, f.current_price
+        FROM stat_device_facts f
+        JOIN model ml ON f.model_id = ml.model_id
+        WHERE f.current_price IS NOT NULL
+        ORDER BY f.current_price {}
+        LIMIT 5
+    """
+    cur.execute(cheap_sql.format("ASC"))
+    cheapest = [list(r) for r in cur.fetchall()]
+    cur.execute(cheap_sql.format("DESC"))
+    expensive = [list(r) for r in cur.fetchall()]
+
+    # Линии цен для топ-4 категорий (не более 60 самых дешёвых точек на линию) — из индекса цен
+    category_names = dict(reference_data(['categories'], conn)['categories'])
+    with price_index(conn) as index:
+        sizes = [(cat_id, category_names.get(cat_id), len(prices))
+                 for cat_id, prices in index.sorted.items() if cat_id is not None and prices]
+        top4 = sorted((s for s in sizes if s[1] is not None), key=lambda s: (-s[2], s[1]))[:4]
+        price_lines = [{'name': name, 'prices': index.prices(cat_id)[:60]} for cat_id, name, _ in top4]
+
+    cur.execute("SELECT MIN(release_date), MAX(release_date) FROM devices")
+    release_min, release_max = cur.fetchone()
+    cur.execute("SELECT MAX(last_updated) FROM device_retailers")
+    last_update = cur.fetchone()[0]
+
+    return {
+        'min_price': _int0(min_p), 'avg_price': _int0(avg_p), 'max_price': _int0(max_p),
+        'cheapest': cheapest, 'expensive': expensive,
+        'devices_without_specs': _int0(without_specs),
+        'devices_without_waterproof': _int0(without_waterproof),
+        'in_stock_devices': _int0(in_stock_devices),
+        'release_min': str(release_min) if release_min is not None else None,
+        'release_max': str(release_max) if release_max is not None else None,
+        'last_update': str(last_update) if last_update is not None else None,
+        'breakdowns': breakdowns,
+        'price_lines': price_lines,
+        'tables_info': tables_info_for(conn),
+    }
 
-        try:
-            cur.execute("SELECT COUNT(*) FROM devices WHERE COALESCE(is_waterproof, %s) = %s", (False, False))
-            devices_without_waterproof = cur.fetchone()[0] or 0
-        except:
-            devices_without_waterproof = 0
-
-        purpose_map = {
-            'devices': 'главная',
-            'categories': 'справочник',
-            'manufacturers': 'справочник',
-            'retailers': 'справочник',
-            'color': 'справочник',
-            'country': 'справочник',
-            'os_name': 'справочник',
-            'proc_model': 'справочник',
-            'storage_type': 'справочник',
-            'techn_matr': 'справочник',
-            'model' : 'справочник',
-            'device_retailers': 'дополнительная',
-            'batteries': 'дополнительная',
-            'cameras': 'дополнительная',
-            'displays': 'дополнительная',
-            'specifications': 'дополнительная',
-            'operating_systems': 'дополнительная',
-            'users': 'дополнительная'
-        }
-        rus_desc = {
-            'batteries': 'Характеристики батареи',
-            'cameras': 'Характеристики камер',
-            'categories': 'Справочник категорий',
-            'color': 'Справочник цветов',
-            'country': 'Справочник стран',
-            'device_retailers': 'Цены/наличие у продавцов',
-            'devices': 'Устройства (основная)',
-            'displays': 'Характеристики дисплея',
-            'manufacturers': 'Справочник производителей',
-            'operating_systems': 'Версии ОС для устройств',
-            'os_name': 'Справочник названий ОС',
-            'proc_model': 'Модели процессоров',
-            'retailers': 'Справочник продавцов',
-            'specifications': 'Прочие характеристики',
-            'storage_type': 'Типы накопителей',
-            'techn_matr': 'Типы матрицы дисплея',
-            'model' : 'Справочник моделей устройств',
-            'users': 'Пользователи системы'
+# -------------------------------------------------
+# Сводки /statistic по столбцам NumPy
+# -------------------------------------------------
+# Факты устройств (и предложения продавцов) читаются двумя запросами в столбцы NumPy,
+# все группировки и процентили считаются по ним (analytics.group_stats). Столбцы
+# держатся в памяти до следующего изменения данных — ключ кэша stats_version().
+# Новое измерение — столбец в _ANALYTICS_FACTS_SQL и строка в ANALYTICS_DIMENSIONS.
+ANALYTICS_PERCENTILES = (0.25, 0.5, 0.75)
+
+# измерение -> (подпись, справочник из REFERENCE_SETS для названий; None — ключ и есть название)
+ANALYTICS_DIMENSIONS: Dict[str, Tuple[str, Optional[str]]] = {
+    'category':     ('Категория', 'categories'),
+    'manufacturer': ('Производитель', 'manufacturers'),
+    'retailer':     ('Продавец', 'retailers'),
+    'country':      ('Страна', 'countries'),
+    'os':           ('ОС', 'operating_systems'),
+    'storage_type': ('Тип накопителя', 'storage_types'),
+    'year':         ('Год выпуска', None),
+}
+_ANALYTICS_FACTS_SQL = """
+    SELECT f.device_id, f.category_id, f.manufacturer_id, f.country_id, d.os_id, s.storage_type_id,
+           d.release_date, f.current_price, f.in_stock_any, f.has_specs, f.is_waterproof
+    FROM stat_device_facts f
+    JOIN devices d ON d.device_id = f.device_id
+    LEFT JOIN specifications s ON s.device_id = f.device_id
+    ORDER BY f.device_id
+"""
+_ANALYTICS_OFFERS_SQL = "SELECT device_id, retailer_id, price, in_stock FROM device_retailers"
+
+def _release_year(value) -> Optional[int]:
+    if isinstance(value, _Date):
+        return value.year
+    text = str(value or '')[:4]
+    return int(text) if text.isdigit() else None
+
+class FactFrame:
+    """Факты /statistic столбцами: dims — коды групп по измерениям, остальное — значения."""
+    def __init__(self, version: int, facts: List[tuple], offers: List[tuple]):
+        col = analytics.column
+        self.version = version
+        f = list(zip(*facts)) or [()] * 11
+        self.device_id = col(f[0], np.int64, 0)
+        self.dims: Dict[str, np.ndarray] = {
+            'category': col(f[1], np.int64, analytics.MISSING),
+            'manufacturer': col(f[2], np.int64, analytics.MISSING),
+            'country': col(f[3], np.int64, analytics.MISSING),
+            'os': col(f[4], np.int64, analytics.MISSING),
+            'storage_type': col(f[5], np.int64, analytics.MISSING),
+            'year': col(map(_release_year, f[6]), np.int64, analytics.MISSING),
         }
+        self.price = col(f[7])
+        self.in_stock = col(f[8], float, 0)
+        self.has_specs = col(f[9], float, 0)
+        self.is_waterproof = col(f[10], float, 0)
+
+        o = list(zip(*offers)) or [()] * 4
+        offer_device = col(o[0], np.int64, 0)
+        self.offer_retailer = col(o[1], np.int64, analytics.MISSING)
+        self.offer_price = col(o[2])
+        self.offer_in_stock = col(o[3], float, 0)
+        # категория устройства каждого предложения — поиском в отсортированных device_id
+        at = np.searchsorted(self.device_id, offer_device).clip(max=max(len(self.device_id) - 1, 0))
+        found = (self.device_id[at] == offer_device) if len(self.device_id) else np.zeros(len(offer_device), bool)
+        self.offer_category = np.where(found, self.dims['category'][at] if len(self.device_id) else 0,
+                                       analytics.MISSING)
+
+    def totals(self) -> tuple:
+        """(min, avg, max цены, без характеристик, без защиты от воды, в наличии) — как в SQL-варианте."""
+        known = self.price[~np.isnan(self.price)]
+        if len(known):
+            stats = (float(known.min()), float(known.mean()), float(known.max()))
+        else:
+            stats = (None, None, None)
+        return stats + (int((1 - self.has_specs).sum()), int((1 - self.is_waterproof).sum()),
+                        int(self.in_stock.sum()))
 
-        table_names = list_user_tables(conn)
-        if not is_admin:
-            table_names = [t for t in table_names if t.lower() != 'users']
-
-        tables_info = []
-        for name in table_names:
-            try:
-                cur.execute(f"SELECT COUNT(*) FROM {name}")
-                rows = cur.fetchone()[0] or 0
-            except Exception:
-                rows = 0
-            cols = count_columns(conn, name)
-            tables_info.append({
-                'name': name,
-                'rus': rus_desc.get(name, '—'),
-                'purpose': purpose_map.get(name, 'дополнительная'),
-                'rows': rows,
-                'columns': cols
-            })
-        order = {'главная': 0, 'справочник': 1, 'дополнительная': 2}
-        tables_info.sort(key=lambda x: (order.get(x['purpose'], 99), x['name']))
-
-        # категории
-        cur.execute("""
-            WITH dr_any AS (
-              SELECT device_id, MAX(CASE WHEN in_stock THEN 1 ELSE 0 END) AS in_stock_any
-              FROM device_retailers
-              GROUP BY device_id
-            )
-            SELECT c.name,
-                   COUNT(d.device_id)                                           AS devices_count,
-                   COUNT(CASE WHEN dr.in_stock_any=1 THEN d.device_id END)      AS in_stock_devices,
-                   MIN(d.current_price), AVG(d.current_price), MAX(d.current_price)
-            FROM categories c
-            LEFT JOIN devices d ON d.category_id = c.category_id
-            LEFT JOIN dr_any dr ON dr.device_id = d.device_id
-            GROUP BY c.category_id, c.name
-            HAVING COUNT(d.device_id) > 0
-            ORDER BY devices_count DESC, c.name
-        """)
-        categories_stat = [
-            (r[0], r[1] or 0, r[2] or 0,
-             int(r[3]) if r[3] is not None else 0,
-             int(r[4]) if r[4] is not None else 0,
-             int(r[5]) if r[5] is not None else 0)
-            for r in cur.fetchall()
-        ]
-
-        # производители
-        cur.execute("""
-            WITH dr_any AS (
-              SELECT device_id, MAX(CASE WHEN in_stock THEN 1 ELSE 0 END) AS in_stock_any
-              FROM device_retailers
-              GROUP BY device_id
-            )
-            SELECT m.name,
-                   COUNT(d.device_id)                                           AS devices_count,
-                   COUNT(CASE WHEN dr.in_stock_any=1 THEN d.device_id END)      AS in_stock_devices,
-                   MIN(d.current_price), AVG(d.current_price), MAX(d.current_price)
-            FROM manufacturers m
-            LEFT JOIN devices d ON d.manufacturer_id = m.manufacturer_id
-            LEFT JOIN dr_any dr ON dr.device_id = d.device_id
-            GROUP BY m.manufacturer_id, m.name
-            HAVING COUNT(d.device_id) > 0
-            ORDER BY devices_count DESC, m.name
-        """)
-        manufacturers_stat = [
-            (r[0], r[1] or 0, r[2] or 0,
-             int(r[3]) if r[3] is not None else 0,
-             int(r[4]) if r[4] is not None else 0,
-             int(r[5]) if r[5] is not None else 0)
-            for r in cur.fetchall()
-        ]
-
-        # страны
-        cur.execute("""
-            WITH dr_any AS (
-              SELECT device_id, MAX(CASE WHEN in_stock THEN 1 ELSE 0 END) AS in_stock_any
-              FROM device_retailers
-              GROUP BY device_id
-            )
-            SELECT co.name,
-                   COUNT(d.device_id)                                           AS devices_count,
-                   COUNT(CASE WHEN dr.in_stock_any=1 THEN d.device_id END)      AS in_stock_devices,
-                   MIN(d.current_price), AVG(d.current_price), MAX(d.current_price)
-            FROM country co
-            LEFT JOIN manufacturers m ON m.country_id      = co.country_id
-            LEFT JOIN devices d       ON d.manufacturer_id = m.manufacturer_id
-            LEFT JOIN dr_any dr       ON dr.device_id      = d.device_id
-            GROUP BY co.country_id, co.name
-            HAVING COUNT(d.device_id) > 0
-            ORDER BY devices_count DESC, co.name
-        """)
-        countries_stat = [
-            (r[0], r[1] or 0, r[2] or 0,
-             int(r[3]) if r[3] is not None else 0,
-             int(r[4]) if r[4] is not None else 0,
-             int(r[5]) if r[5] is not None else 0)
-            for r in cur.fetchall()
-        ]
-
-        # продавцы
-        cur.execute("""
-            SELECT r.name,
-                   COUNT(DISTINCT dr.device_id)                                  AS devices_count,
-                   COUNT(DISTINCT CASE WHEN dr.in_stock THEN dr.device_id END)   AS in_stock_devices,
-                   MIN(dr.price), AVG(dr.price), MAX(dr.price)
-            FROM retailers r
-            LEFT JOIN device_retailers dr ON dr.retailer_id = r.retailer_id
-            GROUP BY r.retailer_id, r.name
-            HAVING COUNT(DISTINCT dr.device_id) > 0
-            ORDER BY devices_count DESC, r.name
-        """)
-        retailers_stat = [
-            (r[0], r[1] or 0, r[2] or 0,
-             int(r[3]) if r[3] is not None else 0,
-             int(r[4]) if r[4] is not None else 0,
-             int(r[5]) if r[5] is not None else 0)
-            for r in cur.fetchall()
-        ]
-
-        if info_by == 'manufacturer':
-            info_results = manufacturers_stat
-        elif info_by == 'retailer':
-            info_results = retailers_stat
-        elif info_by == 'country':
-            info_results = countries_stat
+    def stats(self, dim: str, category_id: Optional[int] = None,
+              percentiles=ANALYTICS_PERCENTILES) -> Dict[str, Any]:
+        """
+        group_stats по измерению. Продавцы — по предложениям: устройств = предложений
+        (пара устройство-продавец уникальна), «в наличии» — предложения в наличии.
+        """
+        if dim == 'retailer':
+            keys, values, flags, category = (self.offer_retailer, self.offer_price,
+                                             self.offer_in_stock, self.offer_category)
         else:
-            info_by = 'category'
-            info_results = categories_stat
+            keys, values, flags, category = self.dims[dim], self.price, self.in_stock, self.dims['category']
+        if category_id is not None:
+            keys = np.where(category == category_id, keys, analytics.MISSING)
+        return analytics.group_stats(keys, values, flags, percentiles)
+
+_ANALYTICS_CACHE: Dict[str, FactFrame] = {}
+_ANALYTICS_LOCK = threading.Lock()
+
+def analytics_frame(conn) -> FactFrame:
+    """Столбцы фактов для версии данных stats_version(); при новой версии читаются заново."""
+    backend = _conn_backend(conn)
+    version = stats_version(conn)
+    with _ANALYTICS_LOCK:
+        frame = _ANALYTICS_CACHE.get(backend)
+    if frame is not None and frame.version == version:
+        return frame
+    facts, offers = run_queries(conn, [(_ANALYTICS_FACTS_SQL, []), (_ANALYTICS_OFFERS_SQL, [])])
+    frame = FactFrame(version, facts, offers)
+    with _ANALYTICS_LOCK:
+        _ANALYTICS_CACHE[backend] = frame
+    return frame
+
+def _analytics_names(conn, dim: str) -> Optional[Dict[int, str]]:
+    ref = ANALYTICS_DIMENSIONS[dim][1]
+    if ref is None:
+        return None
+    return {row[0]: " ".join(str(v) for v in row[1:] if v) for row in reference_data([ref], conn)[ref]}
 
-        # Линии цен для топ-4 категорий
-        cur.execute("""
-            SELECT c.category_id, c.name, COUNT(d.device_id) AS cnt
-            FROM categories c
-            JOIN devices d ON d.category_id = c.category_id AND d.current_price IS NOT NULL
-            GROUP BY c.category_id, c.name
-            ORDER BY cnt DESC, c.name
-            LIMIT 4
-        """)
-        top4 = cur.fetchall()
+def _num(value) -> Optional[float]:
+    return None if value is None or np.isnan(value) else float(value)
 
-        price_lines = []
-        max_series_len = 0
-        max_series_price = 0
-        for cat_id, cat_name, _ in top4:
-            cur.execute("""
-                SELECT current_price
-                FROM devices
-                WHERE category_id = %s AND current_price IS NOT NULL
-                ORDER BY current_price ASC
-            """, (cat_id,))
-            prices = [int(r[0]) for r in cur.fetchall()][:60]
-            if prices:
-                price_lines.append({'name': cat_name, 'prices': prices})
-                max_series_len = max(max_series_len, len(prices))
-                max_series_price = max(max_series_price, max(prices))
+def analytics_breakdown(conn, frame: FactFrame, dim: str, category_id: Optional[int] = None,
+                        percentiles=ANALYTICS_PERCENTILES) -> List[Dict[str, Any]]:
+    """
+    Строки сводки по измерению, по убыванию числа устройств: key, name, count, in_stock,
+    min, avg, max, percentiles {q: цена}. Ключи, которых нет в справочнике, пропускаются
+    (как JOIN в SQL-варианте).
+    """
+    names = _analytics_names(conn, dim)
+    s = frame.stats(dim, category_id, percentiles)
+    items = []
+    for i, key in enumerate(s['keys'].tolist()):
+        name = str(key) if names is None else names.get(key)
+        if name is None:
+            continue
+        items.append({
+            'key': key, 'name': name, 'count': int(s['count'][i]), 'in_stock': int(s['flagged'][i]),
+            'min': _num(s['min'][i]), 'avg': _num(s['mean'][i]), 'max': _num(s['max'][i]),
+            'percentiles': {str(q): _num(values[i]) for q, values in s['percentiles'].items()},
+        })
+    items.sort(key=lambda item: (-item['count'], item['name']))
+    return items
+
+def _breakdown_row(item: Dict[str, Any]) -> List[Any]:
+    """Строка для шаблона /statistic: [название, устройств, в наличии, мин, средн, макс, медиана]."""
+    return [item['name'], item['count'], item['in_stock'], _int0(item['min']), _int0(item['avg']),
+            _int0(item['max']), _int0(item['percentiles'].get('0.5'))]
+
+@app.route('/api/statistic/breakdown')
+def api_statistic_breakdown():
+    """
+    Сводка по измерению: ?by=<category|manufacturer|retailer|country|os|storage_type|year>
+    &category_id=&q=0.1,0.5,0.9. Считается по столбцам в памяти; новые данные — новая версия.
+    """
+    if analytics is None:
+        return jsonify({'ok': False, 'reason': 'numpy_missing'}), 503
+    dim = request.args.get('by', 'category')
+    if dim not in ANALYTICS_DIMENSIONS:
+        return jsonify({'ok': False, 'reason': 'bad_dimension', 'dimensions': list(ANALYTICS_DIMENSIONS)}), 400
+    try:
+        qs = tuple(float(x) for x in request.args['q'].split(',') if x.strip()) if request.args.get('q') \
+            else ANALYTICS_PERCENTILES
+    except ValueError:
+        return jsonify({'ok': False, 'reason': 'bad_quantiles'}), 400
+    category_id = request.args.get('category_id', type=int)
+    with get_conn() as conn:
+        frame = analytics_frame(conn)
+        items = analytics_breakdown(conn, frame, dim, category_id, tuple(q for q in qs if 0 <= q <= 1))
+    return jsonify({'by': dim, 'label': ANALYTICS_DIMENSIONS[dim][0], 'category_id': category_id,
+                    'version': frame.version, 'items': items})
+
+def load_statistic_snapshot(conn, force: bool = False) -> Dict[str, Any]:
+    """
+    Данные /statistic одним чтением stat_snapshot. Снимок пересобирается, только
+    если после сборки были изменения и он старше STATS_MAX_STALENESS секунд.
+    Пересборка записывает новый снимок (upsert) — даже если страницу открыли GET-запросом.
+    """
+    cur = tup_cur(conn)
+    version = stats_version(conn)
+    cur.execute("SELECT payload, built_at, built_version FROM stat_snapshot WHERE name = %s", (STATS_SNAPSHOT,))
+    row = cur.fetchone()
+    if row and row[0] and not force:
+        payload, built_at, built_version = row
+        if version <= built_version or time.time() - built_at < STATS_MAX_STALENESS:
+            return json.loads(payload)
+
+    data = build_statistic_payload(conn)
+    cur.execute("""
+        INSERT INTO stat_snapshot (name, payload, built_at, version, built_version)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (name) DO UPDATE
+        SET payload = excluded.payload, built_at = excluded.built_at, built_version = excluded.built_version
+    """, (STATS_SNAPSHOT, json.dumps(data, ensure_ascii=False, default=str), time.time(), version, version))
+    return data
+
+@app.route('/statistic', methods=['GET', 'POST'])
+def statistic():
+    info_by = request.form.get('info_by') or request.args.get('info_by') or 'category'
+    is_admin = current_user.is_authenticated and getattr(current_user, 'is_admin', False)
+
+    with get_conn() as conn:
+        stats = load_statistic_snapshot(conn, force=bool(is_admin and request.args.get('refresh')))
+
+    tables_info = stats['tables_info']
+    if not is_admin:
+        tables_info = [t for t in tables_info if t['name'].lower() != 'users']
+
+    if info_by not in stats['breakdowns']:
+        info_by = 'category'
+    info_results = stats['breakdowns'][info_by]
+    info_dims = [(dim, label) for dim, (label, _) in ANALYTICS_DIMENSIONS.items() if dim in stats['breakdowns']]
+    categories_stat = stats['breakdowns']['category']
+
+    price_lines = stats['price_lines']
+    max_series_len = max((len(l['prices']) for l in price_lines), default=0)
+    max_series_price = max((max(l['prices']) for l in price_lines), default=0)
 
     return render_template(
         'statistic.html',
         info_by=info_by,
         info_results=info_results,
-        min_price=min_price, avg_price=avg_price, max_price=max_price,
-        cheapest=cheapest, expensive=expensive,
-        devices_without_specs=devices_without_specs,
-        devices_without_waterproof=devices_without_waterproof,
+        info_dims=info_dims,
+        min_price=stats['min_price'], avg_price=stats['avg_price'], max_price=stats['max_price'],
+        cheapest=stats['cheapest'], expensive=stats['expensive'],
+        devices_without_specs=stats['devices_without_specs'],
+        devices_without_waterproof=stats['devices_without_waterproof'],
         top_cat=[(r[0], r[1]) for r in categories_stat[:5]],
         price_lines=price_lines,
         price_lines_max_x=max_series_len if max_series_len else 1,
@@ -1305,6 +3860,592 @@ def statistic():
         tables_info=tables_info
     )
 
+# -------------------------------------------------
+# Распределение цен по категориям
+# -------------------------------------------------
+# Отсортированные массивы current_price по категориям (и по всем устройствам сразу),
+# построенные из stat_device_facts. Гистограмма — бинарный поиск границ корзин,
+# квантиль — обращение по индексу; изменённые устройства дочитываются при следующем запросе.
+PRICE_HISTOGRAM_BINS = 20
+PRICE_HISTOGRAM_BINS_MAX = 200
+PRICE_QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+PRICE_INDEX_MAX_AGE = env_int("PRICE_INDEX_MAX_AGE", 300)
+
+class PriceIndex:
+    def __init__(self):
+        self.by_device: Dict[int, Tuple[Any, int]] = {}   # device_id -> (category_id, цена)
+        self.sorted: Dict[Any, List[int]] = {None: []}      # category_id -> цены по возрастанию; None — все
+        self.built_at = time.monotonic()
+
+    def _add(self, device_id: int, category_id, price: int):
+        self.by_device[device_id] = (category_id, price)
+        bisect.insort(self.sorted[None], price)
+        bisect.insort(self.sorted.setdefault(category_id, []), price)
+
+    def _remove(self, device_id: int):
+        old = self.by_device.pop(device_id, None)
+        if old is None:
+            return
+        category_id, price = old
+        for key in (None, category_id):
+            prices = self.sorted[key]
+            del prices[bisect.bisect_left(prices, price)]
+
+    @staticmethod
+    def queries(device_ids: Optional[List[int]] = None) -> List[Tuple[str, List[Any]]]:
+        sql = "SELECT device_id, category_id, current_price FROM stat_device_facts WHERE current_price IS NOT NULL"
+        if device_ids is None:
+            return [(sql, [])]
+        return [(sql + f" AND device_id IN ({', '.join(['%s'] * len(device_ids))})", list(device_ids))]
+
+    def apply_rows(self, rows, device_ids: Optional[List[int]] = None):
+        """Загрузить всё (device_ids=None) или заменить цены перечисленных устройств."""
+        if device_ids is None:
+            self.by_device = {r[0]: (r[1], int(r[2])) for r in rows}
+            self.sorted = {None: sorted(p for _, p in self.by_device.values())}
+            for category_id, price in self.by_device.values():
+                self.sorted.setdefault(category_id, []).append(price)
+            for key, prices in self.sorted.items():
+                if key is not None:
+                    prices.sort()
+            self.built_at = time.monotonic()
+            return
+        for device_id in device_ids:
+            self._remove(device_id)
+        for device_id, category_id, price in rows:
+            self._add(device_id, category_id, int(price))
+
+    def prices(self, category_id=None) -> List[int]:
+        return self.sorted.get(category_id, [])
+
+def price_quantile(prices: List[int], q: float) -> Optional[float]:
+    """Квантиль отсортированного массива с линейной интерполяцией (как numpy 'linear')."""
+    if not prices:
+        return None
+    pos = (len(prices) - 1) * min(max(q, 0.0), 1.0)
+    lo = int(pos)
+    hi = min(lo + 1, len(prices) - 1)
+    return prices[lo] + (prices[hi] - prices[lo]) * (pos - lo)
+
+def price_histogram(prices: List[int], bins: int) -> List[Dict[str, Any]]:
+    """Корзины равной ширины от min до max; последняя включает max."""
+    if not prices:
+        return []
+    lo, hi = prices[0], prices[-1]
+    width = (hi - lo) / bins if hi > lo else 1
+    result, start = [], 0
+    for i in range(bins):
+        upper = lo + width * (i + 1)
+        end = len(prices) if i == bins - 1 else bisect.bisect_left(prices, upper)
+        result.append({'from': round(lo + width * i, 2), 'to': round(upper, 2), 'count': end - start})
+        start = end
+        if hi == lo:
+            break
+    return result
+
+_PRICE_INDEX: Dict[str, PriceIndex] = {}
+_PRICE_PENDING: Dict[str, Optional[set]] = {}
+_PRICE_LOCK = threading.Lock()
+
+@on_data_change
+def _prices_on_change(conn, table_name, device_ids):
+    if table_name != 'devices':
+        return
+    backend = _conn_backend(conn)
+    ids = None if device_ids is None else {int(i) for i in device_ids}
+    after_commit(conn, lambda: _price_queue(backend, ids))
+
+def _price_queue(backend: str, device_ids: Optional[set]):
+    # после commit: запрос до него забрал бы id и перечитал старые цены
+    with _PRICE_LOCK:
+        pending = _PRICE_PENDING.get(backend, set())
+        _PRICE_PENDING[backend] = None if device_ids is None or pending is None else pending | device_ids
+
+def price_pending(backend: str) -> Optional[List[int]]:
+    """Что обновить в индексе цен: [] — ничего, список id — эти устройства, None — всё."""
+    with _PRICE_LOCK:
+        index = _PRICE_INDEX.get(backend)
+        pending = _PRICE_PENDING.pop(backend, set())
+    if index is None or pending is None or (PRICE_INDEX_MAX_AGE and time.monotonic() - index.built_at > PRICE_INDEX_MAX_AGE):
+        return None
+    return sorted(pending)
+
+def price_apply(backend: str, rows, device_ids: Optional[List[int]]):
+    if device_ids is None:
+        # полная сборка (сортировка всех цен) — без блокировки, под ней только подмена
+        index = PriceIndex()
+        index.apply_rows(rows)
+        with _PRICE_LOCK:
+            _PRICE_INDEX[backend] = index
+        return
+    with _PRICE_LOCK:
+        _PRICE_INDEX[backend].apply_rows(rows, device_ids)
+
+def refresh_price_index(conn) -> str:
+    """
+    Дочитывает изменения цен с прошлого раза; возвращает бэкенд соединения.
+    Запрос к БД идёт без _PRICE_LOCK — блокировка берётся только на применение.
+    """
+    backend = _conn_backend(conn)
+    device_ids = price_pending(backend)
+    if device_ids != []:
+        price_apply(backend, run_queries(conn, PriceIndex.queries(device_ids))[0], device_ids)
+    return backend
+
+@contextmanager
+def price_index(conn):
+    """Индекс цен бэкенда этого соединения, под блокировкой на время чтения."""
+    backend = refresh_price_index(conn)
+    with _PRICE_LOCK:
+        yield _PRICE_INDEX[backend]
+
+def price_bounds(backend: str, category_id: Optional[int]) -> Tuple[int, int]:
+    """(min, max) цен категории по уже обновлённому индексу; (0, 0) — цен нет."""
+    with _PRICE_LOCK:
+        prices = _PRICE_INDEX[backend].prices(category_id)
+        return (prices[0], prices[-1]) if prices else (0, 0)
+
+@app.route('/api/price_histogram')
+def api_price_histogram():
+    """
+    Распределение цен: ?category_id=<id|all>&bins=<1..200>&q=0.1,0.5,0.9.
+    Ответ: count, min, max, bins [{from, to, count}], quantiles {"0.5": цена}.
+    """
+    category_id = request.args.get('category_id', type=int)
+    bins = max(1, min(request.args.get('bins', PRICE_HISTOGRAM_BINS, type=int), PRICE_HISTOGRAM_BINS_MAX))
+    try:
+        qs = [float(x) for x in request.args['q'].split(',') if x.strip()] if request.args.get('q') else list(PRICE_QUANTILES)
+    except ValueError:
+        return jsonify({'ok': False, 'reason': 'bad_quantiles'}), 400
+
+    with get_conn() as conn, price_index(conn) as index:
+        prices = index.prices(category_id)
+        return jsonify({
+            'category_id': category_id,
+            'count': len(prices),
+            'min': prices[0] if prices else None,
+            'max': prices[-1] if prices else None,
+            'bins': price_histogram(prices, bins),
+            'quantiles': {str(q): price_quantile(prices, q) for q in qs if 0 <= q <= 1},
+        })
+
+# -------------------------------------------------
+# Поисковая проекция device_search
+# -------------------------------------------------
+# Одна строка на устройство со всеми названиями из справочников — /search и
+# /api/auto_search читают её по индексу вместо соединения 11 таблиц с DISTINCT.
+SEARCH_RESULT_COLUMNS = ("device_id, model, manufacturer, category, color, country, "
+                         "storage_type, proc_model, techn_matr, current_price")
+SEARCH_SOURCE_TABLES = {
+    'devices', 'specifications', 'displays', 'model', 'manufacturers', 'categories',
+    'color', 'country', 'storage_type', 'proc_model', 'techn_matr',
+}
+_DEVICE_SEARCH_COLS = ("device_id, model, model_key, manufacturer_id, manufacturer, category_id, category, "
+                       "color_id, color, country_id, country, storage_type_id, storage_type, "
+                       "proc_model_id, proc_model, techn_matr_id, techn_matr, current_price")
+_DEVICE_SEARCH_SELECT = """
+    SELECT d.device_id, ml.name, LOWER(ml.name),
+           d.manufacturer_id, m.name, d.category_id, c.name,
+           d.color_id, col.name, m.country_id, co.name,
+           s.storage_type_id, st.name, s.proc_model_id, pm.name,
+           disp.techn_matr_id, tm.name, d.current_price
+    FROM devices d
+    JOIN model ml ON d.model_id = ml.model_id
+    JOIN manufacturers m ON d.manufacturer_id = m.manufacturer_id
+    JOIN categories    c ON d.category_id     = c.category_id
+    LEFT JOIN color          col ON d.color_id        = col.color_id
+    LEFT JOIN specifications s   ON d.device_id       = s.device_id
+    LEFT JOIN storage_type   st  ON s.storage_type_id = st.storage_type_id
+    LEFT JOIN proc_model     pm  ON s.proc_model_id   = pm.proc_model_id
+    LEFT JOIN displays       disp ON d.device_id      = disp.device_id
+    LEFT JOIN techn_matr     tm  ON disp.techn_matr_id = tm.techn_matr_id
+    LEFT JOIN country        co  ON m.country_id      = co.country_id
+"""
+
+def refresh_device_search(conn, device_ids: Optional[List[int]] = None):
+    """Пересобрать строки device_search для устройств (None — для всех)."""
+    cur = tup_cur(conn)
+    if device_ids is None:
+        cur.execute("DELETE FROM device_search")
+        cur.execute(f"INSERT INTO device_search ({_DEVICE_SEARCH_COLS}) {_DEVICE_SEARCH_SELECT}")
+        return
+    ids = sorted({int(i) for i in device_ids})
+    if not ids:
+        return
+    ph = ", ".join(['%s'] * len(ids))
+    cur.execute(f"DELETE FROM device_search WHERE device_id IN ({ph})", ids)
+    cur.execute(f"INSERT INTO device_search ({_DEVICE_SEARCH_COLS}) {_DEVICE_SEARCH_SELECT} WHERE d.device_id IN ({ph})", ids)
+
+def _device_search_bootstrap(conn):
+    cur = tup_cur(conn)
+    cur.execute("SELECT 1 FROM device_search LIMIT 1")
+    if cur.fetchone() is None:
+        refresh_device_search(conn)
+
+register_aux_schema(
+    ['device_search'],
+    [
+        """CREATE TABLE IF NOT EXISTS device_search (
+               device_id       integer PRIMARY KEY,
+               model           text,
+               model_key       text,
+               manufacturer_id integer,
+               manufacturer    text,
+               category_id     integer,
+               category        text,
+               color_id        integer,
+               color           text,
+               country_id      integer,
+               country         text,
+               storage_type_id integer,
+               storage_type    text,
+               proc_model_id   integer,
+               proc_model      text,
+               techn_matr_id   integer,
+               techn_matr      text,
+               current_price   integer
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_device_search_manufacturer ON device_search (manufacturer_id, model_key)",
+        "CREATE INDEX IF NOT EXISTS idx_device_search_country_color ON device_search (country_id, color_id, model_key)",
+        "CREATE INDEX IF NOT EXISTS idx_device_search_category ON device_search (category_id, manufacturer_id, color_id)",
+        "CREATE INDEX IF NOT EXISTS idx_device_search_color ON device_search (color_id)",
+        "CREATE INDEX IF NOT EXISTS idx_device_search_model_key ON device_search (model_key)",
+    ],
+    bootstrap=_device_search_bootstrap,
+)
+
+@on_data_change
+def _device_search_on_change(conn, table_name, device_ids):
+    if table_name not in SEARCH_SOURCE_TABLES:
+        return
+    # строки устройства зависят только от него самого, его характеристик, дисплея и строк
+    # справочников, на которые он ссылается: у справочника приходят эти устройства
+    # (новая строка — [], ничего не пересобирается); None — пересобрать всё
+    refresh_device_search(conn, device_ids)
+
+def search_devices_query(filters: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    """Запрос результатов поиска (SEARCH_RESULT_COLUMNS) по равенству столбцов device_search."""
+    where, params = [], []
+    for column in ('category_id', 'manufacturer_id', 'country_id', 'color_id'):
+        value = filters.get(column)
+        if value not in (None, '', 'all'):
+            where.append(f"{column} = %s")
+            params.append(value)
+    sql = f"SELECT {SEARCH_RESULT_COLUMNS} FROM device_search"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return sql + " ORDER BY model_key, device_id", params
+
+def search_devices(conn, filters: Dict[str, Any]) -> List[tuple]:
+    return run_queries(conn, [search_devices_query(filters)])[0]
+
+# -------------------------------------------------
+# Подсказки при вводе (/api/suggest)
+# -------------------------------------------------
+# Текстовый индекс по названиям модели, производителя, процессора и ОС.
+# PostgreSQL — tsvector с весами (модель важнее всего) под GIN-индексом и btree по
+# lower(model) для префиксов; SQLite — таблица FTS5 с префиксными индексами.
+SUGGEST_LIMIT = 10
+SUGGEST_LIMIT_MAX = 50
+SUGGEST_MIN_CHARS = 2
+SUGGEST_SOURCE_TABLES = {
+    'devices', 'specifications', 'model', 'manufacturers', 'categories',
+    'proc_model', 'operating_systems', 'os_name',
+}
+_SUGGEST_FIELDS = ('device_id', 'model', 'manufacturer', 'proc_model', 'os', 'category')
+_SUGGEST_COLS = "model, model_key, manufacturer, proc_model, os_name, category"
+_SUGGEST_SELECT = """
+    SELECT d.device_id, ml.name, LOWER(ml.name), m.name, pm.name, osn.name, c.name
+    FROM devices d
+    JOIN model ml ON d.model_id = ml.model_id
+    JOIN manufacturers m ON d.manufacturer_id = m.manufacturer_id
+    JOIN categories    c ON d.category_id     = c.category_id
+    LEFT JOIN specifications    s   ON d.device_id     = s.device_id
+    LEFT JOIN proc_model        pm  ON s.proc_model_id = pm.proc_model_id
+    LEFT JOIN operating_systems os  ON d.os_id         = os.os_id
+    LEFT JOIN os_name           osn ON os.os_name_id   = osn.os_name_id
+"""
+
+def _suggest_key(conn) -> str:
+    # в FTS5 device_id хранится как rowid — по нему есть индекс
+    return "rowid" if _is_sqlite_conn(conn) else "device_id"
+
+def refresh_device_suggest(conn, device_ids: Optional[List[int]] = None):
+    """Пересобрать строки текстового индекса для устройств (None — для всех)."""
+    cur = tup_cur(conn)
+    key = _suggest_key(conn)
+    if device_ids is None:
+        cur.execute("DELETE FROM device_suggest")
+        cur.execute(f"INSERT INTO device_suggest ({key}, {_SUGGEST_COLS}) {_SUGGEST_SELECT}")
+        return
+    ids = sorted({int(i) for i in device_ids})
+    if not ids:
+        return
+    ph = ", ".join(['%s'] * len(ids))
+    cur.execute(f"DELETE FROM device_suggest WHERE {key} IN ({ph})", ids)
+    cur.execute(f"INSERT INTO device_suggest ({key}, {_SUGGEST_COLS}) {_SUGGEST_SELECT} WHERE d.device_id IN ({ph})", ids)
+
+def _device_suggest_bootstrap(conn):
+    cur = tup_cur(conn)
+    cur.execute("SELECT 1 FROM device_suggest LIMIT 1")
+    if cur.fetchone() is None:
+        refresh_device_suggest(conn)
+
+register_aux_schema(
+    ['device_suggest',
+     # служебные таблицы FTS5
+     'device_suggest_data', 'device_suggest_idx', 'device_suggest_content',
+     'device_suggest_docsize', 'device_suggest_config'],
+    [
+        """CREATE TABLE IF NOT EXISTS device_suggest (
+               device_id    integer PRIMARY KEY,
+               model        text,
+               model_key    text,
+               manufacturer text,
+               proc_model   text,
+               os_name      text,
+               category     text,
+               doc tsvector GENERATED ALWAYS AS (
+                   setweight(to_tsvector('simple', coalesce(model, '')), 'A') ||
+                   setweight(to_tsvector('simple', coalesce(manufacturer, '')), 'B') ||
+                   setweight(to_tsvector('simple', coalesce(proc_model, '')), 'C') ||
+                   setweight(to_tsvector('simple', coalesce(os_name, '')), 'C')
+               ) STORED
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_device_suggest_doc ON device_suggest USING gin (doc)",
+        "CREATE INDEX IF NOT EXISTS idx_device_suggest_model_key ON device_suggest (model_key text_pattern_ops)",
+    ],
+    [
+        """CREATE VIRTUAL TABLE IF NOT EXISTS device_suggest USING fts5(
+               model, manufacturer, proc_model, os_name,
+               model_key UNINDEXED, category UNINDEXED,
+               tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4'
+           )""",
+    ],
+    bootstrap=_device_suggest_bootstrap,
+)
+
+@on_data_change
+def _device_suggest_on_change(conn, table_name, device_ids):
+    if table_name not in SUGGEST_SOURCE_TABLES:
+        return
+    # справочник — только ссылающиеся устройства, как в _device_search_on_change
+    refresh_device_suggest(conn, device_ids)
+
+def _like_prefix(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def suggest_devices(conn, query: str, limit: int = SUGGEST_LIMIT) -> List[Dict[str, Any]]:
+    """
+    Устройства, у которых каждое слово запроса — начало слова в названии модели,
+    производителя, процессора или ОС. Сначала модели, начинающиеся с запроса целиком.
+    """
+    words = re.findall(r'\w+', query.lower())[:6]
+    if not words or len(query.strip()) < SUGGEST_MIN_CHARS:
+        return []
+    cur = tup_cur(conn)
+    cols = f"{_suggest_key(conn)}, model, manufacturer, proc_model, os_name, category"
+    if _is_sqlite_conn(conn):
+        cur.execute(f"""
+            SELECT {cols} FROM device_suggest
+            WHERE device_suggest MATCH %s
+            ORDER BY bm25(device_suggest, 10.0, 4.0, 1.0, 1.0), model_key
+            LIMIT %s
+        """, (" ".join(f'"{w}"*' for w in words), limit))
+        rows = cur.fetchall()
+    else:
+        # префикс модели целиком — по btree, остальное добираем полнотекстовым поиском
+        cur.execute(f"""
+            SELECT {cols} FROM device_suggest
+            WHERE model_key LIKE %s
+            ORDER BY model_key
+            LIMIT %s
+        """, (_like_prefix(query.strip().lower()), limit))
+        rows = cur.fetchall()
+        if len(rows) < limit:
+            seen = [r[0] for r in rows] or [0]
+            cur.execute(f"""
+                SELECT {cols} FROM device_suggest, to_tsquery('simple', %s) q
+                WHERE doc @@ q AND device_id <> ALL(%s)
+                ORDER BY ts_rank(doc, q) DESC, model_key
+                LIMIT %s
+            """, (" & ".join(f"{w}:*" for w in words), seen, limit - len(rows)))
+            rows += cur.fetchall()
+    return [dict(zip(_SUGGEST_FIELDS, r)) for r in rows]
+
+@app.route('/api/suggest')
+def api_suggest():
+    """Подсказки по мере ввода: ?q=<текст>&limit=<до 50>."""
+    query = (request.args.get('q') or '')[:100]
+    try:
+        limit = max(1, min(int(request.args.get('limit', SUGGEST_LIMIT)), SUGGEST_LIMIT_MAX))
+    except ValueError:
+        limit = SUGGEST_LIMIT
+    with get_conn() as conn:
+        items = suggest_devices(conn, query, limit)
+    for item in items:
+        item['url'] = url_for('device_detail', device_id=item['device_id'])
+    return jsonify(items)
+
+# -------------------------------------------------
+# Фасеты: устройства по значениям фильтров
+# -------------------------------------------------
+# Для каждого атрибута: значение -> множество device_id в виде битовой маски (int,
+# бит N = устройство N). Любая комбинация фильтров — AND масок, счётчик — bit_count().
+# Индекс строится из device_search и device_retailers; изменения устройств дочитываются
+# точечно при следующем запросе, изменения справочников — полной пересборкой.
+FACET_ATTRS = ('category', 'manufacturer', 'color', 'storage_type', 'country', 'retailer')
+FACET_MAX_AGE = env_int("FACET_MAX_AGE", 300)
+FACET_DEVICE_TABLES = {'devices', 'specifications', 'device_retailers'}
+FACET_DICTIONARY_TABLES = {'manufacturers', 'categories', 'color', 'country', 'storage_type', 'retailers', 'model'}
+
+_FACET_SEARCH_SQL = """
+    SELECT device_id, category_id, category, manufacturer_id, manufacturer, color_id, color,
+           storage_type_id, storage_type, country_id, country
+    FROM device_search
+"""
+_FACET_RETAILER_SQL = """
+    SELECT DISTINCT dr.device_id, r.retailer_id, r.name
+    FROM device_retailers dr
+    JOIN retailers r ON dr.retailer_id = r.retailer_id
+"""
+
+class FacetIndex:
+    """Битовые маски устройств по значениям атрибутов. Не меняется после построения."""
+
+    def __init__(self, postings: Dict[str, Dict[int, int]], names: Dict[str, Dict[int, str]],
+                 universe: int, built_at: float):
+        self.postings = postings
+        self.names = names
+        self.universe = universe
+        self.built_at = built_at
+
+    @staticmethod
+    def queries(device_ids: Optional[List[int]] = None) -> List[Tuple[str, List[Any]]]:
+        """Запросы для build_from_rows: все устройства или только device_ids."""
+        if device_ids is None:
+            return [(_FACET_SEARCH_SQL, []), (_FACET_RETAILER_SQL, [])]
+        ph = ", ".join(['%s'] * len(device_ids))
+        return [(_FACET_SEARCH_SQL + f" WHERE device_id IN ({ph})", list(device_ids)),
+                (_FACET_RETAILER_SQL + f" WHERE dr.device_id IN ({ph})", list(device_ids))]
+
+    @classmethod
+    def build(cls, conn, device_ids: Optional[List[int]] = None, base: "Optional[FacetIndex]" = None) -> "FacetIndex":
+        """Полная сборка, либо копия base с перечитанными device_ids."""
+        return cls.build_from_rows(*run_queries(conn, cls.queries(device_ids)), device_ids=device_ids, base=base)
+
+    @classmethod
+    def build_from_rows(cls, search_rows, retailer_rows, device_ids: Optional[List[int]] = None,
+                        base: "Optional[FacetIndex]" = None) -> "FacetIndex":
+        postings = {a: dict(base.postings[a]) if base else {} for a in FACET_ATTRS}
+        names = {a: dict(base.names[a]) if base else {} for a in FACET_ATTRS}
+        universe = base.universe if base else 0
+        if device_ids is not None:
+            clear = 0
+            for i in device_ids:
+                clear |= 1 << i
+            universe &= ~clear
+            for attr in FACET_ATTRS:
+                postings[attr] = {v: bits & ~clear for v, bits in postings[attr].items() if bits & ~clear}
+
+        present = 0
+        for row in search_rows:
+            bit = 1 << row[0]
+            present |= bit
+            for k, attr in enumerate(('category', 'manufacturer', 'color', 'storage_type', 'country')):
+                value, name = row[1 + 2 * k], row[2 + 2 * k]
+                if value is not None:
+                    postings[attr][value] = postings[attr].get(value, 0) | bit
+                    names[attr][value] = name
+        universe |= present
+        for device_id, retailer_id, name in retailer_rows:
+            bit = 1 << device_id
+            if present & bit:
+                postings['retailer'][retailer_id] = postings['retailer'].get(retailer_id, 0) | bit
+                names['retailer'][retailer_id] = name
+        return cls(postings, names, universe, base.built_at if base else time.monotonic())
+
+    def match(self, filters: Dict[str, Any], skip: Optional[str] = None) -> int:
+        """Маска устройств, подходящих под все фильтры {атрибут: id} (кроме skip)."""
+        mask = self.universe
+        for attr, value in filters.items():
+            if attr == skip or attr not in self.postings or value in (None, '', 'all'):
+                continue
+            try:
+                mask &= self.postings[attr].get(int(value), 0)
+            except (TypeError, ValueError):
+                return 0
+        return mask
+
+    def counts(self, attr: str, mask: int) -> List[Dict[str, Any]]:
+        """Значения атрибута, встречающиеся среди mask, с числом устройств; по имени без регистра."""
+        names = self.names[attr]
+        items = []
+        for value, bits in self.postings[attr].items():
+            n = (bits & mask).bit_count()
+            if n:
+                items.append({'id': value, 'name': names.get(value), 'count': n})
+        return _sort_ci_dicts(items, 'name')
+
+_FACETS: Dict[str, FacetIndex] = {}
+_FACET_PENDING: Dict[str, Optional[set]] = {}   # backend -> id изменённых устройств; None — пересобрать всё
+_FACET_LOCK = threading.Lock()
+
+@on_data_change
+def _facets_on_change(conn, table_name, device_ids):
+    # в очередь — только после commit: иначе запрос между записью и commit заберёт
+    # id и перечитает ещё старые строки
+    backend = _conn_backend(conn)
+    if table_name in FACET_DEVICE_TABLES and device_ids is not None:
+        after_commit(conn, lambda: _facet_queue(backend, {int(i) for i in device_ids}))
+    elif table_name in FACET_DEVICE_TABLES or table_name in FACET_DICTIONARY_TABLES:
+        after_commit(conn, lambda: _facet_queue(backend, None))
+
+def _facet_queue(backend: str, device_ids: Optional[set]):
+    with _FACET_LOCK:
+        pending = _FACET_PENDING.get(backend, set())
+        _FACET_PENDING[backend] = None if device_ids is None or pending is None else pending | device_ids
+
+def facet_pending(backend: str) -> Tuple[Optional[FacetIndex], Optional[List[int]]]:
+    """
+    Текущий индекс и что в нём обновить: [] — ничего, список id — дочитать эти устройства,
+    None — собрать заново (тогда и индекс None).
+    """
+    with _FACET_LOCK:
+        index = _FACETS.get(backend)
+        pending = _FACET_PENDING.pop(backend, set())
+    if index is None or pending is None or (FACET_MAX_AGE and time.monotonic() - index.built_at > FACET_MAX_AGE):
+        return None, None
+    return index, sorted(pending)
+
+def facet_store(backend: str, index: FacetIndex) -> FacetIndex:
+    with _FACET_LOCK:
+        _FACETS[backend] = index
+    return index
+
+def facet_index() -> FacetIndex:
+    """Индекс фасетов текущего бэкенда; изменения с прошлого раза дочитываются здесь."""
+    backend = current_backend()
+    index, device_ids = facet_pending(backend)
+    if device_ids == []:
+        return index
+    with get_conn() as conn:
+        return facet_store(backend, FacetIndex.build(conn, device_ids, base=index))
+
+@app.route('/api/facets')
+def api_facets():
+    """
+    Счётчики по всем фасетам для выбранных фильтров: ?category=1&manufacturer=2...
+    Значения каждого фасета считаются без его собственного фильтра — как в обычных
+    каскадных фильтрах, где можно переключиться на соседнее значение.
+    """
+    index = facet_index()
+    filters = {attr: request.args.get(attr) for attr in FACET_ATTRS if request.args.get(attr)}
+    return jsonify({
+        'total': index.match(filters).bit_count(),
+        'facets': {attr: index.counts(attr, index.match(filters, skip=attr)) for attr in FACET_ATTRS},
+    })
+
 # -------------------------------------------------
 # Поиск
 # -------------------------------------------------
@@ -1316,61 +4457,20 @@ def search():
     selected_country      = request.form.get('country_id')      if request.method == 'POST' else ''
     selected_color        = request.form.get('color_id')        if request.method == 'POST' else ''
 
-    base_select = '''
-        SELECT DISTINCT
-            d.device_id,
-            ml.name as model,
-            m.name  AS manufacturer,
-            c.name  AS category,
-            col.name AS color,
-            co.name AS country,
-            st.name AS storage_type,
-            pm.name AS proc_model,
-            tm.name AS techn_matr,
-            d.current_price
-        FROM devices d
-        JOIN model ml ON d.model_id = ml.model_id
-        JOIN manufacturers m ON d.manufacturer_id = m.manufacturer_id
-        JOIN categories    c ON d.category_id     = c.category_id
-        JOIN color       col ON d.color_id        = col.color_id
-        LEFT JOIN specifications s  ON d.device_id    = s.device_id
-        LEFT JOIN storage_type   st ON s.storage_type_id = st.storage_type_id
-        LEFT JOIN proc_model     pm ON s.proc_model_id   = pm.proc_model_id
-        LEFT JOIN displays     disp ON d.device_id       = disp.device_id
-        LEFT JOIN techn_matr     tm ON disp.techn_matr_id = tm.techn_matr_id
-        LEFT JOIN country        co ON m.country_id       = co.country_id
-        WHERE 1=1
-    '''
-
     with get_conn() as conn:
         cur = tup_cur(conn)
-        cur.execute("""
-            SELECT DISTINCT m.manufacturer_id, m.name
-            FROM manufacturers m
-            JOIN devices d ON d.manufacturer_id = m.manufacturer_id
-        """)
+        cur.execute("SELECT DISTINCT manufacturer_id, manufacturer FROM device_search")
         manufacturers = _sort_ci_tuples(cur.fetchall())
 
-        cur.execute("""
-            SELECT DISTINCT co.country_id, co.name
-            FROM country co
-            JOIN manufacturers m ON m.country_id = co.country_id
-            JOIN devices d ON d.manufacturer_id = m.manufacturer_id
-        """)
+        cur.execute("SELECT DISTINCT country_id, country FROM device_search WHERE country_id IS NOT NULL")
         countries = _sort_ci_tuples(cur.fetchall())
 
         if request.method == 'POST':
             if mode == 'by1' and selected_manufacturer:
-                inner = base_select + ' AND d.manufacturer_id = %s'
-                q = f"SELECT * FROM ({inner}) AS t ORDER BY LOWER(model)"
-                cur.execute(q, (selected_manufacturer,))
-                results = cur.fetchall()
+                results = search_devices(conn, {'manufacturer_id': selected_manufacturer})
 
             elif mode == 'by2' and selected_country and selected_color:
-                inner = base_select + ' AND m.country_id = %s AND d.color_id = %s'
-                q = f"SELECT * FROM ({inner}) AS t ORDER BY LOWER(model)"
-                cur.execute(q, (selected_country, selected_color))
-                results = cur.fetchall()
+                results = search_devices(conn, {'country_id': selected_country, 'color_id': selected_color})
 
     return render_template('search.html',
         mode=mode,
@@ -1388,70 +4488,23 @@ def api_attribute_values():
     other_attr = request.args.get('other_attr')
     other_val = request.args.get('other_val')
 
-    sql_map = {
-        'category':      ('categories', 'category_id', 'name'),
-        'manufacturer':  ('manufacturers', 'manufacturer_id', 'name'),
-        'color':         ('color', 'color_id', 'name'),
-        'storage_type':  ('storage_type', 'storage_type_id', 'name'),
-        'country':       ('country', 'country_id', 'name'),
-        'retailer':      ('retailers', 'retailer_id', 'name'),
-    }
-    if attr not in sql_map:
+    if attr not in FACET_ATTRS:
         return jsonify([])
 
-    table, id_field, name_field = sql_map[attr]
-    query = f"SELECT DISTINCT t.{id_field}, t.{name_field} FROM {table} t "
-    params: List[Any] = []
-
-    if attr == 'storage_type':
-        query += """
-          JOIN specifications s ON t.storage_type_id = s.storage_type_id
-          JOIN devices d ON s.device_id = d.device_id
-        """
-    elif attr == 'country':
-        query += """
-          JOIN manufacturers m ON t.country_id = m.country_id
-          JOIN devices d ON m.manufacturer_id = d.manufacturer_id
-        """
-    elif attr == 'retailer':
-        query += """
-          LEFT JOIN device_retailers dr ON t.retailer_id = dr.retailer_id
-          JOIN devices d ON dr.device_id = d.device_id
-        """
-    else:
-        query += f"JOIN devices d ON d.{id_field} = t.{id_field} "
-
-    if other_attr in sql_map and other_val:
-        other_table, other_id_field, _ = sql_map[other_attr]
-        if other_attr == 'storage_type':
-            query += "LEFT JOIN specifications s2 ON d.device_id = s2.device_id AND s2.storage_type_id = %s "
-        elif other_attr == 'country':
-            query += "JOIN manufacturers m2 ON d.manufacturer_id = m2.manufacturer_id AND m2.country_id = %s "
-        elif other_attr == 'retailer':
-            query += "LEFT JOIN device_retailers dr2 ON d.device_id = dr2.device_id AND dr2.retailer_id = %s "
-        else:
-            query += f"AND d.{other_id_field} = %s "
-        params.append(other_val)
-
-    with get_conn() as conn:
-        cur = tup_cur(conn)
-        cur.execute(query, params)
-        data = [{'id': row[0], 'name': row[1]} for row in cur.fetchall()]
-        data = _sort_ci_dicts(data, 'name')
-    return jsonify(data)
+    index = facet_index()
+    filters = {other_attr: other_val} if other_attr in FACET_ATTRS and other_val else {}
+    return jsonify(index.counts(attr, index.match(filters)))
 
 @app.route('/api/category_price_range')
 def api_category_price_range():
     category_id = request.args.get('category_id')
+    try:
+        key = int(category_id) if category_id and category_id != "all" else None
+    except ValueError:
+        key = -1
     with get_conn() as conn:
-        cur = tup_cur(conn)
-        if category_id and category_id != "all":
-            cur.execute("SELECT MIN(current_price), MAX(current_price) FROM devices WHERE category_id = %s", (category_id,))
-        else:
-            cur.execute("SELECT MIN(current_price), MAX(current_price) FROM devices")
-        row = cur.fetchone()
-    min_price = int(row[0] or 0)
-    max_price = int(row[1] or 0)
+        backend = refresh_price_index(conn)
+    min_price, max_price = price_bounds(backend, key)
     return {'min': min_price, 'max': max_price}
 
 @app.route('/api/auto_search')
@@ -1460,46 +4513,12 @@ def api_auto_search():
     manufacturer_id = request.args.get('manufacturer_id', "all")
     color_id = request.args.get('color_id', "all")
 
-    query = '''
-        SELECT DISTINCT
-            d.device_id,
-            ml.name AS model,
-            m.name  AS manufacturer,
-            c.name  AS category,
-            col.name AS color,
-            co.name AS country,
-            st.name AS storage_type,
-            pm.name AS proc_model,
-            tm.name AS techn_matr,
-            d.current_price
-        FROM devices d
-        JOIN model ml ON model_id = ml.model_id
-        JOIN manufacturers m ON d.manufacturer_id = m.manufacturer_id
-        JOIN categories    c ON d.category_id     = c.category_id
-        JOIN color       col ON d.color_id        = col.color_id
-        LEFT JOIN specifications s  ON d.device_id    = s.device_id
-        LEFT JOIN storage_type   st ON s.storage_type_id = st.storage_type_id
-        LEFT JOIN proc_model     pm ON s.proc_model_id   = pm.proc_model_id
-        LEFT JOIN displays     disp ON d.device_id       = disp.device_id
-        LEFT JOIN techn_matr     tm ON disp.techn_matr_id = tm.techn_matr_id
-        LEFT JOIN country        co ON m.country_id       = co.country_id
-        WHERE 1=1
-    '''
-    params: List[Any] = []
-    if category_id != "all":
-        query += " AND d.category_id = %s"
-        params.append(category_id)
-    if manufacturer_id != "all":
-        query += " AND d.manufacturer_id = %s"
-        params.append(manufacturer_id)
-    if color_id != "all":
-        query += " AND d.color_id = %s"
-        params.append(color_id)
-
     with get_conn() as conn:
-        cur = tup_cur(conn)
-        cur.execute(query + " ORDER BY LOWER(d.model)", params)
-        results = cur.fetchall()
+        results = search_devices(conn, {
+            'category_id': category_id,
+            'manufacturer_id': manufacturer_id,
+            'color_id': color_id,
+        })
     return render_template('search_results_table.html', results=results)
 
 @app.route('/api/filter_options')
@@ -1507,39 +4526,12 @@ def api_filter_options():
     category_id = request.args.get('category_id')
     manufacturer_id = request.args.get('manufacturer_id')
 
-    with get_conn() as conn:
-        cur = tup_cur(conn)
-        q = """
-            SELECT DISTINCT m.manufacturer_id, m.name
-            FROM manufacturers m
-            JOIN devices d ON m.manufacturer_id = d.manufacturer_id
-            WHERE 1=1
-        """
-        params: List[Any] = []
-        if category_id and category_id != "all":
-            q += " AND d.category_id = %s"
-            params.append(category_id)
-        cur.execute(q, params)
-        manufacturers = [{'manufacturer_id': row[0], 'name': row[1]} for row in cur.fetchall()]
-        manufacturers = _sort_ci_dicts(manufacturers, 'name')
-
-        q = """
-            SELECT DISTINCT col.color_id, col.name
-            FROM color col
-            JOIN devices d ON col.color_id = d.color_id
-            WHERE 1=1
-        """
-        params = []
-        if category_id and category_id != "all":
-            q += " AND d.category_id = %s"
-            params.append(category_id)
-        if manufacturer_id and manufacturer_id != "all":
-            q += " AND d.manufacturer_id = %s"
-            params.append(manufacturer_id)
-        cur.execute(q, params)
-        colors = [{'color_id': row[0], 'name': row[1]} for row in cur.fetchall()]
-        colors = _sort_ci_dicts(colors, 'name')
-
+    index = facet_index()
+    manufacturers = [{'manufacturer_id': item['id'], 'name': item['name'], 'count': item['count']}
+                     for item in index.counts('manufacturer', index.match({'category': category_id}))]
+    colors = [{'color_id': item['id'], 'name': item['name'], 'count': item['count']}
+              for item in index.counts('color', index.match({'category': category_id,
+                                                             'manufacturer': manufacturer_id}))]
     return jsonify({'manufacturers': manufacturers, 'colors': colors})
 
 # -------------------------------------------------
@@ -1561,12 +4553,11 @@ def add_manufacturer():
             return redirect(url_for('add_manufacturer'))
 
         with get_conn() as conn:
-            cur = tup_cur(conn)
-            new_id, _ = next_id(conn, 'manufacturers')
-            cur.execute("""
-                INSERT INTO manufacturers (manufacturer_id, name, country_id, foundation_year, website)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (new_id, name, country_id, foundation_year, website))
+            insert_returning_id(conn, 'manufacturers', {
+                'name': name, 'country_id': country_id,
+                'foundation_year': foundation_year, 'website': website,
+            }, 'manufacturer_id')
+            notify_data_change(conn, 'manufacturers', [])
             conn.commit()
 
         next_url = request.form.get('next_url')
@@ -1576,11 +4567,7 @@ def add_manufacturer():
         else:
             return redirect(url_for('add_manufacturer'))
 
-    with get_conn() as conn:
-        cur = tup_cur(conn)
-        cur.execute("SELECT country_id, name FROM country")
-        countries = _sort_ci_tuples(cur.fetchall())
-    return render_template('add_manufacturer.html', countries=countries, message=message, next_url=next_url)
+    return render_reference_form('add_manufacturer.html', ['countries'], message=message, next_url=next_url)
 
 @app.route('/add_category', methods=['GET', 'POST'])
 @admin_required
@@ -1590,9 +4577,8 @@ def add_category():
         name = request.form.get('name')
         description = request.form.get('description')
         with get_conn() as conn:
-            cur = tup_cur(conn)
-            new_id, _ = next_id(conn, 'categories')
-            cur.execute("INSERT INTO categories (category_id, name, description) VALUES (%s, %s, %s)", (new_id, name, description))
+            insert_returning_id(conn, 'categories', {'name': name, 'description': description}, 'category_id')
+            notify_data_change(conn, 'categories', [])
             conn.commit()
         next_url = request.form.get('next_url')
         flash('Категория добавлена!', 'success')
@@ -1608,29 +4594,23 @@ def add_os():
     today = _Date.today().isoformat()
     next_url = request.args.get('next')
 
-    with get_conn() as conn:
-        cur = tup_cur(conn)
-        cur.execute("SELECT os_name_id, name FROM os_name")
-        os_names = _sort_ci_tuples(cur.fetchall())
-
     if request.method == 'POST':
         os_name_id = request.form.get('os_name_id')
         developer = request.form.get('developer')
         latest_version = request.form.get('latest_version')
         release_date = request.form.get('release_date')
         with get_conn() as conn:
-            cur = tup_cur(conn)
-            new_id, _ = next_id(conn, 'operating_systems')
-            cur.execute("""
-                INSERT INTO operating_systems (os_id, os_name_id, developer, latest_version, release_date)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (new_id, os_name_id, developer, latest_version, release_date))
+            insert_returning_id(conn, 'operating_systems', {
+                'os_name_id': os_name_id, 'developer': developer,
+                'latest_version': latest_version, 'release_date': release_date,
+            }, 'os_id')
+            notify_data_change(conn, 'operating_systems', [])
             conn.commit()
         flash('Операционная система добавлена!', 'success')
         if request.form.get('next_url'):
             return redirect(request.form['next_url'])
         return redirect(url_for('add_os'))
-    return render_template('add_os.html', os_names=os_names, today=today, next_url=next_url)
+    return render_reference_form('add_os.html', ['os_names'], today=today, next_url=next_url)
 
 @app.route('/add_retailer', methods=['GET', 'POST'])
 @admin_required
@@ -1648,9 +4628,8 @@ def add_retailer():
             flash("Рейтинг должен быть от 0.1 до 5.0", "danger")
             return redirect(request.url)
         with get_conn() as conn:
-            cur = tup_cur(conn)
-            new_id, _ = next_id(conn, 'retailers')
-            cur.execute("INSERT INTO retailers (retailer_id, name, website, rating) VALUES (%s, %s, %s, %s)", (new_id, name, website, rating))
+            insert_returning_id(conn, 'retailers', {'name': name, 'website': website, 'rating': rating}, 'retailer_id')
+            notify_data_change(conn, 'retailers', [])
             conn.commit()
         next_url = request.form.get('next_url')
         flash('Продавец добавлен!', 'success')
@@ -1662,6 +4641,165 @@ def add_retailer():
 
 
 
+# -------------------------------------------------
+# Предзаполнение доп. характеристик по модели
+# -------------------------------------------------
+# model_id -> доп. характеристики двух последних устройств модели (второе нужно,
+# когда последнее — само редактируемое устройство). Один запрос на модель, дальше из памяти.
+# Сброс — после commit записи; PREFILL_CACHE_TTL ограничивает отставание от других процессов.
+PREFILL_CACHE_SIZE = env_int("PREFILL_CACHE_SIZE", 5000)
+PREFILL_CACHE_TTL = env_int("PREFILL_CACHE_TTL", 300)
+PREFILL_TABLES = {'devices', 'specifications', 'displays', 'cameras', 'batteries'}
+
+# (столбец-признак наличия, [(поле ответа, столбец, приведение)])
+_PREFILL_PARTS = [
+    ('s.spec_id', [
+        ('proc_model_id', 's.proc_model_id', None), ('processor_cores', 's.processor_cores', None),
+        ('ram_gb', 's.ram_gb', None), ('storage_gb', 's.storage_gb', None),
+        ('storage_type_id', 's.storage_type_id', None)]),
+    ('disp.display_id', [
+        ('diagonal_inches', 'disp.diagonal_inches', None), ('resolution', 'disp.resolution', None),
+        ('techn_matr_id', 'disp.techn_matr_id', None), ('refresh_rate_hz', 'disp.refresh_rate_hz', None),
+        ('brightness_nits', 'disp.brightness_nits', None)]),
+    ('cam.camera_id', [
+        ('megapixels_main', 'cam.megapixels_main', None), ('aperture_main', 'cam.aperture_main', None),
+        ('optical_zoom_x', 'cam.optical_zoom_x', None), ('video_resolution', 'cam.video_resolution', None),
+        ('has_ai_enhance', 'cam.has_ai_enhance', bool)]),
+    ('b.battery_id', [
+        ('capacity_mah', 'b.capacity_mah', None), ('fast_charging_w', 'b.fast_charging_w', None),
+        ('estimated_life_hours', 'b.estimated_life_hours', None), ('wireless_charging', 'b.wireless_charging', bool)]),
+]
+_PREFILL_SQL = "SELECT d.device_id, " + ", ".join(
+    col for flag, fields in _PREFILL_PARTS for col in [flag] + [f[1] for f in fields]
+) + """
+    FROM devices d
+    LEFT JOIN specifications s ON s.device_id = d.device_id
+    LEFT JOIN displays disp ON disp.device_id = d.device_id
+    LEFT JOIN cameras cam ON cam.device_id = d.device_id
+    LEFT JOIN batteries b ON b.device_id = d.device_id
+    WHERE d.model_id = %s
+    ORDER BY d.device_id DESC
+    LIMIT 2
+"""
+
+# (backend, model_id) -> (когда прочитано, [(device_id, характеристики)])
+_PREFILL_CACHE: "OrderedDict[Tuple[str, int], Tuple[float, List[Tuple[int, Dict[str, Any]]]]]" = OrderedDict()
+_PREFILL_OWNER: Dict[Tuple[str, int], int] = {}   # (backend, device_id) -> model_id закэшированной записи
+_PREFILL_EPOCH: Dict[str, int] = {}   # backend -> число сбросов; чтение, пересёкшееся со сбросом, не кэшируется
+_PREFILL_LOCK = threading.Lock()
+
+def prefill_from_rows(rows) -> List[Tuple[int, Dict[str, Any]]]:
+    """Строки _PREFILL_SQL -> [(device_id, {поле: значение})]."""
+    result = []
+    for row in rows:
+        scalars: Dict[str, Any] = {}
+        pos = 1
+        for _, fields in _PREFILL_PARTS:
+            if row[pos] is not None:
+                for i, (name, _, cast) in enumerate(fields):
+                    value = row[pos + 1 + i]
+                    scalars[name] = cast(value) if cast else value
+            pos += 1 + len(fields)
+        result.append((row[0], scalars))
+    return result
+
+def _drop_prefill(key: Tuple[str, int]):
+    # вызывается под _PREFILL_LOCK
+    _, latest = _PREFILL_CACHE.pop(key, (0.0, []))
+    for device_id, _ in latest:
+        _PREFILL_OWNER.pop((key[0], device_id), None)
+
+def prefill_lookup(backend: str, model_id: int) -> Optional[List[Tuple[int, Dict[str, Any]]]]:
+    key = (backend, model_id)
+    with _PREFILL_LOCK:
+        hit = _PREFILL_CACHE.get(key)
+        if hit is None:
+            return None
+        if PREFILL_CACHE_TTL and time.monotonic() - hit[0] >= PREFILL_CACHE_TTL:
+            _drop_prefill(key)
+            return None
+        _PREFILL_CACHE.move_to_end(key)
+        return hit[1]
+
+def prefill_epoch(backend: str) -> int:
+    """Снимается до чтения из БД и передаётся в prefill_store."""
+    with _PREFILL_LOCK:
+        return _PREFILL_EPOCH.get(backend, 0)
+
+def prefill_store(backend: str, model_id: int, latest: List[Tuple[int, Dict[str, Any]]], epoch: int):
+    key = (backend, model_id)
+    with _PREFILL_LOCK:
+        if _PREFILL_EPOCH.get(backend, 0) != epoch:
+            return   # пока читали, данные менялись — прочитанное могло устареть
+        _drop_prefill(key)
+        _PREFILL_CACHE[key] = (time.monotonic(), latest)
+        for device_id, _ in latest:
+            _PREFILL_OWNER[(backend, device_id)] = model_id
+        while len(_PREFILL_CACHE) > PREFILL_CACHE_SIZE:
+            _drop_prefill(next(iter(_PREFILL_CACHE)))
+
+def prefill_pick(latest: List[Tuple[int, Dict[str, Any]]],
+                 exclude_device_id: Optional[int] = None) -> Tuple[Optional[int], Dict[str, Any]]:
+    for device_id, scalars in latest:
+        if device_id != exclude_device_id:
+            return device_id, scalars
+    return None, {}
+
+def model_prefill(model_id: int, exclude_device_id: Optional[int] = None) -> Tuple[Optional[int], Dict[str, Any]]:
+    """(id устройства-источника, его доп. характеристики) для последнего устройства модели."""
+    backend = current_backend()
+    latest = prefill_lookup(backend, model_id)
+    if latest is None:
+        epoch = prefill_epoch(backend)
+        with get_conn() as conn:
+            latest = prefill_from_rows(run_queries(conn, [(_PREFILL_SQL, [model_id])])[0])
+        prefill_store(backend, model_id, latest, epoch)
+    return prefill_pick(latest, exclude_device_id)
+
+@on_data_change
+def _prefill_on_change(conn, table_name, device_ids):
+    if table_name not in PREFILL_TABLES:
+        return
+    backend = _conn_backend(conn)
+    if device_ids is None:
+        after_commit(conn, lambda: _prefill_drop(backend, None, []))
+        return
+    ids = sorted({int(i) for i in device_ids})
+    if not ids:
+        return
+    # новое устройство может стать последним в своей модели — модель узнаём из БД
+    # (в этой же транзакции, пока строки видны); удалённое или изменённое имеет
+    # значение, только если оно уже в кэше
+    cur = tup_cur(conn)
+    cur.execute(f"SELECT DISTINCT model_id FROM devices WHERE device_id IN ({', '.join(['%s'] * len(ids))})", ids)
+    models = {row[0] for row in cur.fetchall()}
+    after_commit(conn, lambda: _prefill_drop(backend, models, ids))
+
+def _prefill_drop(backend: str, models: Optional[set], device_ids: List[int]):
+    """Сброс после commit: моделей models и владельцев device_ids; models=None — всего бэкенда."""
+    with _PREFILL_LOCK:
+        _PREFILL_EPOCH[backend] = _PREFILL_EPOCH.get(backend, 0) + 1
+        if models is None:
+            models = {k[1] for k in _PREFILL_CACHE if k[0] == backend}
+        models = set(models) | {_PREFILL_OWNER[(backend, i)] for i in device_ids if (backend, i) in _PREFILL_OWNER}
+        for model_id in models:
+            _drop_prefill((backend, model_id))
+
+DEVICE_MODEL_SQL = "SELECT model_id FROM devices WHERE device_id=%s"
+
+def prefill_owner(backend: str, device_id: int) -> Optional[int]:
+    """model_id устройства, если оно среди закэшированных."""
+    with _PREFILL_LOCK:
+        return _PREFILL_OWNER.get((backend, device_id))
+
+def _device_model_id(device_id: int) -> Optional[int]:
+    model_id = prefill_owner(current_backend(), device_id)
+    if model_id is not None:
+        return model_id
+    with get_conn() as conn:
+        rows = run_queries(conn, [(DEVICE_MODEL_SQL, [device_id])])[0]
+    return rows[0][0] if rows else None
+
 #для дозаполнения
 @app.route('/api/model_prefill', endpoint='api_model_prefill')
 @login_required
@@ -1673,81 +4811,13 @@ def api_model_prefill():
     if not (device_id or model_id):
         return jsonify({'ok': False, 'reason': 'missing_ids'}), 400
 
-    with get_conn() as conn:
-        cur = tup_cur(conn)
-
-        # Если model_id не передали — выясним его по текущему устройству
-        if not model_id:
-            cur.execute("SELECT model_id FROM devices WHERE device_id=%s", (device_id,))
-            row = cur.fetchone()
-            if not row:
-                return jsonify({'ok': False, 'reason': 'device_not_found'}), 404
-            model_id = row[0]
-
-        # Берём последний device этой модели, но не текущий
-        params = [model_id]
-        sql = "SELECT device_id FROM devices WHERE model_id=%s"
-        if device_id:
-            sql += " AND device_id <> %s"
-            params.append(device_id)
-        sql += " ORDER BY device_id DESC LIMIT 1"
-
-        cur.execute(sql, tuple(params))
-        row = cur.fetchone()
-        if not row:
-            return jsonify({'ok': True, 'source_device_id': None, 'scalars': {}})
-
-        src_dev = row[0]
-        scalars = {}
-
-        # specifications
-        cur.execute("""
-            SELECT proc_model_id, processor_cores, ram_gb, storage_gb, storage_type_id
-            FROM specifications WHERE device_id=%s
-        """, (src_dev,))
-        r = cur.fetchone()
-        if r:
-            scalars.update({
-                'proc_model_id': r[0], 'processor_cores': r[1],
-                'ram_gb': r[2], 'storage_gb': r[3], 'storage_type_id': r[4],
-            })
-
-        # displays
-        cur.execute("""
-            SELECT diagonal_inches, resolution, techn_matr_id, refresh_rate_hz, brightness_nits
-            FROM displays WHERE device_id=%s
-        """, (src_dev,))
-        r = cur.fetchone()
-        if r:
-            scalars.update({
-                'diagonal_inches': r[0], 'resolution': r[1], 'techn_matr_id': r[2],
-                'refresh_rate_hz': r[3], 'brightness_nits': r[4],
-            })
-
-        # cameras
-        cur.execute("""
-            SELECT megapixels_main, aperture_main, optical_zoom_x, video_resolution, has_ai_enhance
-            FROM cameras WHERE device_id=%s
-        """, (src_dev,))
-        r = cur.fetchone()
-        if r:
-            scalars.update({
-                'megapixels_main': r[0], 'aperture_main': r[1], 'optical_zoom_x': r[2],
-                'video_resolution': r[3], 'has_ai_enhance': bool(r[4]),
-            })
-
-        # batteries
-        cur.execute("""
-            SELECT capacity_mah, fast_charging_w, estimated_life_hours, wireless_charging
-            FROM batteries WHERE device_id=%s
-        """, (src_dev,))
-        r = cur.fetchone()
-        if r:
-            scalars.update({
-                'capacity_mah': r[0], 'fast_charging_w': r[1],
-                'estimated_life_hours': r[2], 'wireless_charging': bool(r[3]),
-            })
+    # Если model_id не передали — выясним его по текущему устройству
+    if not model_id:
+        model_id = _device_model_id(device_id)
+        if model_id is None:
+            return jsonify({'ok': False, 'reason': 'device_not_found'}), 404
 
+    src_dev, scalars = model_prefill(model_id, exclude_device_id=device_id)
     return jsonify({'ok': True, 'source_device_id': src_dev, 'scalars': scalars})
 
 # -------------------------------------------------
@@ -1768,23 +4838,12 @@ def edit_extras(device_id):
     with get_conn() as conn:
         cur = tup_cur(conn)
 
-        cur.execute("""
-            SELECT aperture_main
-            FROM cameras
-            WHERE aperture_main IS NOT NULL
-            GROUP BY aperture_main
-            ORDER BY LOWER(aperture_main)
-        """)
-        aperture_main = [row[0] for row in cur.fetchall() if row[0]]
-
-        cur.execute("SELECT proc_model_id, name FROM proc_model")
-        proc_models = _sort_ci_tuples(cur.fetchall())
-
-        cur.execute("SELECT storage_type_id, name FROM storage_type")
-        storage_types = _sort_ci_tuples(cur.fetchall())
-
-        cur.execute("SELECT techn_matr_id, name FROM techn_matr")
-        techn_matrices = _sort_ci_tuples(cur.fetchall())
+        refs = reference_data(['aperture_main', 'proc_models', 'storage_types', 'techn_matrices', 'retailers'], conn)
+        aperture_main = refs['aperture_main']
+        proc_models = refs['proc_models']
+        storage_types = refs['storage_types']
+        techn_matrices = refs['techn_matrices']
+        retailers = refs['retailers']
 
         cur.execute("SELECT * FROM specifications WHERE device_id=%s", (device_id,))
         spec = cur.fetchone()
@@ -1798,9 +4857,6 @@ def edit_extras(device_id):
         cur.execute("SELECT * FROM batteries WHERE device_id=%s", (device_id,))
         battery = cur.fetchone()
 
-        cur.execute("SELECT retailer_id, name FROM retailers")
-        retailers = _sort_ci_tuples(cur.fetchall())
-
         cur.execute("""
             SELECT dr.device_retailer_id, dr.retailer_id, r.name, dr.price, dr.in_stock, dr.last_updated
             FROM device_retailers dr
@@ -1842,7 +4898,6 @@ def edit_extras(device_id):
             if data:
                 with get_conn() as conn:
                     cur = tup_cur(conn)
-                    new_id1, _ = next_id(conn, 'specifications')
                     cur.execute("SELECT spec_id FROM specifications WHERE device_id=%s", (device_id,))
                     exists = cur.fetchone()
                     if exists:
@@ -1850,10 +4905,8 @@ def edit_extras(device_id):
                         cur.execute(f"UPDATE specifications SET {sets} WHERE device_id=%s",
                                     (*data.values(), device_id))
                     else:
-                        fields = ", ".join(['spec_id'] + ['device_id'] + list(data.keys()))
-                        ph = ", ".join(['%s'] * (len(data) + 2))
-                        cur.execute(f"INSERT INTO specifications ({fields}) VALUES ({ph})",
-                                    (new_id1, device_id, *data.values()))
+                        insert_returning_id(conn, 'specifications', dict(data, device_id=device_id), 'spec_id')
+                    notify_data_change(conn, 'specifications', [device_id])
                     conn.commit()
                 flash("Спецификация обновлена", "success")
 
@@ -1874,7 +4927,6 @@ def edit_extras(device_id):
 
             with get_conn() as conn:
                 cur = tup_cur(conn)
-                new_id2, _ = next_id(conn, 'displays')
                 cur.execute("SELECT display_id FROM displays WHERE device_id=%s", (device_id,))
                 exists = cur.fetchone()
                 if exists:
@@ -1885,10 +4937,12 @@ def edit_extras(device_id):
                         WHERE device_id=%s
                     """, (diagonal_inches, resolution, techn_matr_id, refresh_rate_hz, brightness_nits, device_id))
                 else:
-                    cur.execute("""
-                        INSERT INTO displays (display_id, device_id, diagonal_inches, resolution, techn_matr_id, refresh_rate_hz, brightness_nits)
-                        VALUES (%s,%s,%s,%s,%s,%s,%s)
-                    """, (new_id2, device_id, diagonal_inches, resolution, techn_matr_id, refresh_rate_hz, brightness_nits))
+                    insert_returning_id(conn, 'displays', {
+                        'device_id': device_id, 'diagonal_inches': diagonal_inches, 'resolution': resolution,
+                        'techn_matr_id': techn_matr_id, 'refresh_rate_hz': refresh_rate_hz,
+                        'brightness_nits': brightness_nits,
+                    }, 'display_id')
+                notify_data_change(conn, 'displays', [device_id])
                 conn.commit()
             flash("Дисплей обновлён", "success")
 
@@ -1918,11 +4972,12 @@ def edit_extras(device_id):
                         WHERE device_id=%s
                     """, (megapixels_main, aperture_main, optical_zoom_x, video_resolution, has_ai_enhance, device_id))
                 else:
-                    new_id3, _ = next_id(conn, 'cameras')
-                    cur.execute("""
-                        INSERT INTO cameras (camera_id, device_id, megapixels_main, aperture_main, optical_zoom_x, video_resolution, has_ai_enhance)
-                        VALUES (%s,%s,%s,%s,%s,%s, %s)
-                    """, (new_id3, device_id, megapixels_main, aperture_main, optical_zoom_x, video_resolution, has_ai_enhance))
+                    insert_returning_id(conn, 'cameras', {
+                        'device_id': device_id, 'megapixels_main': megapixels_main, 'aperture_main': aperture_main,
+                        'optical_zoom_x': optical_zoom_x, 'video_resolution': video_resolution,
+                        'has_ai_enhance': has_ai_enhance,
+                    }, 'camera_id')
+                notify_data_change(conn, 'cameras', [device_id])
                 conn.commit()
             flash("Камера обновлена", "success")
 
@@ -1940,7 +4995,6 @@ def edit_extras(device_id):
 
             with get_conn() as conn:
                 cur = tup_cur(conn)
-                new_id4, _ = next_id(conn, 'batteries')
                 cur.execute("SELECT battery_id FROM batteries WHERE device_id=%s", (device_id,))
                 exists = cur.fetchone()
                 if exists:
@@ -1950,10 +5004,11 @@ def edit_extras(device_id):
                         WHERE device_id=%s
                     """, (capacity_mah, fast_charging_w, wireless_charging, estimated_life_hours, device_id))
                 else:
-                    cur.execute("""
-                        INSERT INTO batteries (battery_id, device_id, capacity_mah, fast_charging_w, wireless_charging, estimated_life_hours)
-                        VALUES (%s,%s,%s,%s,%s,%s)
-                    """, (new_id4, device_id, capacity_mah, fast_charging_w, wireless_charging, estimated_life_hours))
+                    insert_returning_id(conn, 'batteries', {
+                        'device_id': device_id, 'capacity_mah': capacity_mah, 'fast_charging_w': fast_charging_w,
+                        'wireless_charging': wireless_charging, 'estimated_life_hours': estimated_life_hours,
+                    }, 'battery_id')
+                notify_data_change(conn, 'batteries', [device_id])
                 conn.commit()
             flash("Батарея обновлена", "success")
 
@@ -1966,35 +5021,24 @@ def edit_extras(device_id):
                 last_updated = request.form.get('last_updated') or today
 
                 try:
+                    retailer_id = int(retailer_id)
                     price_val = float(site_price)
                     if not (0.0 <= price_val <= 1_000_000.0): raise ValueError
                     _DT.strptime(last_updated, "%Y-%m-%d")
                 except:
-                    flash('Проверьте цену (0–1 000 000) и дату (YYYY-MM-DD).', 'danger'); return back_to_extras()
+                    flash('Проверьте продавца, цену (0–1 000 000) и дату (YYYY-MM-DD).', 'danger'); return back_to_extras()
 
                 with get_conn() as conn:
-                    cur = tup_cur(conn)
-                    new_id5, _ = next_id(conn, 'device_retailers')
-                    cur.execute("""
-                        SELECT device_retailer_id
-                        FROM device_retailers
-                        WHERE device_id=%s AND retailer_id=%s
-                    """, ( device_id, retailer_id))
-                    row = cur.fetchone()
-                    if row:
-                        cur.execute("""
-                            UPDATE device_retailers
-                            SET price=%s, in_stock=%s, last_updated=%s
-                            WHERE device_retailer_id=%s
-                        """, (price_val, in_stock, last_updated, row[0]))
-                        msg = 'Предложение обновлено.'
-                    else:
-                        cur.execute("""
-                            INSERT INTO device_retailers (device_retailer_id, device_id, retailer_id, price, in_stock, last_updated)
-                            VALUES (%s,%s,%s,%s,%s,%s)
-                        """, (new_id5, device_id, retailer_id, price_val, in_stock, last_updated))
-                        msg = 'Продавец добавлен для устройства.'
+                    # форма пишет всегда — и с той же ценой обновляет дату
+                    try:
+                        result = upsert_offers(conn, [{
+                            'device_id': device_id, 'retailer_id': retailer_id, 'price': price_val,
+                            'in_stock': in_stock, 'last_updated': last_updated,
+                        }], only_changed=False)
+                    except RuntimeError as e:
+                        flash(str(e), 'danger'); return back_to_extras()
                     conn.commit()
+                msg = 'Продавец добавлен для устройства.' if result['inserted'] else 'Предложение обновлено.'
                 flash(msg, 'success')
                 return back_to_extras()
 
@@ -2006,7 +5050,12 @@ def edit_extras(device_id):
                     flash('Некорректный идентификатор предложения.', 'danger'); return back_to_extras()
                 with get_conn() as conn:
                     cur = tup_cur(conn)
+                    cur.execute("SELECT retailer_id FROM device_retailers WHERE device_retailer_id=%s AND device_id=%s", (dr_id, device_id))
+                    removed = [{'device_id': device_id, 'retailer_id': r[0], 'price': None, 'in_stock': False}
+                               for r in cur.fetchall()]
                     cur.execute("DELETE FROM device_retailers WHERE device_retailer_id=%s AND device_id=%s", (dr_id, device_id))
+                    record_price_history(conn, removed)
+                    notify_data_change(conn, 'device_retailers', [device_id])
                     conn.commit()
                     if cur.rowcount and cur.rowcount > 0:
                         flash('Предложение удалено.', 'success')
@@ -2038,83 +5087,17 @@ def api_last_specs():
     model_id = request.args.get('model_id', type=int)
     device_id = request.args.get('device_id', type=int)
 
-    with get_conn() as conn:
-        cur = tup_cur(conn)
-
-        # Если пришёл только device_id — выясним его model_id
-        if not model_id and device_id:
-            cur.execute("SELECT model_id FROM devices WHERE device_id=%s", (device_id,))
-            row = cur.fetchone()
-            if not row:
-                return jsonify({'ok': False, 'reason': 'device_not_found'}), 404
-            model_id = row[0]
-
-        if not model_id:
-            return jsonify({'ok': False, 'reason': 'missing_ids'}), 400
+    # Если пришёл только device_id — выясним его model_id
+    if not model_id and device_id:
+        model_id = _device_model_id(device_id)
+        if model_id is None:
+            return jsonify({'ok': False, 'reason': 'device_not_found'}), 404
 
-        # Берём последний device этой модели
-        cur.execute("""
-            SELECT device_id
-            FROM devices
-            WHERE model_id=%s
-            ORDER BY device_id DESC
-            LIMIT 1
-        """, (model_id,))
-        row = cur.fetchone()
-        if not row:
-            return jsonify({'ok': True, 'scalars': {}, 'source_device_id': None})
-        src_dev = row[0]
-
-        scalars = {}
-
-        # specifications
-        cur.execute("""
-            SELECT proc_model_id, processor_cores, ram_gb, storage_gb, storage_type_id
-            FROM specifications WHERE device_id=%s
-        """, (src_dev,))
-        r = cur.fetchone()
-        if r:
-            scalars.update({
-                'proc_model_id': r[0], 'processor_cores': r[1],
-                'ram_gb': r[2], 'storage_gb': r[3], 'storage_type_id': r[4],
-            })
-
-        # displays
-        cur.execute("""
-            SELECT diagonal_inches, resolution, techn_matr_id, refresh_rate_hz, brightness_nits
-            FROM displays WHERE device_id=%s
-        """, (src_dev,))
-        r = cur.fetchone()
-        if r:
-            scalars.update({
-                'diagonal_inches': r[0], 'resolution': r[1], 'techn_matr_id': r[2],
-                'refresh_rate_hz': r[3], 'brightness_nits': r[4],
-            })
-
-        # cameras
-        cur.execute("""
-            SELECT megapixels_main, aperture_main, optical_zoom_x, video_resolution, has_ai_enhance
-            FROM cameras WHERE device_id=%s
-        """, (src_dev,))
-        r = cur.fetchone()
-        if r:
-            scalars.update({
-                'megapixels_main': r[0], 'aperture_main': r[1], 'optical_zoom_x': r[2],
-                'video_resolution': r[3], 'has_ai_enhance': bool(r[4]),
-            })
-
-        # batteries
-        cur.execute("""
-            SELECT capacity_mah, fast_charging_w, estimated_life_hours, wireless_charging
-            FROM batteries WHERE device_id=%s
-        """, (src_dev,))
-        r = cur.fetchone()
-        if r:
-            scalars.update({
-                'capacity_mah': r[0], 'fast_charging_w': r[1],
-                'estimated_life_hours': r[2], 'wireless_charging': bool(r[3]),
-            })
+    if not model_id:
+        return jsonify({'ok': False, 'reason': 'missing_ids'}), 400
 
+    # Берём последний device этой модели (включая сам device_id)
+    src_dev, scalars = model_prefill(model_id)
     return jsonify({'ok': True, 'source_device_id': src_dev, 'scalars': scalars})
 
 
@@ -2138,6 +5121,122 @@ def switch_db(backend):
         return redirect(request.referrer or url_for('index'))
     flash(f"Переключено на {backend_name()}.", "success")
     return redirect(request.referrer or url_for('index'))
+
+@app.route('/admin/pool')
+@admin_required
+def admin_pool_stats():
+    return jsonify({name: pool.stats() for name, pool in _POOLS.items()})
+
+@app.route('/admin/perf')
+@admin_required
+def admin_perf():
+    """Сводка замеров SQL этого процесса: эндпоинты, отпечатки запросов, медленные запросы."""
+    stats = SQL_STATS.snapshot()
+    if request.args.get('format') == 'json':
+        return jsonify(stats)
+    for entry in stats['slow']:
+        entry['at'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['at']))
+    stats['since'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stats['since']))
+    return render_template('admin_perf.html', stats=stats, enabled=SQL_STATS_ENABLED,
+                           slow_query_ms=SLOW_QUERY_MS, pools={n: p.stats() for n, p in _POOLS.items()})
+
+@app.route('/admin/perf/reset', methods=['POST'])
+@admin_required
+def admin_perf_reset():
+    SQL_STATS.reset()
+    flash('Счётчики SQL сброшены.', 'success')
+    return redirect(url_for('admin_perf'))
+
+def _prom_label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def perf_metrics_text() -> str:
+    """
+    Замеры в текстовом формате Prometheus (0.0.4). Счётчики у каждого процесса свои,
+    поэтому у всех рядов есть метка pid: под gunicorn ответ даёт тот воркер, к которому
+    попал запрос, и без метки ряды разных воркеров выглядели бы сбросами счётчика.
+    """
+    stats = SQL_STATS.snapshot()
+    lines: List[str] = []
+    pid = str(os.getpid())
+
+    def metric(name: str, kind: str, help_text: str, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_str = ",".join(f'{k}="{_prom_label(v)}"' for k, v in dict(labels, pid=pid).items())
+            lines.append(f"{name}{{{label_str}}} {value}")
+
+    by_backend: Dict[str, Dict[str, float]] = {}
+    for q in stats['queries']:
+        agg = by_backend.setdefault(q['backend'], {'calls': 0, 'ms': 0.0, 'rows': 0, 'errors': 0, 'slow': 0})
+        for key in agg:
+            agg[key] += q[key]
+    metric("app_sql_queries_total", "counter", "SQL statements executed",
+           [({'backend': b}, a['calls']) for b, a in by_backend.items()])
+    metric("app_sql_seconds_total", "counter", "Time spent in SQL (execute and fetch)",
+           [({'backend': b}, round(a['ms'] / 1000.0, 6)) for b, a in by_backend.items()])
+    metric("app_sql_rows_total", "counter", "Rows fetched or affected",
+           [({'backend': b}, a['rows']) for b, a in by_backend.items()])
+    metric("app_sql_errors_total", "counter", "Failed SQL statements",
+           [({'backend': b}, a['errors']) for b, a in by_backend.items()])
+    metric("app_sql_slow_queries_total", "counter", f"Statements slower than {SLOW_QUERY_MS:g} ms",
+           [({}, stats['slow_total'])])
+
+    top = stats['queries'][:SQL_METRICS_TOP]
+    metric("app_sql_query_calls_total", "counter", "Executions per query fingerprint (top by time)",
+           [({'backend': q['backend'], 'query_id': q['id']}, q['calls']) for q in top])
+    metric("app_sql_query_seconds_total", "counter", "Time per query fingerprint (top by time)",
+           [({'backend': q['backend'], 'query_id': q['id']}, round(q['ms'] / 1000.0, 6)) for q in top])
+    metric("app_sql_query_max_seconds", "gauge", "Slowest execution per query fingerprint (top by time)",
+           [({'backend': q['backend'], 'query_id': q['id']}, round(q['max_ms'] / 1000.0, 6)) for q in top])
+
+    eps = stats['endpoints']
+    metric("app_http_requests_total", "counter", "Finished requests per endpoint",
+           [({'endpoint': e['endpoint']}, e['requests']) for e in eps])
+    metric("app_http_sql_queries_total", "counter", "SQL statements per endpoint",
+           [({'endpoint': e['endpoint']}, e['queries']) for e in eps])
+    metric("app_http_sql_seconds_total", "counter", "SQL time per endpoint",
+           [({'endpoint': e['endpoint']}, round(e['ms'] / 1000.0, 6)) for e in eps])
+    metric("app_http_sql_queries_max", "gauge", "Most SQL statements in one request per endpoint",
+           [({'endpoint': e['endpoint']}, e['max_queries']) for e in eps])
+
+    pools = {n: p.stats() for n, p in _POOLS.items()}
+    for key, kind in (('in_use', 'gauge'), ('idle', 'gauge'), ('checkouts', 'counter'),
+                      ('waits', 'counter'), ('timeouts', 'counter')):
+        name = f"app_db_pool_{key}" + ("_total" if kind == 'counter' else "")
+        metric(name, kind, f"Connection pool {key}", [({'backend': n}, st[key]) for n, st in pools.items()])
+    return "\n".join(lines) + "\n"
+
+@app.route('/admin/perf/metrics')
+def admin_perf_metrics():
+    """Для Prometheus: `Authorization: Bearer $METRICS_TOKEN` или вход администратора."""
+    auth = request.headers.get('Authorization', '')
+    if not (METRICS_TOKEN and hmac.compare_digest(auth.encode(), f"Bearer {METRICS_TOKEN}".encode())):
+        if not (current_user.is_authenticated and getattr(current_user, 'is_admin', False)):
+            abort(403)
+    return Response(perf_metrics_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def check_backend(backend: str) -> Optional[str]:
+    """None, если бэкенд отвечает на SELECT 1, иначе текст ошибки."""
+    try:
+        with get_conn(backend) as conn:
+            run_queries(conn, [("SELECT 1", [])])
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    return None
+
+@app.route('/healthz')
+def healthz():
+    """Проверка для балансировщика: основной бэкенд и те, к которым процесс уже подключался."""
+    result = {}
+    for backend in sorted({DB_DEFAULT} | set(_POOLS)):
+        error = check_backend(backend)
+        if error:
+            app.logger.warning("healthz %s: %s", backend, error)
+        result[backend] = 'down' if error else 'ok'
+    return jsonify(result), 503 if result[DB_DEFAULT] != 'ok' else 200
+
 if __name__ == '__main__':
     app.run(debug=True)
     #app.run(host="0.0.0.0", port=5000, debug=True)
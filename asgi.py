@@ -0,0 +1,414 @@
+# asgi.py
+"""
+ASGI-режим: лёгкие JSON-эндпоинты поиска и формы работают асинхронно,
+остальное — то же Flask-приложение через WsgiToAsgi (в пуле потоков).
+
+Запуск:
+    pip install uvicorn asgiref asyncpg aiosqlite
+    uvicorn asgi:application --workers 4
+
+Асинхронно обслуживаются GET-запросы:
+    /api/attribute_values, /api/filter_options, /api/category_price_range,
+    /api/auto_search, /api/model_prefill, /api/last_specs
+
+Они используют те же индексы в памяти, что и Flask-версии (фасеты, цены,
+предзаполнение): прогретый индекс отвечает вообще без обращения к БД, а
+изменения, накопленные с прошлого запроса, дочитываются через асинхронный
+пул (asyncpg для PostgreSQL, aiosqlite для SQLite) — поток на время
+ожидания БД не занимается. Ответы совпадают с ответами Flask байт в байт.
+
+Бэкенд и вход пользователя берутся из той же подписанной cookie сессии Flask;
+для /api/model_prefill и /api/last_specs, как и у @login_required, пользователь
+проверяется по таблице users. Без входа запрос целиком отдаётся Flask — ответ
+тот же (перенаправление на страницу входа или вход по remember-cookie).
+Драйверы нужны только для своего бэкенда: без asyncpg запросы к PG вернут 500.
+"""
+import asyncio
+import re
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from psycopg2.extensions import parse_dsn
+
+import app as web
+from db_pool import PoolTimeout, env_float, env_int
+
+try:
+    import asyncpg
+except ImportError:      # нужен только для PostgreSQL
+    asyncpg = None
+
+try:
+    import aiosqlite
+except ImportError:      # нужен только для SQLite
+    aiosqlite = None
+
+# Размеры асинхронных пулов: ASYNC_PG_POOL_SIZE / ASYNC_SQLITE_POOL_SIZE,
+# ожидание свободного соединения — ASYNC_POOL_TIMEOUT.
+ASYNC_PG_POOL_SIZE = env_int("ASYNC_PG_POOL_SIZE", 10)
+ASYNC_SQLITE_POOL_SIZE = env_int("ASYNC_SQLITE_POOL_SIZE", 5)
+ASYNC_POOL_TIMEOUT = env_float("ASYNC_POOL_TIMEOUT", 30.0)
+
+flask_app = WsgiToAsgi(web.app)
+
+
+# -------------------------------------------------
+# Асинхронные пулы
+# -------------------------------------------------
+_PLACEHOLDER = re.compile(r"%s")
+
+def _pg_sql(sql: str) -> str:
+    """%s -> $1, $2, ... для asyncpg."""
+    counter = iter(range(1, sql.count("%s") + 1))
+    return _PLACEHOLDER.sub(lambda _: f"${next(counter)}", sql)
+
+
+class AsyncPgPool:
+    def __init__(self, size: int, timeout: float):
+        self.size = size
+        self.timeout = timeout
+        self._pool = None
+
+    async def open(self):
+        if asyncpg is None:
+            raise RuntimeError("Для асинхронного режима PostgreSQL нужен пакет asyncpg")
+        params = parse_dsn(web.PG_DSN)
+        if 'dbname' in params:
+            params['database'] = params.pop('dbname')
+        if 'sslmode' in params:
+            # asyncpg понимает строки libpq (require, verify-full, ...); без ssl= было бы prefer
+            params['ssl'] = params.pop('sslmode')
+        self._pool = await asyncpg.create_pool(min_size=1, max_size=self.size, **params)
+
+    async def fetch(self, sql: str, params: List[Any]) -> List[tuple]:
+        try:
+            conn = await self._pool.acquire(timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(f"pg (async): нет свободных соединений (size={self.size}, timeout={self.timeout}s)")
+        try:
+            return [tuple(r) for r in await conn.fetch(_pg_sql(sql), *params)]
+        finally:
+            await self._pool.release(conn)
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+
+
+class AsyncSqlitePool:
+    """Не больше `size` соединений aiosqlite; каждое живёт в своём потоке драйвера."""
+
+    def __init__(self, size: int, timeout: float):
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._idle: "asyncio.LifoQueue" = asyncio.LifoQueue()
+        self._opened = 0
+
+    async def open(self):
+        if aiosqlite is None:
+            raise RuntimeError("Для асинхронного режима SQLite нужен пакет aiosqlite")
+
+    async def _acquire(self):
+        if not self._idle.empty():
+            return self._idle.get_nowait()
+        if self._opened < self.size:
+            self._opened += 1
+            try:
+                conn = await aiosqlite.connect(web.SQLITE_PATH)
+                await conn.execute("PRAGMA foreign_keys = ON")
+                return conn
+            except Exception:
+                self._opened -= 1
+                raise
+        try:
+            return await asyncio.wait_for(self._idle.get(), self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(f"sqlite (async): нет свободных соединений (size={self.size}, timeout={self.timeout}s)")
+
+    async def fetch(self, sql: str, params: List[Any]) -> List[tuple]:
+        conn = await self._acquire()
+        try:
+            async with conn.execute(sql.replace("%s", "?"), params) as cur:
+                rows = [tuple(r) for r in await cur.fetchall()]
+        except Exception:
+            self._opened -= 1
+            await conn.close()
+            raise
+        self._idle.put_nowait(conn)
+        return rows
+
+    async def close(self):
+        while not self._idle.empty():
+            await self._idle.get_nowait().close()
+            self._opened -= 1
+
+
+_POOLS: Dict[str, Any] = {}
+_POOLS_LOCK: Optional[asyncio.Lock] = None
+
+async def get_async_pool(backend: str):
+    """Пул бэкенда; при первом обращении заодно создаётся служебная схема (синхронно, в потоке)."""
+    global _POOLS_LOCK
+    pool = _POOLS.get(backend)
+    if pool is not None:
+        return pool
+    if _POOLS_LOCK is None:
+        _POOLS_LOCK = asyncio.Lock()
+    async with _POOLS_LOCK:
+        pool = _POOLS.get(backend)
+        if pool is None:
+            if backend not in web._AUX_READY:
+                await asyncio.to_thread(_ensure_aux_schema, backend)
+            if backend == "pg":
+                pool = AsyncPgPool(ASYNC_PG_POOL_SIZE, ASYNC_POOL_TIMEOUT)
+            else:
+                pool = AsyncSqlitePool(ASYNC_SQLITE_POOL_SIZE, ASYNC_POOL_TIMEOUT)
+            await pool.open()
+            _POOLS[backend] = pool
+    return pool
+
+def _ensure_aux_schema(backend: str):
+    with web.get_conn(backend):
+        pass
+
+async def fetch(backend: str, sql: str, params: List[Any]) -> List[tuple]:
+    return await (await get_async_pool(backend)).fetch(sql, params)
+
+async def close_pools():
+    pools = list(_POOLS.values())
+    _POOLS.clear()
+    for pool in pools:
+        await pool.close()
+
+
+# -------------------------------------------------
+# Запрос / ответ
+# -------------------------------------------------
+class Request:
+    def __init__(self, scope):
+        self.args = {k: v[0] for k, v in parse_qs(scope.get('query_string', b'').decode('latin-1'),
+                                                   keep_blank_values=True).items()}
+        self.session = _flask_session(scope)
+        self.backend = self.session.get('DB_BACKEND', web.DB_DEFAULT)
+
+    def get_int(self, name: str) -> Optional[int]:
+        """Как request.args.get(name, type=int) во Flask: неразборчивое значение — None."""
+        try:
+            return int(self.args[name])
+        except (KeyError, ValueError):
+            return None
+
+
+def _flask_session(scope) -> Dict[str, Any]:
+    """Содержимое подписанной cookie сессии Flask; {} если её нет или подпись неверна."""
+    cookie_name = web.app.config['SESSION_COOKIE_NAME']
+    raw = None
+    for name, value in scope.get('headers', []):
+        if name == b'cookie':
+            for part in value.decode('latin-1').split(';'):
+                key, _, val = part.strip().partition('=')
+                if key == cookie_name:
+                    raw = val
+    if not raw:
+        return {}
+    serializer = web.app.session_interface.get_signing_serializer(web.app)
+    if serializer is None:
+        return {}
+    try:
+        return serializer.loads(raw, max_age=int(web.app.permanent_session_lifetime.total_seconds()))
+    except Exception:
+        return {}
+
+
+Response = Tuple[int, str, bytes]
+
+def json_response(obj: Any, status: int = 200) -> Response:
+    # тот же сериализатор, что у jsonify: порядок ключей, разделители, формат Decimal/дат
+    with web.app.app_context():
+        body = web.app.json.response(obj).get_data()
+    return status, "application/json", body
+
+
+# -------------------------------------------------
+# Индексы в памяти: дочитывание изменений через асинхронный пул
+# -------------------------------------------------
+async def facet_index(backend: str) -> "web.FacetIndex":
+    index, device_ids = web.facet_pending(backend)
+    if device_ids == []:
+        return index
+    rows = [await fetch(backend, sql, params) for sql, params in web.FacetIndex.queries(device_ids)]
+    return web.facet_store(backend, web.FacetIndex.build_from_rows(*rows, device_ids=device_ids, base=index))
+
+async def refresh_price_index(backend: str):
+    device_ids = web.price_pending(backend)
+    if device_ids != []:
+        (sql, params), = web.PriceIndex.queries(device_ids)
+        web.price_apply(backend, await fetch(backend, sql, params), device_ids)
+
+async def model_prefill(backend: str, model_id: int,
+                        exclude_device_id: Optional[int] = None) -> Tuple[Optional[int], Dict[str, Any]]:
+    latest = web.prefill_lookup(backend, model_id)
+    if latest is None:
+        epoch = web.prefill_epoch(backend)
+        latest = web.prefill_from_rows(await fetch(backend, web._PREFILL_SQL, [model_id]))
+        web.prefill_store(backend, model_id, latest, epoch)
+    return web.prefill_pick(latest, exclude_device_id)
+
+async def device_model_id(backend: str, device_id: int) -> Optional[int]:
+    model_id = web.prefill_owner(backend, device_id)
+    if model_id is not None:
+        return model_id
+    rows = await fetch(backend, web.DEVICE_MODEL_SQL, [device_id])
+    return rows[0][0] if rows else None
+
+
+# -------------------------------------------------
+# Обработчики (зеркало одноимённых маршрутов app.py)
+# -------------------------------------------------
+async def api_attribute_values(req: Request) -> Response:
+    attr = req.args.get('attr')
+    other_attr = req.args.get('other_attr')
+    other_val = req.args.get('other_val')
+
+    if attr not in web.FACET_ATTRS:
+        return json_response([])
+
+    index = await facet_index(req.backend)
+    filters = {other_attr: other_val} if other_attr in web.FACET_ATTRS and other_val else {}
+    return json_response(index.counts(attr, index.match(filters)))
+
+async def api_filter_options(req: Request) -> Response:
+    category_id = req.args.get('category_id')
+    manufacturer_id = req.args.get('manufacturer_id')
+
+    index = await facet_index(req.backend)
+    manufacturers = [{'manufacturer_id': item['id'], 'name': item['name'], 'count': item['count']}
+                     for item in index.counts('manufacturer', index.match({'category': category_id}))]
+    colors = [{'color_id': item['id'], 'name': item['name'], 'count': item['count']}
+              for item in index.counts('color', index.match({'category': category_id,
+                                                             'manufacturer': manufacturer_id}))]
+    return json_response({'manufacturers': manufacturers, 'colors': colors})
+
+async def api_category_price_range(req: Request) -> Response:
+    category_id = req.args.get('category_id')
+    try:
+        key = int(category_id) if category_id and category_id != "all" else None
+    except ValueError:
+        key = -1
+    await refresh_price_index(req.backend)
+    min_price, max_price = web.price_bounds(req.backend, key)
+    return json_response({'min': min_price, 'max': max_price})
+
+async def api_auto_search(req: Request) -> Response:
+    filters = {}
+    for column in ('category_id', 'manufacturer_id', 'color_id'):
+        value = req.args.get(column, "all")
+        if value not in ('', 'all'):
+            # asyncpg не приводит текст к integer сам — нечисловой id ничего не найдёт
+            try:
+                value = int(value)
+            except ValueError:
+                value = -1
+        filters[column] = value
+    sql, params = web.search_devices_query(filters)
+    results = await fetch(req.backend, sql, params)
+    with web.app.test_request_context():
+        html = web.render_template('search_results_table.html', results=results)
+    return 200, "text/html; charset=utf-8", html.encode("utf-8")
+
+async def api_model_prefill(req: Request) -> Response:
+    device_id = req.get_int('device_id')
+    model_id = req.get_int('model_id')
+
+    if not (device_id or model_id):
+        return json_response({'ok': False, 'reason': 'missing_ids'}, 400)
+
+    if not model_id:
+        model_id = await device_model_id(req.backend, device_id)
+        if model_id is None:
+            return json_response({'ok': False, 'reason': 'device_not_found'}, 404)
+
+    src_dev, scalars = await model_prefill(req.backend, model_id, exclude_device_id=device_id)
+    return json_response({'ok': True, 'source_device_id': src_dev, 'scalars': scalars})
+
+async def api_last_specs(req: Request) -> Response:
+    model_id = req.get_int('model_id')
+    device_id = req.get_int('device_id')
+
+    if not model_id and device_id:
+        model_id = await device_model_id(req.backend, device_id)
+        if model_id is None:
+            return json_response({'ok': False, 'reason': 'device_not_found'}, 404)
+
+    if not model_id:
+        return json_response({'ok': False, 'reason': 'missing_ids'}, 400)
+
+    src_dev, scalars = await model_prefill(req.backend, model_id)
+    return json_response({'ok': True, 'source_device_id': src_dev, 'scalars': scalars})
+
+# путь -> (обработчик, нужен ли вход)
+ASYNC_ROUTES: Dict[str, Tuple[Callable[[Request], Awaitable[Response]], bool]] = {
+    '/api/attribute_values':     (api_attribute_values, False),
+    '/api/filter_options':       (api_filter_options, False),
+    '/api/category_price_range': (api_category_price_range, False),
+    '/api/auto_search':          (api_auto_search, False),
+    '/api/model_prefill':        (api_model_prefill, True),
+    '/api/last_specs':           (api_last_specs, True),
+}
+
+
+# -------------------------------------------------
+# Точка входа ASGI
+# -------------------------------------------------
+USER_EXISTS_SQL = "SELECT 1 FROM users WHERE user_id = %s"
+
+async def has_user(req: Request) -> bool:
+    """Как load_user для @login_required: в сессии есть пользователь и он есть в users."""
+    try:
+        user_id = int(req.session['_user_id'])
+        return bool(await fetch(req.backend, USER_EXISTS_SQL, [user_id]))
+    except Exception:
+        # нет входа, чужой id или ошибка БД — пусть отвечает Flask
+        return False
+
+async def _serve(handler, login: bool, scope, receive, send):
+    req = Request(scope)
+    if login and not await has_user(req):
+        await flask_app(scope, receive, send)
+        return
+    try:
+        status, content_type, body = await handler(req)
+    except PoolTimeout as e:
+        web.app.logger.warning("%s: %s", scope['path'], e)
+        status, content_type, body = json_response({'ok': False, 'reason': 'busy'}, 503)
+    except Exception:
+        web.app.logger.exception("Ошибка асинхронного обработчика %s", scope['path'])
+        status, content_type, body = json_response({'ok': False, 'reason': 'internal_error'}, 500)
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('latin-1')),
+                    (b'content-length', str(len(body)).encode('latin-1'))],
+    })
+    await send({'type': 'http.response.body', 'body': b'' if scope['method'] == 'HEAD' else body})
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_pools()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    route = ASYNC_ROUTES.get(scope.get('path')) if scope['type'] == 'http' else None
+    if route and scope['method'] in ('GET', 'HEAD'):
+        await _serve(*route, scope, receive, send)
+        return
+    await flask_app(scope, receive, send)
@@ -0,0 +1,270 @@
+# db_pool.py
+"""
+Пул соединений для PostgreSQL и SQLite.
+
+Пул ограничен: держит до `size` простаивающих соединений и позволяет
+временно открыть ещё `max_overflow` сверх этого. Если все соединения заняты,
+acquire() ждёт освобождения не дольше `timeout` секунд и бросает PoolTimeout.
+
+Соединение, выданное пулом, ведёт себя как обычное соединение драйвера
+и поддерживает `with`: при выходе делается commit (или rollback при
+исключении), после чего соединение возвращается в пул, а не закрывается.
+after_commit(fn) откладывает fn() до успешного commit текущей транзакции
+(при rollback они отбрасываются) — так кэши процесса сбрасываются только
+тогда, когда новые данные уже видны другим соединениям.
+"""
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведённое время."""
+
+
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+class PooledConnection:
+    """Обёртка над соединением драйвера; возвращает его в пул на выходе из `with`."""
+
+    def __init__(self, pool: "ConnectionPool", raw, created_at: float):
+        self.raw = raw
+        self.backend = pool.backend
+        self._pool = pool
+        self._created_at = created_at
+        self._released = False
+        self._after_commit: List[Callable[[], Any]] = []
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        except Exception:
+            self.release(discard=True)
+            if exc_type is None:
+                raise
+            return False
+        self.release()
+        return False
+
+    def after_commit(self, fn: Callable[[], Any]):
+        """fn() — после успешного commit текущей транзакции; при rollback не вызывается."""
+        self._after_commit.append(fn)
+
+    def commit(self):
+        self.raw.commit()
+        callbacks, self._after_commit = self._after_commit, []
+        for fn in callbacks:
+            fn()
+
+    def rollback(self):
+        self._after_commit = []
+        self.raw.rollback()
+
+    def release(self, discard: bool = False):
+        if self._released:
+            return
+        self._released = True
+        self._after_commit = []
+        self._pool._put(self.raw, self._created_at, discard=discard)
+
+    def close(self):
+        """Явное закрытие: соединение выбрасывается из пула."""
+        self.release(discard=True)
+
+
+class ConnectionPool:
+    """Ограниченный потокобезопасный пул с проверкой соединений при выдаче."""
+
+    def __init__(self, backend: str, connect: Callable[[], Any], *,
+                 size: int = 5, max_overflow: int = 10, timeout: float = 30.0,
+                 recycle: float = 1800.0, ping_interval: float = 30.0):
+        self.backend = backend
+        self._connect = connect
+        self.size = max(1, size)
+        self.max_overflow = max(0, max_overflow)
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+
+        self._cond = threading.Condition()
+        self._idle: List[Tuple[Any, float, float]] = []   # (raw, created_at, released_at)
+        self._in_use = 0
+        self._pid = os.getpid()
+        self._stats = {
+            'checkouts': 0, 'created': 0, 'discarded': 0, 'failed_pings': 0,
+            'waits': 0, 'timeouts': 0, 'wait_ms_total': 0.0, 'peak_in_use': 0,
+        }
+
+    # --- выдача / возврат ---
+    def acquire(self) -> PooledConnection:
+        self._check_fork()
+        deadline = time.monotonic() + self.timeout
+        waited_from = None
+        while True:
+            with self._cond:
+                while True:
+                    if self._idle:
+                        # место занято на время проверки; SELECT 1 и close — вне блокировки,
+                        # чтобы зависший ping не держал остальные acquire()/_put()
+                        idle = self._idle.pop()
+                        self._in_use += 1
+                        break
+                    if self._in_use < self.size + self.max_overflow:
+                        # место есть — открываем новое соединение вне блокировки
+                        idle = None
+                        self._in_use += 1
+                        break
+                    if waited_from is None:
+                        waited_from = time.monotonic()
+                        self._stats['waits'] += 1
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(
+                            f"{self.backend}: нет свободных соединений "
+                            f"(size={self.size}, overflow={self.max_overflow}, timeout={self.timeout}s)"
+                        )
+                    self._cond.wait(left)
+            if idle is None:
+                break
+            raw, created_at, released_at = idle
+            if self._healthy(raw, created_at, released_at):
+                with self._cond:
+                    self._in_use -= 1
+                    return self._checkout(raw, created_at, waited_from)
+            self._close_quietly(raw)
+            with self._cond:
+                self._in_use -= 1
+                self._stats['discarded'] += 1
+                self._cond.notify()
+
+        try:
+            raw = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        now = time.monotonic()
+        with self._cond:
+            self._stats['created'] += 1
+            self._in_use -= 1
+            return self._checkout(raw, now, waited_from)
+
+    def _checkout(self, raw, created_at: float, waited_from: Optional[float]) -> PooledConnection:
+        # вызывается под self._cond
+        self._in_use += 1
+        self._stats['checkouts'] += 1
+        self._stats['peak_in_use'] = max(self._stats['peak_in_use'], self._in_use)
+        if waited_from is not None:
+            self._stats['wait_ms_total'] += (time.monotonic() - waited_from) * 1000.0
+        return PooledConnection(self, raw, created_at)
+
+    def _put(self, raw, created_at: float, discard: bool = False):
+        if not discard:
+            discard = not self._reset(raw)
+        with self._cond:
+            self._in_use -= 1
+            discard = (discard or os.getpid() != self._pid or len(self._idle) >= self.size
+                       or (self.recycle and time.monotonic() - created_at > self.recycle))
+            if discard:
+                self._stats['discarded'] += 1
+            else:
+                self._idle.append((raw, created_at, time.monotonic()))
+            self._cond.notify()
+        if discard:
+            self._close_quietly(raw)
+
+    # --- проверка здоровья ---
+    def _reset(self, raw) -> bool:
+        """Откатывает незавершённую транзакцию перед возвратом в пул."""
+        if getattr(raw, 'closed', False):
+            return False
+        try:
+            raw.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _healthy(self, raw, created_at: float, released_at: float) -> bool:
+        # вызывается без self._cond
+        now = time.monotonic()
+        if getattr(raw, 'closed', False):
+            return False
+        if self.recycle and now - created_at > self.recycle:
+            return False
+        if now - released_at < self.ping_interval:
+            return True
+        try:
+            cur = raw.cursor()
+            try:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            finally:
+                cur.close()
+            raw.rollback()
+            return True
+        except Exception:
+            with self._cond:
+                self._stats['failed_pings'] += 1
+            return False
+
+    def _check_fork(self):
+        """После fork() соединения родителя не используем: сокеты общие."""
+        if os.getpid() == self._pid:
+            return
+        with self._cond:
+            if os.getpid() != self._pid:
+                self._idle = []
+                self._in_use = 0
+                self._pid = os.getpid()
+
+    @staticmethod
+    def _close_quietly(raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    # --- метрики / завершение ---
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            data = dict(self._stats)
+            data.update({
+                'backend': self.backend,
+                'size': self.size,
+                'max_overflow': self.max_overflow,
+                'timeout': self.timeout,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+            })
+        data['wait_ms_total'] = round(data['wait_ms_total'], 2)
+        return data
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for raw, _, _ in idle:
+            self._close_quietly(raw)
@@ -0,0 +1,41 @@
+# gunicorn.conf.py
+"""
+Настройки gunicorn (читаются автоматически): `gunicorn wsgi:application`.
+
+preload_app: приложение импортируется и прогревается один раз в главном процессе,
+воркеры получают его копией при fork. Плавная перезагрузка — `kill -HUP <master>`:
+главный процесс заново проверяет и прогревает кэши, поднимает новых воркеров и
+даёт старым дообслужить запросы (graceful_timeout). Код при этом не перечитывается —
+для выкладки новой версии: `kill -USR2 <master>`, затем `kill -TERM <старый master>`.
+"""
+import multiprocessing
+import os
+
+from db_pool import env_int
+
+bind = os.getenv("WEB_BIND", "0.0.0.0:8000")
+workers = env_int("WEB_WORKERS", multiprocessing.cpu_count())
+worker_class = "gthread"
+threads = env_int("WEB_THREADS", 4)
+preload_app = True
+timeout = env_int("WEB_TIMEOUT", 60)
+graceful_timeout = env_int("WEB_GRACEFUL_TIMEOUT", 30)
+keepalive = 5
+# перезапуск воркера после N запросов (+ разброс, чтобы не все разом)
+max_requests = env_int("WEB_MAX_REQUESTS", 10000)
+max_requests_jitter = max_requests // 10
+accesslog = "-"
+
+
+def on_starting(server):
+    import wsgi
+    wsgi.prepare(logger=server.log, workers=server.cfg.workers)
+
+
+def on_reload(server):
+    import wsgi
+    try:
+        wsgi.prepare(logger=server.log, workers=server.cfg.workers)
+    except SystemExit as e:
+        # воркеры всё равно перезапустятся — с кэшами, которые наполнятся по запросам
+        server.log.error("%s", e)
@@ -0,0 +1,68 @@
+# import_cli.py
+"""
+Общая часть командных загрузчиков (import_devices.py, import_prices.py): разбор
+общих аргументов, открытие файла и --rejects, цикл событий загрузки с прогрессом
+в stderr и итог (JSON) в stdout. Код возврата — 1, если были отклонённые строки.
+"""
+import argparse
+import json
+import sys
+import time
+from typing import Any, Callable, Dict, Iterator
+
+import app as web
+
+
+def parser(description: str, batch_size: int) -> argparse.ArgumentParser:
+    """Аргументы, общие для всех загрузчиков; свои скрипт добавляет сам."""
+    ap = argparse.ArgumentParser(description=description)
+    ap.add_argument("file", help="путь к файлу или '-' для stdin")
+    ap.add_argument("--backend", choices=["pg", "sqlite"], default=web.DB_DEFAULT)
+    ap.add_argument("--format", choices=["csv", "ndjson"], default=None,
+                    help="по умолчанию — по расширению файла или первой строке")
+    ap.add_argument("--batch-size", type=int, default=batch_size)
+    ap.add_argument("--rejects", default=None, help="куда писать отклонённые строки (NDJSON)")
+    return ap
+
+
+def run(args: argparse.Namespace,
+        load: Callable[[Iterator, "web.ImportReport"], Iterator[tuple]],
+        progress: Callable[[Dict[str, Any]], str]) -> int:
+    """
+    load(records, report) — генератор событий загрузки (import_devices / import_price_feed);
+    progress(stats) — середина строки прогресса между «прочитано» и «отклонено».
+    """
+    if args.file == "-":
+        stream = sys.stdin
+    else:
+        stream = open(args.file, encoding="utf-8-sig", newline="")
+    rejects = open(args.rejects, "w", encoding="utf-8") if args.rejects else None
+    report = web.ImportReport()
+    last_print = 0.0
+    try:
+        records = web.iter_import_records(stream, args.format, args.file)
+        for event in load(records, report):
+            if event[0] == "rejected":
+                _, line_no, record, error = event
+                if rejects:
+                    rejects.write(json.dumps({'line': line_no, 'error': error, 'record': record},
+                                             ensure_ascii=False, default=str) + "\n")
+                else:
+                    print(f"строка {line_no}: {error}", file=sys.stderr)
+            elif time.monotonic() - last_print >= 1.0:
+                last_print = time.monotonic()
+                stats = report.to_dict()
+                print(f"прочитано {stats['read']}, {progress(stats)}, отклонено {stats['rejected']} "
+                      f"({stats['rows_per_second']} строк/с)", file=sys.stderr)
+    except RuntimeError as e:
+        # загрузка выключена (например, нет индекса предложений — см. migrate_offers.py)
+        print(e, file=sys.stderr)
+        return 2
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        if rejects:
+            rejects.close()
+
+    print(json.dumps(report.to_dict(), ensure_ascii=False))
+    return 1 if report.rejected else 0
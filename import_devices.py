@@ -0,0 +1,33 @@
+# import_devices.py
+"""
+Массовая загрузка устройств из CSV / NDJSON.
+
+    python import_devices.py catalog.csv --backend pg --rejects rejected.ndjson
+    python import_devices.py - --format ndjson < catalog.ndjson
+
+Столбцы — поля формы add_device (current_price, release_date, ram_gb, site_price, ...),
+справочники — id (manufacturer_id, ...) или названием (manufacturer, model, color,
+category, os, proc_model, storage_type, techn_matr, retailer). Отклонённые строки
+пишутся в --rejects (NDJSON: line, error, record), прогресс — в stderr.
+"""
+import sys
+
+import app as web
+import import_cli
+
+
+def main(argv=None) -> int:
+    ap = import_cli.parser("Массовая загрузка устройств (CSV / NDJSON)", web.IMPORT_BATCH_SIZE)
+    ap.add_argument("--create-models", action="store_true", help="создавать модели, которых нет в справочнике")
+    ap.add_argument("--user-id", type=int, default=None, help="created_by для новых устройств")
+    args = ap.parse_args(argv)
+    return import_cli.run(
+        args,
+        lambda records, report: web.import_devices(records, args.backend, report, args.user_id,
+                                                   args.batch_size, args.create_models),
+        lambda stats: f"загружено {stats['imported']}",
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+# import_prices.py
+"""
+Загрузка прайса продавцов в device_retailers (CSV / NDJSON).
+
+    python import_prices.py dns.csv --retailer DNS --backend pg
+    python import_prices.py - --format ndjson < feed.ndjson
+
+Столбцы: device_id, retailer_id или retailer (название; можно задать на весь файл
+через --retailer), price, in_stock (по умолчанию 1), last_updated (по умолчанию сегодня).
+Новые пары (устройство, продавец) добавляются, у существующих обновляются цена и
+наличие — только если что-то из них изменилось. Отклонённые строки пишутся в
+--rejects (NDJSON: line, error, record), прогресс — в stderr.
+"""
+import sys
+
+import app as web
+import import_cli
+
+
+def resolve_retailer(backend: str, value: str) -> int:
+    """--retailer: id или название продавца."""
+    if value.isdigit():
+        return int(value)
+    with web.get_conn(backend) as conn:
+        retailer_id, error = web.ImportLookups(conn).resolve('retailer', value)
+    if error:
+        raise SystemExit(error)
+    return retailer_id
+
+
+def main(argv=None) -> int:
+    ap = import_cli.parser("Загрузка прайса продавцов (CSV / NDJSON)", web.PRICE_FEED_BATCH_SIZE)
+    ap.add_argument("--retailer", default=None, help="продавец (id или название) для строк, где он не указан")
+    args = ap.parse_args(argv)
+
+    retailer_id = resolve_retailer(args.backend, args.retailer) if args.retailer else None
+    return import_cli.run(
+        args,
+        lambda records, report: web.import_price_feed(records, args.backend, report, retailer_id, args.batch_size),
+        lambda stats: (f"новых {stats['inserted']}, изменено {stats['updated']}, "
+                       f"без изменений {stats['unchanged']}"),
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,45 @@
+# migrate_offers.py
+"""
+Уникальный индекс предложений (device_id, retailer_id) для device_retailers — отдельным
+шагом, а не при старте приложения: до него запись предложений выключена.
+
+    python migrate_offers.py --backend pg            # только проверить повторы и построить индекс
+    python migrate_offers.py --backend pg --dedupe   # сначала схлопнуть повторы в последнее
+
+Повторы без --dedupe не удаляются: скрипт печатает их число и выходит с кодом 1.
+PostgreSQL строит индекс CREATE UNIQUE INDEX CONCURRENTLY — запись в таблицу не блокируется.
+"""
+import argparse
+import sys
+
+import app as web
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Уникальный индекс предложений продавцов")
+    ap.add_argument("--backend", choices=["pg", "sqlite"], default=web.DB_DEFAULT)
+    ap.add_argument("--dedupe", action="store_true",
+                    help="удалить повторы пар, оставив последнее предложение (наибольший device_retailer_id)")
+    args = ap.parse_args(argv)
+
+    with web.get_conn(args.backend) as conn:
+        if web._offer_unique_exists(conn):
+            print(f"{web.OFFER_UNIQUE_INDEX}: уже есть")
+            return 0
+        duplicates = web.offer_duplicates(conn)
+        if duplicates and not args.dedupe:
+            print(f"пар (device_id, retailer_id) с повторами: {duplicates}; "
+                  f"запустите с --dedupe, чтобы оставить последнее предложение", file=sys.stderr)
+            return 1
+        if duplicates:
+            removed = web.dedupe_offers(conn)
+            conn.commit()
+            print(f"удалено повторных предложений: {removed}")
+
+    web.create_offer_unique_index(args.backend)
+    print(f"{web.OFFER_UNIQUE_INDEX}: создан")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
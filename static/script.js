@@ -16,7 +16,7 @@ document.addEventListener('DOMContentLoaded', function() {
           data.manufacturers.forEach(function(man) {
             let opt = document.createElement('option');
             opt.value = man.manufacturer_id;
-            opt.text = man.name;
+            opt.text = man.count ? `${man.name} (${man.count})` : man.name;
             if (selected == String(man.manufacturer_id)) opt.selected = true;
             manufacturer.appendChild(opt);
           });
@@ -27,7 +27,7 @@ document.addEventListener('DOMContentLoaded', function() {
           data.colors.forEach(function(col) {
             let opt = document.createElement('option');
             opt.value = col.color_id;
-            opt.text = col.name;
+            opt.text = col.count ? `${col.name} (${col.count})` : col.name;
             if (selected == String(col.color_id)) opt.selected = true;
             color.appendChild(opt);
           });
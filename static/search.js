@@ -52,7 +52,7 @@ document.addEventListener('DOMContentLoaded', function() {
         data.manufacturers.forEach(man => {
           let opt = document.createElement('option');
           opt.value = man.manufacturer_id;
-          opt.text = man.name;
+          opt.text = man.count ? `${man.name} (${man.count})` : man.name;
           if (manValue == String(man.manufacturer_id)) opt.selected = true;
           manufacturer.appendChild(opt);
         });
@@ -63,7 +63,7 @@ document.addEventListener('DOMContentLoaded', function() {
         data.colors.forEach(col => {
           let opt = document.createElement('option');
           opt.value = col.color_id;
-          opt.text = col.name;
+          opt.text = col.count ? `${col.name} (${col.count})` : col.name;
           if (colorValue == String(col.color_id)) opt.selected = true;
           color.appendChild(opt);
         });
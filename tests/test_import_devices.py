@@ -0,0 +1,54 @@
+# tests/test_import_devices.py
+"""
+Загрузка устройств на копии db/2lr.db (SQLite): строка с ошибкой отклоняется,
+остальные загружаются.
+
+    python -m unittest discover tests
+"""
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp()
+shutil.copy(os.path.join(ROOT, "db", "2lr.db"), os.path.join(WORKDIR, "2lr.db"))
+os.environ["SQLITE_PATH"] = os.path.join(WORKDIR, "2lr.db")
+os.environ["DB_DEFAULT"] = "sqlite"
+sys.path.insert(0, ROOT)
+
+import app as web  # noqa: E402
+
+CSV = (
+    "manufacturer;category;model;color;os;release_date;current_price;proc_model_id;storage_type_id\n"
+    "Apple;Смартфоны;Galaxy 15 Pro;Чёрный;iOS 17;2024-01-01;99990;;\n"
+    "Apple;Смартфоны;Galaxy 15 Pro;Чёрный;iOS 17;2024-01-01;99990;abc;1\n"
+    "Apple;Смартфоны;Galaxy 15 Pro;Чёрный;iOS 17;2024-01-01;99990;1;x\n"
+)
+
+
+class ImportDevicesTest(unittest.TestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+    def test_bad_cell_rejects_only_its_row(self):
+        report = web.ImportReport()
+        records = web.iter_import_records(io.StringIO(CSV), "csv")
+        rejected = [event for event in web.import_devices(records, "sqlite", report) if event[0] == "rejected"]
+        self.assertEqual([line_no for _, line_no, _, _ in rejected], [3, 4])
+        self.assertIn("proc_model_id", rejected[0][3])
+        self.assertIn("storage_type_id", rejected[1][3])
+        self.assertEqual((report.imported, report.rejected), (1, 2))
+
+    def test_form_error_instead_of_exception(self):
+        plan, error = web.parse_device_form({"proc_model_id": "abc"}, "2024-01-01")
+        self.assertIsNone(plan)
+        self.assertIn("proc_model_id", error)
+
+
+if __name__ == "__main__":
+    unittest.main()
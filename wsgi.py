@@ -0,0 +1,117 @@
+# wsgi.py
+"""
+Боевая точка входа WSGI (вместо `python app.py`, где однопоточный сервер с отладчиком).
+
+    gunicorn wsgi:application          # Linux: несколько процессов, настройки в gunicorn.conf.py
+    python wsgi.py                     # Windows / без gunicorn: waitress, один процесс с потоками
+
+Перед стартом prepare() проверяет бэкенды (`SELECT 1`), прогревает кэши
+(схема, справочники, снимок статистики, число устройств, фасеты, цены, похожие) и
+закрывает соединения главного процесса: с preload_app воркеры получают
+прогретые кэши копией памяти при fork, а пулы открывают каждый свои.
+Недоступный основной бэкенд (DB_DEFAULT) — ошибка запуска, остальные — предупреждение.
+
+Кэши каждого воркера сбрасываются только его собственными записями; о записи в
+соседнем воркере кэш узнаёт по истечении срока (CACHE_TTLS). Поэтому при нескольких
+воркерах сроки 0 («не истекает») заменяются значениями по умолчанию.
+"""
+import logging
+import os
+import sys
+import time
+from typing import Dict, List
+
+import app as web
+from db_pool import env_int
+
+# WEB_BACKENDS — какие бэкенды проверять и прогревать (через запятую)
+WEB_BACKENDS = [b.strip() for b in os.getenv("WEB_BACKENDS", "pg,sqlite").split(",") if b.strip()]
+WEB_BIND = os.getenv("WEB_BIND", "0.0.0.0:8000")
+WEB_THREADS = env_int("WEB_THREADS", 4)
+
+log = logging.getLogger("wsgi")
+
+# срок кэша процесса (0 — не истекает) -> значение при нескольких воркерах, сек
+CACHE_TTLS = {
+    'REFERENCE_CACHE_TTL': 300,
+    'DEVICE_CACHE_TTL': 300,
+    'PREFILL_CACHE_TTL': 300,
+    'FACET_MAX_AGE': 300,
+    'PRICE_INDEX_MAX_AGE': 300,
+    'SIMILAR_INDEX_MAX_AGE': 300,
+}
+
+application = web.app
+
+
+def warm_up(backend: str) -> Dict[str, float]:
+    """
+    Заново заполнить кэши процесса для бэкенда; возвращает время каждого шага, мс.
+    Старое содержимое сбрасывается: главный процесс не получает уведомлений об
+    изменениях от воркеров, и к перезагрузке (HUP) его кэши уже устарели.
+    """
+    web.invalidate_schema(backend)
+    web.invalidate_reference(backend, set().union(*(src for _, src, _ in web.REFERENCE_SETS.values())))
+    web._DEVICE_COUNT.pop(backend, None)
+    timings: Dict[str, float] = {}
+    with web.get_conn(backend) as conn:
+        steps = [
+            ('schema', lambda: web.schema_catalog(conn)),
+            ('reference', lambda: web.reference_data(list(web.REFERENCE_SETS), conn)),
+            ('statistic', lambda: web.load_statistic_snapshot(conn)),
+            ('device_count', lambda: web.device_list_total(conn)),
+            ('facets', lambda: web.facet_store(backend, web.FacetIndex.build(conn))),
+            ('prices', lambda: web.price_apply(backend, web.run_queries(conn, web.PriceIndex.queries())[0], None)),
+        ]
+        if web.np is not None:
+            steps.append(('similar', lambda: web.similar_apply(
+                backend, web.run_queries(conn, web.SimilarIndex.queries())[0], None)))
+        for name, step in steps:
+            started = time.perf_counter()
+            step()
+            timings[name] = round((time.perf_counter() - started) * 1000.0, 1)
+    return timings
+
+
+def enforce_cache_ttls(workers: int, logger=log):
+    """Несколько воркеров: кэши без срока не увидели бы записей соседей — задаём срок."""
+    if workers <= 1:
+        return
+    for name, default in CACHE_TTLS.items():
+        if getattr(web, name) <= 0:
+            logger.warning("%s=0 при %d воркерах: изменения из других воркеров не были бы видны, "
+                           "берём %d с", name, workers, default)
+            setattr(web, name, default)
+
+
+def prepare(backends: List[str] = WEB_BACKENDS, logger=log, workers: int = 1):
+    """Проверка и прогрев перед запуском воркеров; SystemExit, если основной бэкенд недоступен."""
+    if web.app.secret_key == "dev_key_change_me":
+        logger.warning("FLASK_SECRET не задан — сессии подписываются ключом по умолчанию")
+    enforce_cache_ttls(workers, logger)
+    for backend in dict.fromkeys([web.DB_DEFAULT] + backends):
+        error = web.check_backend(backend)
+        if error:
+            if backend == web.DB_DEFAULT:
+                raise SystemExit(f"Основной бэкенд {backend} недоступен: {error}")
+            logger.warning("Бэкенд %s недоступен, пропускаем прогрев: %s", backend, error)
+            continue
+        logger.info("Прогрев %s: %s", backend, warm_up(backend))
+    # соединения родителя воркерам не нужны (и делить сокет между процессами нельзя)
+    web.close_pools()
+
+
+def serve():
+    """Запуск под waitress — для Windows и мест, где нет gunicorn."""
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        raise SystemExit("Нужен waitress (pip install waitress) или gunicorn: gunicorn wsgi:application")
+    prepare()
+    waitress_serve(application, listen=WEB_BIND, threads=WEB_THREADS)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    serve()